@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'NCUACG.settings')
+# AI 助理：告知 assistant 目前在長駐的事件迴圈上（async client 可跨請求重用連線池）
+os.environ.setdefault('ASSISTANT_ASGI', '1')
 
 application = get_asgi_application()
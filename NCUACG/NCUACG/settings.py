@@ -167,7 +167,8 @@ LOGGING = {
         'file': {
             'level': 'DEBUG',
             'class': 'logging.FileHandler',
-            'filename': 'debug.log',
+            # 固定在 BASE_DIR 底下（已列入 .gitignore），不再依啟動時的工作目錄落地
+            'filename': os.getenv('DJANGO_LOG_FILE') or str(BASE_DIR / 'debug.log'),
         },
     },
     'loggers': {
@@ -176,6 +177,10 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
+        # HTTP client 的 DEBUG 會把完整 prompt / 回覆寫進檔案
+        'httpx': {'level': 'WARNING'},
+        'httpcore': {'level': 'WARNING'},
+        'groq': {'level': 'WARNING'},
     },
 }
 
@@ -219,3 +224,87 @@ CSRF_TRUSTED_ORIGINS = [
 # ─────────────────────────────────────────────────────────────────────────────
 # 事件查詢預設視窗（天數）：event/views.py 可以讀此設定做預設過濾（未來 N 天）
 DEFAULT_EVENT_WINDOW_DAYS = int(os.getenv("DEFAULT_EVENT_WINDOW_DAYS", "30"))
+
+# ─────────────────────────────────────────────────────────────────────────────
+# AI 助理：嵌入模型預熱（預設關閉；gunicorn 等正式 worker 可設 ASSISTANT_WARMUP=1）
+ASSISTANT_WARMUP = os.getenv("ASSISTANT_WARMUP", "0") == "1"
+
+# AI 助理：向量搜尋後端（exact = 全表掃描；ivf = 近似最近鄰，語料量大時使用）
+ASSISTANT_SEARCH_BACKEND = os.getenv("ASSISTANT_SEARCH_BACKEND", "exact")
+ASSISTANT_IVF_MIN_ROWS = int(os.getenv("ASSISTANT_IVF_MIN_ROWS", "20000"))
+ASSISTANT_IVF_NPROBE = int(os.getenv("ASSISTANT_IVF_NPROBE", "8"))
+
+# AI 助理：查詢向量快取（容量 0 = 停用；ASSISTANT_QEMB_CACHE_SHARED 填 CACHES 的 alias 可跨 worker 共用）
+ASSISTANT_QEMB_CACHE_SIZE = int(os.getenv("ASSISTANT_QEMB_CACHE_SIZE", "1024"))
+ASSISTANT_QEMB_CACHE_TTL = int(os.getenv("ASSISTANT_QEMB_CACHE_TTL", "3600"))
+ASSISTANT_QEMB_CACHE_SHARED = os.getenv("ASSISTANT_QEMB_CACHE_SHARED") or None
+
+# AI 助理：併發查詢 micro-batching（批次大小 <= 1 = 停用）；WAIT_MS 只在還有其他查詢進行中時才等，單獨的查詢立即編碼
+ASSISTANT_QUERY_BATCH_SIZE = int(os.getenv("ASSISTANT_QUERY_BATCH_SIZE", "16"))
+ASSISTANT_QUERY_BATCH_WAIT_MS = float(os.getenv("ASSISTANT_QUERY_BATCH_WAIT_MS", "3"))
+
+# AI 助理：向量索引熱重載檢查間隔（秒；<= 0 = 停用）。重跑 scripts/build_emb.py 後不必重啟 worker
+ASSISTANT_INDEX_RELOAD_SECONDS = float(os.getenv("ASSISTANT_INDEX_RELOAD_SECONDS", "5"))
+
+# AI 助理：混合檢索（BM25 字元 bigram + 向量，以 Reciprocal Rank Fusion 合併）
+ASSISTANT_HYBRID = os.getenv("ASSISTANT_HYBRID", "1") == "1"
+ASSISTANT_RRF_K = float(os.getenv("ASSISTANT_RRF_K", "60"))
+
+# AI 助理：檢索結果 MMR 多樣化（λ 介於 0~1，越小越重視多樣性；1 = 停用）
+ASSISTANT_MMR_LAMBDA = float(os.getenv("ASSISTANT_MMR_LAMBDA", "1"))
+
+# AI 助理：時間視窗用法 pool（近期且夠相關的列補進相似度候選池，預設）/ prefilter（只搜視窗內）/ off
+# 近期列的 cosine 需 >= 候選池最佳 cosine − MARGIN 才會被優先排序
+ASSISTANT_TIME_FILTER = os.getenv("ASSISTANT_TIME_FILTER", "pool")
+ASSISTANT_WINDOW_SIM_MARGIN = float(os.getenv("ASSISTANT_WINDOW_SIM_MARGIN", "0.05"))
+
+# AI 助理：索引帶量化副本（build_emb --quantize int8/float16）時先掃副本，再以 float32 精算前 k*倍數 名
+# 只省常駐記憶體；NumPy 沒有 int8/float16 BLAS，掃描比 float32 全表內積慢，預設關閉
+ASSISTANT_QUANTIZED_SCAN = os.getenv("ASSISTANT_QUANTIZED_SCAN", "0") == "1"
+ASSISTANT_RESCORE_FACTOR = int(os.getenv("ASSISTANT_RESCORE_FACTOR", "4"))
+
+# AI 助理：LLM HTTP 連線池（同步與非同步 client 共用設定）；GROQ_BASE_URL 可指向本機 stub（scripts/groq_stub.py）
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL") or None
+LLAMA_HTTP_TIMEOUT = float(os.getenv("LLAMA_HTTP_TIMEOUT", "60"))
+LLAMA_HTTP_MAX_CONNECTIONS = int(os.getenv("LLAMA_HTTP_MAX_CONNECTIONS", "200"))
+LLAMA_HTTP_MAX_KEEPALIVE = int(os.getenv("LLAMA_HTTP_MAX_KEEPALIVE", "50"))
+LLAMA_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("LLAMA_HTTP_KEEPALIVE_EXPIRY", "30"))
+
+# AI 助理：以 ASGI 部署時讓 /api/assistant/chat/ 改走 async view（WSGI 請維持 0）
+ASSISTANT_ASYNC_CHAT = os.getenv("ASSISTANT_ASYNC_CHAT", "0") == "1"
+# AI 助理：是否以 ASGI 執行（NCUACG/asgi.py 會設為 1）；決定是否掛上 /chat/async/ 與 async client 的生命週期
+ASSISTANT_ASGI = os.getenv("ASSISTANT_ASGI", "0") == "1"
+
+# AI 助理：LLM 回覆快取（完全相同的 model/persona/脈絡/訊息/temperature 直接回傳；TTL 0 = 停用）
+# 預設為行程內 LocMemCache（MAX_ENTRIES 即容量上限）；多 worker 共用可改成 Redis 等後端：
+#   ASSISTANT_CACHE_BACKEND=django.core.cache.backends.redis.RedisCache ASSISTANT_CACHE_LOCATION=redis://127.0.0.1:6379/1
+ASSISTANT_RESPONSE_CACHE_TTL = int(os.getenv("ASSISTANT_RESPONSE_CACHE_TTL", "600"))
+ASSISTANT_RESPONSE_CACHE_SIZE = int(os.getenv("ASSISTANT_RESPONSE_CACHE_SIZE", "2048"))
+ASSISTANT_RESPONSE_CACHE_ALIAS = os.getenv("ASSISTANT_RESPONSE_CACHE_ALIAS", "assistant")
+_ASSISTANT_CACHE_BACKEND = os.getenv("ASSISTANT_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache")
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "assistant": {
+        "BACKEND": _ASSISTANT_CACHE_BACKEND,
+        "LOCATION": os.getenv("ASSISTANT_CACHE_LOCATION", "assistant"),
+    },
+}
+if _ASSISTANT_CACHE_BACKEND.endswith("LocMemCache"):
+    # 只有行程內後端吃 MAX_ENTRIES；Redis 等共用後端的容量由伺服器端（maxmemory）控制
+    CACHES["assistant"]["OPTIONS"] = {"MAX_ENTRIES": ASSISTANT_RESPONSE_CACHE_SIZE}
+
+# AI 助理：語意回覆快取（E5 查詢向量 cosine >= 門檻且 persona/脈絡相同即沿用回覆；容量 0 = 停用）
+ASSISTANT_SEMANTIC_CACHE_SIZE = int(os.getenv("ASSISTANT_SEMANTIC_CACHE_SIZE", "1024"))
+# 門檻之外，問題中的數字與英數詞也要相同才命中（見 services/semantic_cache.py 的 query_guard）
+ASSISTANT_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("ASSISTANT_SEMANTIC_CACHE_THRESHOLD", "0.95"))
+ASSISTANT_SEMANTIC_CACHE_TTL = int(os.getenv("ASSISTANT_SEMANTIC_CACHE_TTL", "600"))
+
+# AI 助理：single-flight（同一句話的併發請求只做一次檢索 + LLM 呼叫）
+# SHARED=1 時以 ASSISTANT_RESPONSE_CACHE_ALIAS 的共用後端（例如 Redis）當鎖，跨 worker 也只呼叫一次 Groq
+ASSISTANT_SINGLEFLIGHT = os.getenv("ASSISTANT_SINGLEFLIGHT", "1") == "1"
+ASSISTANT_SINGLEFLIGHT_SHARED = os.getenv("ASSISTANT_SINGLEFLIGHT_SHARED", "0") == "1"
+ASSISTANT_SINGLEFLIGHT_LOCK_TTL = float(os.getenv("ASSISTANT_SINGLEFLIGHT_LOCK_TTL", "60"))
+ASSISTANT_SINGLEFLIGHT_WAIT = float(os.getenv("ASSISTANT_SINGLEFLIGHT_WAIT", "60"))
+
+# AI 助理：RAG 脈絡 token 預算（依排序填入、句子邊界截斷、去重；personas.json 的 context_tokens 可逐一覆寫；<= 0 = 不限）
+ASSISTANT_CONTEXT_TOKENS = int(os.getenv("ASSISTANT_CONTEXT_TOKENS", "1200"))
@@ -1,6 +1,16 @@
+import os
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class AssistantConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'assistant'
+
+    def ready(self):
+        # 預設不載入嵌入模型（manage.py / migrate 不需要 torch）；
+        # 正式環境可設 ASSISTANT_WARMUP=1，讓 worker 啟動後在背景先把模型載好
+        if getattr(settings, "ASSISTANT_WARMUP", False) or os.getenv("ASSISTANT_WARMUP") == "1":
+            from .services.embedding import warmup
+            warmup()
@@ -0,0 +1,92 @@
+# NCUACG/assistant/management/commands/run_query_log.py
+from __future__ import annotations
+
+import json
+import time
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+
+from assistant.services.retriever import Window, index_generation, search_batch
+from assistant.services.timeparse import parse_dt
+
+
+def _read_log(path: Path) -> Iterator[Tuple[str, Window]]:
+    """
+    每行一筆查詢：純文字，或 JSON 物件 {"query": ..., "from"?: ..., "to"?: ...}
+    （from/to 同時給才會當作該查詢的時間視窗）。
+    """
+    with open(path, "r", encoding="utf-8-sig") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith("{"):
+                yield line, None
+                continue
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise CommandError(f"{path}:{lineno}: {e.msg}")
+            query = str(rec.get("query") or rec.get("message") or "").strip()
+            if not query:
+                continue
+            lo, hi = parse_dt(rec.get("from")), parse_dt(rec.get("to"))
+            yield query, ((lo, hi) if lo and hi else None)
+
+
+class Command(BaseCommand):
+    help = "把查詢紀錄檔批次送進 retriever（search_batch），回報吞吐量；也可用來預熱查詢向量快取。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", type=Path, help="查詢紀錄檔（每行一筆，純文字或 JSON）")
+        parser.add_argument("--k", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=64, help="每次 search_batch 的查詢數")
+        parser.add_argument("--limit", type=int, default=None, help="最多處理幾筆")
+        parser.add_argument("--json", action="store_true", help="輸出 JSON")
+
+    def handle(self, *args, **opts):
+        path: Path = opts["path"]
+        if not path.is_file():
+            raise CommandError(f"query log not found: {path}")
+        entries = list(_read_log(path))[: opts["limit"]]
+        if not entries:
+            raise CommandError(f"no queries in {path}")
+
+        generation, content_hash = index_generation()   # 先載入索引，不算進吞吐量
+        size = max(1, opts["batch_size"])
+        embed_ms: List[float] = []
+        rank_ms: List[float] = []
+        empty = 0
+        t0 = time.perf_counter()
+        for start in range(0, len(entries), size):
+            batch = entries[start:start + size]
+            results = search_batch([q for q, _ in batch], k=opts["k"], windows=[w for _, w in batch])
+            for r in results:
+                embed_ms.append(r.timings["embed_ms"])
+                rank_ms.append(r.timings["rank_ms"])
+                empty += not r.hits
+        elapsed = time.perf_counter() - t0
+
+        report = {
+            "queries": len(entries),
+            "batch_size": size,
+            "k": opts["k"],
+            "seconds": round(elapsed, 4),
+            "queries_per_second": round(len(entries) / elapsed, 2) if elapsed else None,
+            "avg_embed_ms": round(sum(embed_ms) / len(embed_ms), 4),
+            "avg_rank_ms": round(sum(rank_ms) / len(rank_ms), 4),
+            "empty_results": empty,
+            "index_generation": generation,
+            "index_hash": content_hash[:12],
+        }
+        if opts["json"]:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+            return
+        self.stdout.write(
+            f"{report['queries']} 筆查詢，{report['seconds']:.3f}s，"
+            f"{report['queries_per_second']} q/s（embed {report['avg_embed_ms']:.3f} ms/q，"
+            f"rank {report['avg_rank_ms']:.3f} ms/q，空結果 {empty} 筆）"
+        )
+
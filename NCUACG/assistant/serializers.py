@@ -72,11 +72,13 @@ class ChatResponseSerializer(serializers.Serializer):
     - persona: 實際使用的 persona（選填）
     - conversation_id: 對話識別（選填）
     - usage: 計量/除錯資訊（選填，結構不固定，採任意 dict）
+    - sources: 本次回答引用的站內文件（title/source/date/score…，選填）
     """
     reply = serializers.CharField()
     persona = serializers.CharField(required=False, allow_blank=True, allow_null=True)
     conversation_id = serializers.CharField(required=False, allow_blank=True, allow_null=True)
     usage = serializers.DictField(required=False)
+    sources = serializers.ListField(child=serializers.DictField(), required=False)
 
 
 class PersonaSerializer(serializers.Serializer):
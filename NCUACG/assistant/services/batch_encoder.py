@@ -0,0 +1,159 @@
+# NCUACG/assistant/services/batch_encoder.py
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 查詢 micro-batching
+# 每個請求執行緒把查詢丟進佇列、拿回一個 Future；背景執行緒在「湊滿 max_batch 筆」
+# 或「第一筆進來後等了 max_wait_ms」時一次送進模型，再把結果分發回各 Future。
+# 一次 encode 16 筆與 1 筆的耗時差不多，尖峰時每個 worker 的吞吐量因此倍增。
+# 只有還有其他請求正在 encode() 裡（還沒排進這一批）時才等；單獨一筆立即送出，
+# 單一使用者不會多付 max_wait_ms。模型忙的時候進來的請求自然在佇列裡累積成下一批。
+#
+# prepare（例如載入模型）在呼叫端執行緒上先做完才排隊：冷啟動載入模型可能要數十秒，
+# 不計入 encode() 的 timeout，也不會讓背景執行緒卡住時後面的請求一起逾時。
+EncodeFn = Callable[[Sequence[str]], np.ndarray]
+
+
+class BatchingEncoder:
+    def __init__(
+        self,
+        encode_fn: EncodeFn,
+        max_batch: int = 16,
+        max_wait_ms: float = 3.0,
+        name: str = "query-batcher",
+        prepare: Optional[Callable[[], Any]] = None,
+    ):
+        self.encode_fn = encode_fn
+        self.prepare = prepare
+        self._ready = prepare is None
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.name = name
+        self._queue: "queue.Queue[Optional[Tuple[str, Future]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._active = 0                 # 進了 encode() 但結果還沒出來的呼叫數
+        self._active_lock = threading.Lock()
+        # 以下統計只由背景執行緒寫入（單一寫入者），stats() 讀到略舊的值無妨，不加鎖
+        self.batches = 0
+        self.items = 0
+        self.max_seen = 0
+
+    # ---- 生命週期 ----
+    def _ensure_started(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def close(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+    # ---- 對外 ----
+    def submit(self, text: str) -> Future:
+        fut: Future = Future()
+        self._ensure_started()
+        self._queue.put((text, fut))
+        return fut
+
+    def ensure_ready(self) -> None:
+        """執行 prepare（只成功一次；併發呼叫由 prepare 自己的鎖序列化，例如 get_model）。"""
+        if not self._ready:
+            self.prepare()
+            self._ready = True
+
+    def encode(self, text: str, timeout: Optional[float] = 30.0) -> np.ndarray:
+        """timeout 只計算排隊 + 編碼；模型載入在這之前完成。"""
+        with self._active_lock:
+            self._active += 1
+        try:
+            self.ensure_ready()
+            fut = self.submit(text)
+        except BaseException:
+            self._leave()
+            raise
+        # 結果一設定就扣掉（在背景執行緒上、收下一批之前），不等呼叫端醒來
+        fut.add_done_callback(self._leave)
+        return fut.result(timeout=timeout)
+
+    def _leave(self, _fut: Optional[Future] = None) -> None:
+        with self._active_lock:
+            self._active -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "max_batch_seen": self.max_seen,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "active": self._active,
+        }
+
+    # ---- 背景執行緒 ----
+    def _others_pending(self, batched: int) -> bool:
+        """佇列裡還有東西，或有 encode() 呼叫還沒排進這一批（例如正在 prepare / 剛要 submit）。"""
+        return not self._queue.empty() or self._active > batched
+
+    def _collect(self, first: Tuple[str, Future]) -> Tuple[List[Tuple[str, Future]], bool]:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch and self._others_pending(len(batch)):
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _flush(self, batch: List[Tuple[str, Future]]) -> None:
+        live = [(t, f) for (t, f) in batch if f.set_running_or_notify_cancel()]
+        if not live:
+            return
+        # 同一批內的相同查詢只編碼一次
+        uniq: Dict[str, int] = {}
+        for t, _ in live:
+            uniq.setdefault(t, len(uniq))
+        try:
+            vecs = np.asarray(self.encode_fn(list(uniq.keys())), dtype=np.float32)
+        except BaseException as e:  # noqa: BLE001 例外要交回給每個等待中的請求
+            for _, f in live:
+                f.set_exception(e)
+            return
+        for t, f in live:
+            f.set_result(vecs[uniq[t]])
+        self.batches += 1
+        self.items += len(live)
+        self.max_seen = max(self.max_seen, len(live))
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch, stop = self._collect(first)
+            self._flush(batch)
+            if stop:
+                return
+
+
+__all__ = ["BatchingEncoder"]
@@ -0,0 +1,142 @@
+# NCUACG/assistant/services/chunking.py
+from __future__ import annotations
+
+import math
+import re
+from typing import Any, Callable, Dict, Iterable, List
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 依句子切塊（取代每 500 字硬切）
+# 1) 以中英文句末標點（。！？；… / . ! ? ;）與換行切句，標點留在句尾
+# 2) 依 token 預算把連續句子裝進同一塊；超過預算的單句才硬切
+# 3) 相鄰兩塊重疊最後幾句（overlap 預算內），跨塊的問題仍能命中
+# 本模組不依賴 Django，scripts/build_emb.py 直接使用。
+DEFAULT_MAX_TOKENS = 256
+DEFAULT_OVERLAP_TOKENS = 32
+
+# 每個 chunk 都會帶上的來源欄位（notices.json 的結構化 metadata）
+# notices.json 的 date 是「發布日」不是活動日期；改名為 posted 帶進 chunk，
+# 否則 timeparse 會把它當成開始時間（"8/30社團博覽會" 被當成 7/16 的活動）。
+META_KEYS = ("id", "date", "type", "category")
+META_RENAME = {"date": "posted"}
+
+_SENT_RE = re.compile(r".+?(?:[。！？；…]+[」』”’）)]*|[.!?;]+(?=\s|$)|\n+|$)", re.S)
+_CJK_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]")
+_WORD_RE = re.compile(r"[A-Za-z0-9]+")
+
+TokenCounter = Callable[[str], int]
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    不載入 tokenizer 的估計：中日韓字元各算 1，英數詞約 4 字元 1 個，
+    其餘標點各算 1。對 E5 / Llama 的 sentencepiece 而言略為高估，切塊時偏保守。
+    """
+    cjk = len(_CJK_RE.findall(text))
+    words = sum(math.ceil(len(w) / 4) for w in _WORD_RE.findall(text))
+    rest = len(_WORD_RE.sub("", _CJK_RE.sub("", text)).replace(" ", ""))
+    return cjk + words + rest
+
+
+def split_sentences(text: str) -> List[str]:
+    """切成句子（保留句末標點）；空白正規化後丟掉空句。"""
+    out: List[str] = []
+    for m in _SENT_RE.finditer(text or ""):
+        s = re.sub(r"\s+", " ", m.group(0)).strip()
+        if s:
+            out.append(s)
+    return out
+
+
+def _hard_split(sentence: str, max_tokens: int, count: TokenCounter) -> List[str]:
+    """單句超過預算時，依字元二分找出能放進預算的最長前綴。"""
+    pieces: List[str] = []
+    rest = sentence
+    while rest:
+        if count(rest) <= max_tokens:
+            pieces.append(rest)
+            break
+        lo, hi = 1, len(rest)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if count(rest[:mid]) <= max_tokens:
+                lo = mid
+            else:
+                hi = mid - 1
+        pieces.append(rest[:lo].strip())
+        rest = rest[lo:].strip()
+    return [p for p in pieces if p]
+
+
+def chunk_sentences(
+    text: str,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    overlap_tokens: int = DEFAULT_OVERLAP_TOKENS,
+    count: TokenCounter = estimate_tokens,
+) -> List[str]:
+    """把 text 切成不超過 max_tokens 的塊；相鄰塊重疊最多 overlap_tokens 的尾句。"""
+    max_tokens = max(1, int(max_tokens))
+    overlap_tokens = max(0, min(int(overlap_tokens), max_tokens // 2))
+
+    units: List[tuple] = []
+    for s in split_sentences(text):
+        n = count(s)
+        if n <= max_tokens:
+            units.append((s, n))
+        else:
+            units.extend((p, count(p)) for p in _hard_split(s, max_tokens, count))
+
+    chunks: List[str] = []
+    cur: List[tuple] = []
+    cur_tokens = 0
+    fresh = 0   # cur 裡不屬於重疊的句數；全是重疊時不輸出
+    for s, n in units:
+        if cur and cur_tokens + n > max_tokens:
+            if fresh:
+                chunks.append(_join(u for u, _ in cur))
+            # 從尾端往回取，湊出重疊的句子
+            carry: List[tuple] = []
+            carry_tokens = 0
+            for u in reversed(cur):
+                if carry_tokens + u[1] > overlap_tokens or carry_tokens + u[1] + n > max_tokens:
+                    break
+                carry.insert(0, u)
+                carry_tokens += u[1]
+            cur, cur_tokens, fresh = carry, carry_tokens, 0
+        cur.append((s, n))
+        cur_tokens += n
+        fresh += 1
+    if cur and fresh:
+        chunks.append(_join(u for u, _ in cur))
+    return chunks
+
+
+def _join(sentences: Iterable[str]) -> str:
+    """中文句子直接相接；兩側都是英數時補一個空白。"""
+    out = ""
+    for s in sentences:
+        if out and (out[-1].isascii() and out[-1].isalnum() or out[-1] in ".!?;,") and s[:1].isascii():
+            out += " "
+        out += s
+    return out
+
+
+def carry_meta(
+    record: Dict[str, Any],
+    keys: Iterable[str] = META_KEYS,
+    rename: Dict[str, str] = META_RENAME,
+) -> Dict[str, Any]:
+    """從來源紀錄取出要帶進每個 chunk 的欄位（缺少或空值的略過；依 rename 改欄位名）。"""
+    return {rename.get(k, k): record[k] for k in keys if record.get(k) not in (None, "")}
+
+
+__all__ = [
+    "DEFAULT_MAX_TOKENS",
+    "DEFAULT_OVERLAP_TOKENS",
+    "META_KEYS",
+    "META_RENAME",
+    "estimate_tokens",
+    "split_sentences",
+    "chunk_sentences",
+    "carry_meta",
+]
@@ -0,0 +1,38 @@
+# NCUACG/assistant/services/conf.py
+from __future__ import annotations
+
+import os
+from typing import Any, Callable, Optional
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 助理服務的設定讀取：Django settings 優先，其次環境變數，最後用預設值。
+# 不在 Django 環境（例如 scripts/ 直接匯入）時也能運作。
+_TRUE = {"1", "true", "yes", "on"}
+
+
+def setting(name: str, default: Any = None, cast: Optional[Callable[[Any], Any]] = None) -> Any:
+    value: Any = None
+    try:
+        from django.conf import settings  # type: ignore
+        value = getattr(settings, name, None)
+    except Exception:  # 未設定 DJANGO_SETTINGS_MODULE 等情況
+        value = None
+    if value is None:
+        value = os.getenv(name)
+    if value is None:
+        return default
+    if cast is None:
+        return value
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def as_bool(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in _TRUE
+
+
+__all__ = ["setting", "as_bool"]
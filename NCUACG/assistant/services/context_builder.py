@@ -0,0 +1,168 @@
+# NCUACG/assistant/services/context_builder.py
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from .chunking import TokenCounter, estimate_tokens, split_sentences
+from .dedup import exact_key, hamming, simhash
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 有 token 預算的 RAG 脈絡組裝（取代把 k 段原文直接串起來）
+# 1) 依排序逐段放入，直到用完預算；放不下的那段在句子邊界截斷，之後的段落不再放
+# 2) 同一份文件（id / slug / url / section）且標題列相同的多段共用一個標題列
+#    （[標題] 日期），不重複輸出；區塊依各文件最先出現的排名排列
+# 3) 與已放入內容重複的句子略過（切塊時的重疊句）；整段幾乎都重複、
+#    或 SimHash 與已放入的段落近似時整段丟掉
+# prompt token 越少，Groq 的首字延遲與費用越低。
+SEPARATOR = "\n---\n"
+_TZ_TW = timezone(timedelta(hours=8))
+_NEAR_DUP_DISTANCE = 3
+_MIN_NOVEL_RATIO = 0.2      # 新句子佔比低於此值視為重複段落
+_TRUNCATION_MARK = "…"
+
+
+@dataclass
+class ContextPlan:
+    text: str
+    tokens: int                                   # 估計的脈絡 token 數
+    budget: Optional[int]                         # None = 不限
+    rows: List[int] = field(default_factory=list)         # 有放入的索引列（排序順序）
+    truncated: List[int] = field(default_factory=list)    # 在句子邊界截斷的列
+    redundant: List[int] = field(default_factory=list)    # 因重複而丟掉的列
+    over_budget: List[int] = field(default_factory=list)  # 預算用完沒放入的列
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "context_tokens": self.tokens,
+            "context_budget": self.budget,
+            "context_chunks": len(self.rows),
+            "context_truncated": len(self.truncated),
+            "context_redundant": len(self.redundant),
+            "context_over_budget": len(self.over_budget),
+        }
+
+
+def hit_header(doc: Dict[str, Any], start: Optional[datetime]) -> str:
+    """[標題] 開始時間（台灣時間）；顯示有解析到的日期，幫助 persona 嚴格控雷。"""
+    title = str(doc.get("title", "") or "").strip()
+    dt_str = start.astimezone(_TZ_TW).strftime("%Y-%m-%d %H:%M %Z") if start else ""
+    if not title and not dt_str:
+        return ""
+    return f"[{title}] {dt_str}".strip()
+
+
+# 判斷「同一份原始文件」的欄位，依序取第一個有值的（chunking 會把它們帶進每一段）
+_PARENT_KEYS = ("id", "slug", "url", "section")
+
+
+def parent_key(doc: Dict[str, Any]) -> Optional[Tuple[Any, ...]]:
+    """
+    段落所屬文件的 key（同一則公告的各段相同）；沒有任何識別欄位時，
+    退回 (來源, 標題)，連標題都沒有則回傳 None（只代表自己，不與其他段合併）。
+    """
+    source = str(doc.get("source", "") or "")
+    for name in _PARENT_KEYS:
+        value = doc.get(name)
+        if value not in (None, ""):
+            return (source, name, str(value))
+    title = str(doc.get("title", "") or "").strip()
+    return (source, "title", title) if title else None
+
+
+class _Group:
+    __slots__ = ("header", "lines")
+
+    def __init__(self, header: str):
+        self.header = header
+        self.lines: List[str] = []
+
+    def render(self) -> str:
+        return "\n".join([self.header, *self.lines] if self.header else self.lines)
+
+
+def build_context(
+    hits: Sequence[Any],
+    budget: Optional[int] = None,
+    count: TokenCounter = estimate_tokens,
+) -> ContextPlan:
+    """
+    hits：依排序的 SearchHit（需有 row / doc / start）。
+    budget：脈絡 token 上限；None 或 <= 0 代表不限（仍會去重與合併標題）。
+    """
+    limit = budget if budget and budget > 0 else None
+    sep_cost = count(SEPARATOR)
+    plan = ContextPlan(text="", tokens=0, budget=limit)
+    groups: Dict[Tuple[Any, ...], _Group] = {}
+    order: List[_Group] = []
+    seen: Set[bytes] = set()
+    sigs: List[int] = []
+    used = 0
+    full = False
+
+    for h in hits:
+        if full:
+            plan.over_budget.append(int(h.row))
+            continue
+        content = str(h.doc.get("content", "") or "").strip()
+        sig = simhash(content) if content else 0
+        if sig and any(hamming(sig, s) <= _NEAR_DUP_DISTANCE for s in sigs):
+            plan.redundant.append(int(h.row))
+            continue
+        sentences = split_sentences(content)
+        novel = [s for s in sentences if exact_key(s) not in seen]
+        if len(novel) < max(1, _MIN_NOVEL_RATIO * len(sentences)):
+            plan.redundant.append(int(h.row))
+            continue
+
+        header = hit_header(h.doc, h.start)
+        # 同文件且標題列相同才合併：無標題、無日期的不同文件不會擠進同一個區塊
+        parent = parent_key(h.doc)
+        key = (parent, header) if parent is not None else ("row", int(h.row))
+        group = groups.get(key)
+        cost = 1                                    # 換行
+        if group is None:
+            cost += (count(header) + 1 if header else 0) + (sep_cost if order else 0)
+        cost += count(_TRUNCATION_MARK)             # 預留截斷記號，確保截斷後仍在預算內
+        take: List[str] = []
+        for s in novel:
+            n = count(s)
+            if limit is not None and used + cost + n > limit:
+                full = True
+                break
+            take.append(s)
+            cost += n
+        if not take:
+            # 第一句就放不下：這段與之後的段落都不放
+            plan.over_budget.append(int(h.row))
+            full = True
+            continue
+
+        if group is None:
+            group = groups[key] = _Group(header)
+            order.append(group)
+        line = "".join(take) if _is_cjk_text(take) else " ".join(take)
+        if full:
+            line += _TRUNCATION_MARK
+            plan.truncated.append(int(h.row))
+        else:
+            cost -= count(_TRUNCATION_MARK)
+        group.lines.append(line)
+        used += cost
+        plan.rows.append(int(h.row))
+        seen.update(exact_key(s) for s in take)
+        if sig:
+            sigs.append(sig)
+
+    plan.text = SEPARATOR.join(g.render() for g in order)
+    plan.tokens = count(plan.text) if plan.text else 0
+    return plan
+
+
+def _is_cjk_text(sentences: List[str]) -> bool:
+    """中文句子直接相接；全是英數句子時以空白分隔。"""
+    return any(not s[:1].isascii() for s in sentences)
+
+
+__all__ = ["SEPARATOR", "ContextPlan", "hit_header", "parent_key", "build_context"]
@@ -0,0 +1,219 @@
+# NCUACG/assistant/services/dedup.py
+from __future__ import annotations
+
+import hashlib
+import re
+import unicodedata
+from array import array
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from .lexical import tokenize
+from .timeparse import NAT, extract_start_dt
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 建索引時去重 + 查詢時 MMR 多樣化
+# notices.json 有整段重複貼上的公告；切塊後會變成幾乎相同的向量，
+# 擠掉 topk 裡其他結果、也浪費 LLM 脈絡。
+#
+# - 完全重複：正規化後文字的 sha1
+# - 近似重複：64-bit SimHash（字元 bigram 加權），以 4 段 16-bit band 做 LSH 找候選，
+#   漢明距離 <= max_distance 視為重複
+# 重複段落不寫入索引，改記在代表列的 back-reference（來源 metadata）。
+# SimHash 比對跨所有已保留的段落：標題或發布日不同的轉貼照樣合併，
+# group（標題, 發布日）只在有多個代表可選時當 tiebreaker（同 group 者優先）。
+# 唯一的硬邊界是 scope（活動開始時間）：文字相同但開始時間不同的公告
+# （例如每年重貼一次、日期寫在標題上的活動）是不同的活動，不能互相吃掉。
+SIMHASH_BITS = 64
+_BANDS = 4
+_BAND_BITS = SIMHASH_BITS // _BANDS
+_BAND_MASK = (1 << _BAND_BITS) - 1
+
+RefSink = Callable[[int, Dict[str, Any]], None]
+
+# back-reference 保留的欄位（足以回溯到原始公告）
+REF_KEYS = ("source", "title", "slug", "id", "posted", "date", "url", "section", "chunk")
+
+
+def _normalize(text: str) -> str:
+    t = unicodedata.normalize("NFKC", text or "").lower()
+    return re.sub(r"\s+", " ", t).strip()
+
+
+def exact_key(text: str) -> bytes:
+    return hashlib.sha1(_normalize(text).encode("utf-8")).digest()
+
+
+def _token_hash(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def simhash(text: str) -> int:
+    """64-bit SimHash；每個 token 以出現次數加權。沒有 token 時回傳 0。"""
+    counts: Dict[str, int] = {}
+    for t in tokenize(text):
+        counts[t] = counts.get(t, 0) + 1
+    if not counts:
+        return 0
+    hashes = np.array([_token_hash(t) for t in counts], dtype=np.uint64)
+    weights = np.array(list(counts.values()), dtype=np.int64)
+    bits = (hashes[:, None] >> np.arange(SIMHASH_BITS, dtype=np.uint64)) & np.uint64(1)
+    votes = ((bits.astype(np.int64) * 2 - 1) * weights[:, None]).sum(axis=0)
+    return int(sum(1 << i for i in np.flatnonzero(votes > 0)))
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def dedup_group(doc: Dict[str, Any]) -> Hashable:
+    """預設的 tiebreaker：(標題, 發布日)；近似重複有多個代表可選時，相同者優先。"""
+    return (
+        str(doc.get("title", "") or ""),
+        str(doc.get("posted", doc.get("date", "")) or ""),
+    )
+
+
+def dedup_scope(doc: Dict[str, Any]) -> int:
+    """預設的合併範圍：活動開始時間（epoch 秒，解析不到為 NaT）；不同者永遠不合併。"""
+    dt = extract_start_dt(doc)
+    return int(dt.timestamp()) if dt else NAT
+
+
+def _group_id(group: Hashable) -> int:
+    """group 壓成 int64 存放（每列 8 bytes，不留 tuple 物件）。"""
+    return int.from_bytes(hashlib.blake2b(repr(group).encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+class Deduplicator:
+    """
+    串流式去重：依序呼叫 check(text, group, scope)，回傳代表列號（重複）或 None（新內容，
+    呼叫端寫入後此內容的列號為目前已保留的筆數）。scope 不同的內容永遠不會合併；
+    group 只決定近似重複有多個代表時選哪一個（同 group → 漢明距離小 → 列號小）。
+    """
+
+    def __init__(self, max_distance: int = 3, near: bool = True):
+        self.max_distance = int(max_distance)
+        self.near = near and self.max_distance >= 0
+        self._exact: Dict[Tuple[bytes, int], int] = {}
+        self._bands: List[Dict[int, List[int]]] = [{} for _ in range(_BANDS)]
+        self._sigs = array("Q")
+        self._groups = array("q")
+        self._scopes = array("q")
+        self.kept = 0
+        self.exact_dups = 0
+        self.near_dups = 0
+
+    def _near_match(self, sig: int, group: int, scope: int) -> Optional[int]:
+        seen = set()
+        best: Optional[Tuple[bool, int, int]] = None
+        for b in range(_BANDS):
+            key = (sig >> (b * _BAND_BITS)) & _BAND_MASK
+            for row in self._bands[b].get(key, ()):
+                if row in seen:
+                    continue
+                seen.add(row)
+                if self._scopes[row] != scope:
+                    continue
+                dist = hamming(sig, self._sigs[row])
+                if dist <= self.max_distance:
+                    rank = (self._groups[row] != group, dist, row)
+                    if best is None or rank < best:
+                        best = rank
+        return None if best is None else best[2]
+
+    def check(self, text: str, group: Hashable = None, scope: int = NAT) -> Optional[int]:
+        scope = int(scope)
+        key = (exact_key(text), scope)
+        rep = self._exact.get(key)
+        if rep is not None:
+            self.exact_dups += 1
+            return rep
+        gid = _group_id(group)
+        sig = simhash(text) if self.near else 0
+        if self.near and sig:
+            rep = self._near_match(sig, gid, scope)
+            if rep is not None:
+                self.near_dups += 1
+                self._exact[key] = rep
+                return rep
+        row = self.kept
+        self._exact[key] = row
+        self._sigs.append(sig)
+        self._groups.append(gid)
+        self._scopes.append(scope)
+        if self.near and sig:
+            for b in range(_BANDS):
+                self._bands[b].setdefault((sig >> (b * _BAND_BITS)) & _BAND_MASK, []).append(row)
+        self.kept += 1
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        return {"kept": self.kept, "exact_dups": self.exact_dups, "near_dups": self.near_dups}
+
+
+def dedup_docs(
+    docs: Iterable[Dict[str, Any]],
+    dedup: Deduplicator,
+    refs: Union[Dict[int, List[Dict[str, Any]]], RefSink],
+    group: Callable[[Dict[str, Any]], Hashable] = dedup_group,
+    scope: Callable[[Dict[str, Any]], int] = dedup_scope,
+) -> Iterator[Dict[str, Any]]:
+    """
+    只 yield 保留下來的 doc；重複者的來源 metadata 記到 refs[代表列號]。
+    refs 也可以是 callable(代表列號, ref)，例如 build_emb 直接寫到暫存檔，不留在記憶體。
+    """
+    add = refs if callable(refs) else (lambda rep, ref: refs.setdefault(rep, []).append(ref))
+    for d in docs:
+        rep = dedup.check(str(d.get("content", "")), group(d), scope(d))
+        if rep is None:
+            yield d
+        else:
+            add(rep, {k: d[k] for k in REF_KEYS if k in d})
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Maximal Marginal Relevance
+def mmr_select(
+    vecs: np.ndarray,
+    q: np.ndarray,
+    candidates: Sequence[int],
+    k: int,
+    lam: float = 0.7,
+) -> List[int]:
+    """
+    從 candidates 依 MMR 挑 k 筆：argmax λ·sim(q, d) − (1−λ)·max sim(d, 已選)。
+    λ = 1 等同純相關度；回傳的列號保持挑選順序。
+    """
+    cand = np.asarray(candidates, dtype=np.int64)
+    if cand.size <= 1 or k <= 0:
+        return cand[:k].tolist()
+    sub = np.asarray(vecs[cand], dtype=np.float32)
+    rel = sub @ np.asarray(q, dtype=np.float32)
+    sim = sub @ sub.T
+    chosen: List[int] = []
+    max_sim = np.full(cand.size, -np.inf, dtype=np.float32)
+    available = np.ones(cand.size, dtype=bool)
+    for _ in range(min(k, cand.size)):
+        redundancy = np.where(np.isfinite(max_sim), max_sim, 0.0)
+        score = lam * rel - (1.0 - lam) * redundancy
+        score[~available] = -np.inf
+        j = int(np.argmax(score))
+        chosen.append(j)
+        available[j] = False
+        max_sim = np.maximum(max_sim, sim[j])
+    return cand[chosen].tolist()
+
+
+__all__ = [
+    "REF_KEYS",
+    "exact_key",
+    "simhash",
+    "hamming",
+    "dedup_group",
+    "dedup_scope",
+    "Deduplicator",
+    "dedup_docs",
+    "mmr_select",
+]
@@ -0,0 +1,95 @@
+# NCUACG/assistant/services/embedding.py
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 查詢嵌入模型註冊表
+# - 第一次使用才載入（manage.py / migrate 不會碰到 torch）
+# - 同一個行程內所有執行緒共用同一個實例
+# - 記錄載入耗時，方便觀察 worker 冷啟動成本
+DEFAULT_MODEL_NAME = "intfloat/multilingual-e5-base"
+
+_MODELS: Dict[str, Any] = {}
+_LOAD_SECONDS: Dict[str, float] = {}
+_LOCK = threading.Lock()
+
+
+def get_model(name: str = DEFAULT_MODEL_NAME) -> Any:
+    """
+    取得（必要時載入）指定名稱的 SentenceTransformer。
+    以 double-checked locking 確保多執行緒同時首次呼叫時只載入一次。
+    """
+    model = _MODELS.get(name)
+    if model is not None:
+        return model
+
+    with _LOCK:
+        model = _MODELS.get(name)
+        if model is None:
+            # 延遲匯入：只有真的要編碼時才載入 sentence_transformers / torch
+            from sentence_transformers import SentenceTransformer
+
+            t0 = time.perf_counter()
+            model = SentenceTransformer(name)
+            elapsed = time.perf_counter() - t0
+            _MODELS[name] = model
+            _LOAD_SECONDS[name] = elapsed
+            logger.info("embedding model %s loaded in %.2fs", name, elapsed)
+    return model
+
+
+def is_loaded(name: str = DEFAULT_MODEL_NAME) -> bool:
+    return name in _MODELS
+
+
+def load_seconds(name: str = DEFAULT_MODEL_NAME) -> Optional[float]:
+    """回傳模型載入耗時（秒）；尚未載入則為 None。"""
+    return _LOAD_SECONDS.get(name)
+
+
+def warmup(name: str = DEFAULT_MODEL_NAME, background: bool = True) -> Optional[threading.Thread]:
+    """
+    預先載入模型。
+    background=True 時在 daemon thread 載入，worker 可以立刻開始接請求；
+    若請求先到，get_model() 會在鎖上等待同一次載入完成。
+    """
+    if is_loaded(name):
+        return None
+
+    def _run() -> None:
+        try:
+            get_model(name)
+        except Exception:
+            logger.exception("embedding model warm-up failed: %s", name)
+
+    if not background:
+        _run()
+        return None
+
+    t = threading.Thread(target=_run, name=f"warmup:{name}", daemon=True)
+    t.start()
+    return t
+
+
+def model_stats() -> Dict[str, Dict[str, Any]]:
+    """各已載入模型的狀態（給除錯/監控用）。"""
+    return {
+        name: {"loaded": True, "load_seconds": round(_LOAD_SECONDS.get(name, 0.0), 4)}
+        for name in list(_MODELS.keys())
+    }
+
+
+__all__ = [
+    "DEFAULT_MODEL_NAME",
+    "get_model",
+    "is_loaded",
+    "load_seconds",
+    "warmup",
+    "model_stats",
+]
@@ -0,0 +1,483 @@
+# NCUACG/assistant/services/index_store.py
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 向量索引的磁碟格式（取代 notices.pkl）
+#
+#   <index_dir>/
+#     header.json              ← 版本、模型、維度、筆數、dtype、正規化旗標、內容雜湊
+#     vectors-<hash>.bin       ← row-major 的原始矩陣（float32 或 float16），以 np.memmap 開啟
+#     docs-<hash>.jsonl        ← 每行一筆 doc 的 metadata（與向量列一一對應）
+#     col-<name>-<hash>.bin    ← 選用的逐列欄位（例如 start_ts：int64 epoch 秒）
+#     att-<name>-<hash>.bin    ← 選用的整體附檔（例如 lexical：BM25 倒排索引）
+#     qvectors-<hash>.bin      ← 選用的量化副本（int8 或 float16），第一階段掃描用；
+#                                int8 的逐列縮放係數存在 qscale 欄位
+#
+# 資料檔名帶內容雜湊，header.json 最後以 os.replace 寫入當作「提交點」：
+# 讀者只要讀到 header，就一定能讀到同一代的資料檔；多個 worker 共用同一份 page cache。
+# 提交時保留上一代的資料檔（下一次提交才刪），剛讀到舊 header 的讀者不會撲空。
+# 本模組不依賴 Django，scripts/build_emb.py 也直接使用。
+INDEX_FORMAT = "ncuacg-vector-index"
+FORMAT_VERSION = 4          # v2：columns；v3：attachments；v4：量化副本（舊版索引仍可讀）
+HEADER_NAME = "header.json"
+SUPPORTED_DTYPES = ("float32", "float16")
+QUANT_MODES = ("int8", "float16")
+
+
+class IndexFormatError(ValueError):
+    """索引檔不存在、版本不支援或內容與 header 不符。"""
+
+
+@dataclass(frozen=True)
+class IndexHeader:
+    model: str
+    dim: int
+    count: int
+    dtype: str
+    normalized: bool
+    content_hash: str
+    vectors_file: str
+    docs_file: str
+    format: str = INDEX_FORMAT
+    version: int = FORMAT_VERSION
+    created_at: str = ""
+    columns: Dict[str, Dict[str, str]] = field(default_factory=dict)   # name -> {file, dtype}
+    attachments: Dict[str, str] = field(default_factory=dict)          # name -> file
+    quantization: str = ""       # "" / "int8" / "float16"
+    qvectors_file: str = ""
+    extra: Dict[str, Any] = field(default_factory=dict)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, raw: Dict[str, Any]) -> "IndexHeader":
+        if raw.get("format") != INDEX_FORMAT:
+            raise IndexFormatError(f"unknown index format: {raw.get('format')!r}")
+        version = int(raw.get("version", 0))
+        if version > FORMAT_VERSION:
+            raise IndexFormatError(f"index version {version} is newer than supported {FORMAT_VERSION}")
+        known = {f for f in cls.__dataclass_fields__}
+        return cls(**{k: v for k, v in raw.items() if k in known})
+
+
+@dataclass
+class VectorIndex:
+    path: Path
+    header: IndexHeader
+    vectors: np.ndarray          # np.memmap（唯讀）
+    docs: List[Dict[str, Any]]
+    columns: Dict[str, np.ndarray] = field(default_factory=dict)
+    attachments: Dict[str, Path] = field(default_factory=dict)    # 附檔路徑，由使用端自行載入
+    qvectors: Optional[np.ndarray] = None                         # 量化副本（np.memmap），沒有時為 None
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 寫入
+_HASH_BLOCK = 1 << 20
+
+
+def _hash_files(paths: Iterable[Path]) -> str:
+    """依序串接檔案內容計算 sha256（分塊讀取，記憶體用量固定）。"""
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(_HASH_BLOCK), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def quantize_rows(vecs: np.ndarray, mode: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    逐列量化：int8 為對稱量化（scale = max|v| / 127，v ≈ q * scale），回傳 (q, scale)；
+    float16 直接轉型，scale 為 None。
+    """
+    vecs = np.asarray(vecs, dtype=np.float32)
+    if mode == "float16":
+        return vecs.astype(np.float16), None
+    if mode != "int8":
+        raise IndexFormatError(f"unsupported quantization: {mode}")
+    scale = np.abs(vecs).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.clip(np.rint(vecs / scale[:, None]), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+def _atomic_write_bytes(path: Path, data: bytes) -> None:
+    tmp = path.with_name(f".{path.name}.tmp{os.getpid()}")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class IndexWriter:
+    """
+    以「邊產生邊寫入」的方式建立索引：append() 每批向量/doc/欄位直接寫到暫存檔，
+    記憶體只需容納一個批次；commit() 時計算內容雜湊、改名成正式檔名，最後寫 header。
+
+        with IndexWriter(out_dir, model=MODEL_NAME) as w:
+            for vecs, docs, cols in batches:
+                w.append(vecs, docs, columns=cols)
+            header = w.commit()
+    """
+
+    def __init__(
+        self,
+        index_dir: Path,
+        *,
+        model: str,
+        dtype: str = "float32",
+        normalized: bool = True,
+        extra: Optional[Dict[str, Any]] = None,
+        quantize: Optional[str] = None,
+    ):
+        if dtype not in SUPPORTED_DTYPES:
+            raise IndexFormatError(f"unsupported dtype: {dtype}")
+        if quantize and quantize not in QUANT_MODES:
+            raise IndexFormatError(f"unsupported quantization: {quantize}")
+        self.index_dir = Path(index_dir)
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        self.model = model
+        self.dtype = dtype
+        self.normalized = normalized
+        self.extra = dict(extra or {})
+        self.count = 0
+        self.dim: Optional[int] = None
+        self._tag = f".build-{os.getpid()}-{id(self):x}"
+        self._vec_f = open(self._tmp("vectors"), "wb")
+        self._doc_f = open(self._tmp("docs"), "wb")
+        self.quantize = quantize or ""
+        self._q_f = open(self._tmp("qvectors"), "wb") if self.quantize else None
+        self._col_f: Dict[str, Any] = {}
+        self._col_dtype: Dict[str, np.dtype] = {}
+        self._att: List[str] = []
+        self._done = False
+
+    def _tmp(self, part: str) -> Path:
+        return self.index_dir / f"{self._tag}.{part}"
+
+    def __enter__(self) -> "IndexWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if not self._done:
+            self.abort()
+
+    def append(
+        self,
+        vecs: np.ndarray,
+        docs: List[Dict[str, Any]],
+        columns: Optional[Dict[str, np.ndarray]] = None,
+    ) -> None:
+        vecs = np.asarray(vecs, dtype=np.float32)
+        if vecs.ndim != 2 or vecs.shape[0] != len(docs):
+            raise IndexFormatError(f"vecs shape {vecs.shape} does not match {len(docs)} docs")
+        if self.dim is None:
+            self.dim = int(vecs.shape[1])
+        elif vecs.shape[1] != self.dim:
+            raise IndexFormatError(f"dimension changed mid-build: {vecs.shape[1]} != {self.dim}")
+        cols = dict(columns or {})
+        if self.count and set(cols) != set(self._col_f):
+            raise IndexFormatError(f"columns changed mid-build: {sorted(cols)} != {sorted(self._col_f)}")
+
+        if self.normalized:
+            # 已是單位向量的列不再重除，確保重建（沿用舊向量）時位元完全一致
+            norms = np.linalg.norm(vecs, axis=1)
+            off = np.abs(norms - 1.0) > 1e-5
+            if off.any():
+                vecs = vecs.copy()
+                vecs[off] /= norms[off, None] + 1e-9
+        self._vec_f.write(np.ascontiguousarray(vecs.astype(self.dtype)).tobytes())
+        if self._q_f is not None:
+            qv, scale = quantize_rows(vecs, self.quantize)
+            self._q_f.write(np.ascontiguousarray(qv).tobytes())
+            if scale is not None:
+                cols["qscale"] = scale
+        for d in docs:
+            self._doc_f.write(json.dumps(d, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+        for name, arr in cols.items():
+            arr = np.ascontiguousarray(arr)
+            if arr.ndim != 1 or arr.shape[0] != len(docs):
+                raise IndexFormatError(f"column {name!r} shape {arr.shape} does not match {len(docs)} docs")
+            if name not in self._col_f:
+                self._col_f[name] = open(self._tmp(f"col-{name}"), "wb")
+                self._col_dtype[name] = arr.dtype
+            elif arr.dtype != self._col_dtype[name]:
+                raise IndexFormatError(f"column {name!r} dtype changed mid-build")
+            self._col_f[name].write(arr.tobytes())
+        self.count += len(docs)
+
+    def attach(self, name: str, data: bytes) -> None:
+        """加入一個與列數無關的附檔（同一代提交、一起計入內容雜湊）。"""
+        with self.attach_file(name) as f:
+            f.write(data)
+
+    @contextmanager
+    def attach_file(self, name: str) -> Iterator[BinaryIO]:
+        """同 attach()，但由呼叫端串流寫入（大附檔不必先組成一整個 bytes）。"""
+        if name in self._att:
+            raise IndexFormatError(f"attachment {name!r} already added")
+        with open(self._tmp(f"att-{name}"), "wb") as f:
+            yield f
+        self._att.append(name)
+
+    def _files(self) -> List[Any]:
+        return [self._vec_f, self._doc_f, *self._col_f.values(), *([self._q_f] if self._q_f else [])]
+
+    def _close_files(self) -> None:
+        for f in self._files():
+            if not f.closed:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+
+    def commit(self) -> IndexHeader:
+        if self.dim is None:
+            raise IndexFormatError("cannot commit an empty index")
+        self._close_files()
+        col_names = sorted(self._col_f)
+        att_names = sorted(self._att)
+        digest = _hash_files(
+            [self._tmp("vectors"), self._tmp("docs")]
+            + [self._tmp(f"col-{n}") for n in col_names]
+            + [self._tmp(f"att-{n}") for n in att_names]
+            + ([self._tmp("qvectors")] if self.quantize else [])
+        )
+        header = IndexHeader(
+            model=self.model,
+            dim=self.dim,
+            count=self.count,
+            dtype=self.dtype,
+            normalized=self.normalized,
+            content_hash=digest,
+            vectors_file=f"vectors-{digest[:12]}.bin",
+            docs_file=f"docs-{digest[:12]}.jsonl",
+            created_at=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            columns={
+                n: {"file": f"col-{n}-{digest[:12]}.bin", "dtype": self._col_dtype[n].str}
+                for n in col_names
+            },
+            attachments={n: f"att-{n}-{digest[:12]}.bin" for n in att_names},
+            quantization=self.quantize,
+            qvectors_file=f"qvectors-{digest[:12]}.bin" if self.quantize else "",
+            extra=self.extra,
+        )
+        # 先把資料檔改成正式檔名，最後才換 header（提交點）
+        os.replace(self._tmp("vectors"), self.index_dir / header.vectors_file)
+        os.replace(self._tmp("docs"), self.index_dir / header.docs_file)
+        for n in col_names:
+            os.replace(self._tmp(f"col-{n}"), self.index_dir / header.columns[n]["file"])
+        for n in att_names:
+            os.replace(self._tmp(f"att-{n}"), self.index_dir / header.attachments[n])
+        if self.quantize:
+            os.replace(self._tmp("qvectors"), self.index_dir / header.qvectors_file)
+        # 換 header 前記下目前這一代：剛讀到舊 header、還沒開檔的讀者仍要讀得到它的資料檔
+        try:
+            previous = _generation_files(read_header(self.index_dir))
+        except IndexFormatError:
+            previous = set()
+        _atomic_write_bytes(
+            self.index_dir / HEADER_NAME,
+            json.dumps(header.to_dict(), ensure_ascii=False, indent=2).encode("utf-8"),
+        )
+        self._done = True
+        _cleanup_stale(self.index_dir, keep=_generation_files(header) | previous)
+        return header
+
+    def abort(self) -> None:
+        for f in self._files():
+            f.close()
+        for p in self.index_dir.glob(f"{self._tag}.*"):
+            try:
+                p.unlink()
+            except OSError:
+                pass
+        self._done = True
+
+
+def write_index(
+    index_dir: Path,
+    vecs: np.ndarray,
+    docs: List[Dict[str, Any]],
+    *,
+    model: str,
+    dtype: str = "float32",
+    normalized: bool = True,
+    columns: Optional[Dict[str, np.ndarray]] = None,
+    extra: Optional[Dict[str, Any]] = None,
+    quantize: Optional[str] = None,
+) -> IndexHeader:
+    """
+    將 (vecs, docs) 一次寫成索引目錄。若 normalized=True，會先做 L2 正規化，
+    讓 retriever 直接用內積當 cosine，不必在每個 worker 再複製一份。
+    columns：與 docs 等長的一維欄位（例如 start_ts），各自存成一個原始檔。
+    quantize：另存 int8 / float16 量化副本供第一階段掃描。
+    """
+    with IndexWriter(
+        index_dir, model=model, dtype=dtype, normalized=normalized, extra=extra, quantize=quantize,
+    ) as w:
+        w.append(vecs, docs, columns=columns)
+        return w.commit()
+
+
+def _generation_files(header: IndexHeader) -> set:
+    """某一代 header 引用的全部資料檔名。"""
+    files = {header.vectors_file, header.docs_file} | {c["file"] for c in header.columns.values()}
+    files |= set(header.attachments.values())
+    if header.qvectors_file:
+        files.add(header.qvectors_file)
+    return files
+
+
+def _cleanup_stale(index_dir: Path, keep: set) -> None:
+    """
+    刪掉比上一代更舊的資料檔（keep = 新一代 + 上一代）。上一代保留到下一次提交才刪，
+    讀者在兩次建置之間的任何時候讀 header 再開檔都不會撲空；
+    仍被 mmap 的檔案在 Windows 上刪不掉，略過即可。
+    """
+    for p in index_dir.iterdir():
+        if p.name in keep or p.name == HEADER_NAME:
+            continue
+        if p.name.startswith(("vectors-", "docs-", "col-", "att-", "qvectors-")):
+            try:
+                p.unlink()
+            except OSError:
+                pass
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 讀取
+def exists(index_dir: Path) -> bool:
+    return (Path(index_dir) / HEADER_NAME).is_file()
+
+
+def read_header(index_dir: Path) -> IndexHeader:
+    path = Path(index_dir) / HEADER_NAME
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    except FileNotFoundError:
+        raise IndexFormatError(f"index header not found: {path}")
+    except json.JSONDecodeError as e:
+        raise IndexFormatError(f"broken index header {path}: {e}")
+    return IndexHeader.from_dict(raw)
+
+
+def _read_docs(path: Path) -> List[Dict[str, Any]]:
+    docs: List[Dict[str, Any]] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                docs.append(json.loads(line))
+    return docs
+
+
+def open_index(index_dir: Path) -> VectorIndex:
+    """以唯讀 memmap 開啟向量矩陣，並載入 docs sidecar。"""
+    index_dir = Path(index_dir)
+    header = read_header(index_dir)
+    if header.dtype not in SUPPORTED_DTYPES:
+        raise IndexFormatError(f"unsupported dtype in header: {header.dtype}")
+
+    vec_path = index_dir / header.vectors_file
+    expected = header.count * header.dim * np.dtype(header.dtype).itemsize
+    if not vec_path.is_file() or vec_path.stat().st_size != expected:
+        raise IndexFormatError(f"vector file missing or truncated: {vec_path}")
+
+    if header.count:
+        vectors = np.memmap(vec_path, dtype=header.dtype, mode="r", shape=(header.count, header.dim))
+    else:
+        vectors = np.zeros((0, header.dim), dtype=header.dtype)
+    docs = _read_docs(index_dir / header.docs_file)
+    if len(docs) != header.count:
+        raise IndexFormatError(f"docs sidecar has {len(docs)} rows, header says {header.count}")
+    columns = {name: _open_column(index_dir, header, name) for name in header.columns}
+    attachments = {}
+    for name, fname in header.attachments.items():
+        path = index_dir / fname
+        if not path.is_file():
+            raise IndexFormatError(f"attachment file missing: {path}")
+        attachments[name] = path
+    qvectors = _open_qvectors(index_dir, header) if header.quantization else None
+    return VectorIndex(
+        path=index_dir, header=header, vectors=vectors, docs=docs, columns=columns,
+        attachments=attachments, qvectors=qvectors,
+    )
+
+
+def _open_qvectors(index_dir: Path, header: IndexHeader) -> np.ndarray:
+    if header.quantization not in QUANT_MODES:
+        raise IndexFormatError(f"unsupported quantization in header: {header.quantization}")
+    if header.quantization == "int8" and "qscale" not in header.columns:
+        raise IndexFormatError("int8 index is missing the qscale column")
+    dtype = np.dtype(header.quantization)
+    path = index_dir / header.qvectors_file
+    if not path.is_file() or path.stat().st_size != header.count * header.dim * dtype.itemsize:
+        raise IndexFormatError(f"quantized vector file missing or truncated: {path}")
+    if not header.count:
+        return np.zeros((0, header.dim), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(header.count, header.dim))
+
+
+def _open_column(index_dir: Path, header: IndexHeader, name: str) -> np.ndarray:
+    spec = header.columns[name]
+    dtype = np.dtype(spec["dtype"])
+    path = index_dir / spec["file"]
+    if not path.is_file() or path.stat().st_size != header.count * dtype.itemsize:
+        raise IndexFormatError(f"column file missing or truncated: {path}")
+    if not header.count:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(header.count,))
+
+
+def verify_index(index_dir: Path) -> bool:
+    """重新計算內容雜湊並與 header 比對（部署檢查用，會讀完整檔案）。"""
+    index_dir = Path(index_dir)
+    header = read_header(index_dir)
+    paths = [index_dir / header.vectors_file, index_dir / header.docs_file]
+    paths += [index_dir / header.columns[n]["file"] for n in sorted(header.columns)]
+    paths += [index_dir / header.attachments[n] for n in sorted(header.attachments)]
+    if header.quantization:
+        paths.append(index_dir / header.qvectors_file)
+    return _hash_files(paths) == header.content_hash
+
+
+def load_legacy_pickle(path: Path) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+    """讀取舊版 notices.pkl（(vecs, docs)）。只在尚未建立新索引時當後援。"""
+    import pickle
+
+    with open(path, "rb") as f:
+        vecs, docs = pickle.load(f)
+    return np.asarray(vecs, dtype=np.float32), list(docs)
+
+
+__all__ = [
+    "INDEX_FORMAT",
+    "FORMAT_VERSION",
+    "IndexFormatError",
+    "IndexHeader",
+    "VectorIndex",
+    "QUANT_MODES",
+    "quantize_rows",
+    "IndexWriter",
+    "write_index",
+    "exists",
+    "read_header",
+    "open_index",
+    "verify_index",
+    "load_legacy_pickle",
+]
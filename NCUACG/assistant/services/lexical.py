@@ -0,0 +1,292 @@
+# NCUACG/assistant/services/lexical.py
+from __future__ import annotations
+
+import io
+import re
+import unicodedata
+from array import array
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .topn import topn
+
+# ──────────────────────────────────────────────────────────────────────────────
+# BM25 倒排索引（中文用字元 bigram）
+# 日期（8/30）、教室編號、專有名詞這類查詢，E5 相似度常抓不準；
+# 與向量分數以 Reciprocal Rank Fusion 合併。
+#
+# Posting list 以陣列儲存（CSR）：
+#   offsets[t]:offsets[t+1]  → 詞 t 的區段
+#   doc_ids[...] / tfs[...]  → 出現的列號與詞頻
+# 查詢只需切片 + bincount，不建立 Python dict/list。
+_CJK = r"㐀-䶿一-鿿豈-﫿぀-ヿ가-힯"
+_TOKEN_RE = re.compile(rf"[{_CJK}]+|[a-z0-9]+(?:[/.\-:][a-z0-9]+)*")
+_CJK_RE = re.compile(rf"[{_CJK}]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    - 中日韓連續字串 → 字元 bigram（單一字元時保留 unigram）
+    - 英數 → 整個詞，保留 8/30、e1-101、18:00 這種帶分隔符號的寫法
+    """
+    t = unicodedata.normalize("NFKC", text or "").lower()
+    out: List[str] = []
+    for m in _TOKEN_RE.finditer(t):
+        run = m.group(0)
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                out.append(run)
+            else:
+                out.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            out.append(run)
+    return out
+
+
+class BM25Index:
+    def __init__(
+        self,
+        vocab: Dict[str, int],
+        offsets: np.ndarray,
+        doc_ids: np.ndarray,
+        tfs: np.ndarray,
+        doc_len: np.ndarray,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.k1 = float(k1)
+        self.b = float(b)
+        self.n_docs = int(doc_len.shape[0])
+        avgdl = float(doc_len.mean()) if self.n_docs else 1.0
+        df = np.diff(offsets).astype(np.float32)
+        self.idf = np.log1p((self.n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        # 預先算好每列的長度正規化項，查詢時只剩一次除法
+        self._norm = (self.k1 * (1.0 - self.b + self.b * doc_len / max(avgdl, 1e-9))).astype(np.float32)
+
+    def __len__(self) -> int:
+        return self.n_docs
+
+    def _postings(self, term: str) -> Optional[Tuple[int, np.ndarray, np.ndarray]]:
+        tid = self.vocab.get(term)
+        if tid is None:
+            return None
+        a, b = int(self.offsets[tid]), int(self.offsets[tid + 1])
+        return tid, self.doc_ids[a:b], self.tfs[a:b]
+
+    def scores(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        """回傳 (命中的列號, BM25 分數)，未排序。"""
+        ids_parts, score_parts = [], []
+        for term, qtf in _count(tokenize(query)).items():
+            hit = self._postings(term)
+            if hit is None:
+                continue
+            tid, ids, tf = hit
+            tf = tf.astype(np.float32)
+            contrib = self.idf[tid] * tf * (self.k1 + 1.0) / (tf + self._norm[ids]) * qtf
+            ids_parts.append(ids)
+            score_parts.append(contrib)
+        if not ids_parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        ids = np.concatenate(ids_parts)
+        contrib = np.concatenate(score_parts)
+        uniq, inv = np.unique(ids, return_inverse=True)
+        return uniq.astype(np.int64), np.bincount(inv, weights=contrib).astype(np.float32)
+
+    def search(self, query: str, n: int, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """BM25 前 n 名；rows 給定時只保留這些列（例如時間視窗內）。"""
+        ids, sc = self.scores(query)
+        if rows is not None and ids.size:
+            keep = np.isin(ids, rows, assume_unique=True)
+            ids, sc = ids[keep], sc[keep]
+        local, top = topn(sc, n)
+        return ids[local], top
+
+    # ---- 序列化（npz，不使用 pickle） ----
+    def save(self, f: BinaryIO) -> None:
+        """寫成 npz；posting 陣列是 memmap 時分塊寫出，不會整份讀進記憶體。"""
+        terms = np.array(sorted(self.vocab, key=self.vocab.__getitem__), dtype=str)
+        np.savez(
+            f,
+            terms=terms,
+            offsets=self.offsets,
+            doc_ids=self.doc_ids,
+            tfs=self.tfs,
+            doc_len=self.doc_len,
+            params=np.array([self.k1, self.b], dtype=np.float64),
+        )
+
+    def to_bytes(self) -> bytes:
+        buf = io.BytesIO()
+        self.save(buf)
+        return buf.getvalue()
+
+    @classmethod
+    def load(cls, path) -> "BM25Index":
+        with np.load(path, allow_pickle=False) as z:
+            terms = z["terms"].tolist()
+            k1, b = z["params"].tolist()
+            return cls(
+                vocab={t: i for i, t in enumerate(terms)},
+                offsets=z["offsets"],
+                doc_ids=z["doc_ids"],
+                tfs=z["tfs"],
+                doc_len=z["doc_len"],
+                k1=k1,
+                b=b,
+            )
+
+
+class BM25Builder:
+    """
+    可分批加入文件（配合 build_emb 的串流管線），最後排成 CSR。
+
+    spill_dir 給定時，每批的 (詞, 列, 詞頻) 直接附加到暫存檔，記憶體只留詞表、每個詞的
+    出現次數與每列長度（4 bytes）；build() 依詞頻計數算好 offsets 後逐塊把 posting
+    放進 memmap（列號遞增加入，同一個詞的 posting 自然有序，不需要整份 lexsort）。
+    未給定時全部留在記憶體（小語料、測試）。
+    """
+
+    _SPILL_CHUNK = 1 << 20     # build() 每次讀回的 posting 數
+
+    def __init__(self, spill_dir: Optional[Path] = None):
+        self.vocab: Dict[str, int] = {}
+        self._lens = array("I")
+        self._df = np.zeros(0, dtype=np.int64)      # 每個詞的 posting 數（= 文件頻率）
+        self._spill_dir = Path(spill_dir) if spill_dir is not None else None
+        if self._spill_dir is not None:
+            self._spill = {
+                name: open(self._spill_dir / f"bm25-{name}.bin", "wb") for name in ("terms", "docs", "tfs")
+            }
+        else:
+            self._terms: List[np.ndarray] = []
+            self._docs: List[np.ndarray] = []
+            self._tfs: List[np.ndarray] = []
+
+    def add(self, texts: Iterable[str]) -> None:
+        for text in texts:
+            row = len(self._lens)
+            counts = _count(tokenize(text))
+            self._lens.append(sum(counts.values()))
+            if not counts:
+                continue
+            tids = np.asarray([self.vocab.setdefault(t, len(self.vocab)) for t in counts], dtype=np.int32)
+            docs = np.full(len(tids), row, dtype=np.int32)
+            tfs = np.asarray(list(counts.values()), dtype=np.uint16)
+            if self._df.shape[0] < len(self.vocab):
+                grow = max(len(self.vocab), 2 * self._df.shape[0])
+                self._df = np.concatenate([self._df, np.zeros(grow - self._df.shape[0], dtype=np.int64)])
+            self._df[tids] += 1
+            if self._spill_dir is not None:
+                self._spill["terms"].write(tids.tobytes())
+                self._spill["docs"].write(docs.tobytes())
+                self._spill["tfs"].write(tfs.tobytes())
+            else:
+                self._terms.append(tids)
+                self._docs.append(docs)
+                self._tfs.append(tfs)
+
+    def _csr_in_memory(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._terms:
+            terms = np.concatenate(self._terms)
+            docs = np.concatenate(self._docs)
+            tfs = np.concatenate(self._tfs)
+        else:
+            terms = np.empty(0, dtype=np.int32)
+            docs = np.empty(0, dtype=np.int32)
+            tfs = np.empty(0, dtype=np.uint16)
+        order = np.lexsort((docs, terms))
+        return docs[order], tfs[order]
+
+    def _csr_spilled(self, offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        for f in self._spill.values():
+            f.close()
+        total = int(offsets[-1])
+        if not total:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.uint16)
+        d = self._spill_dir
+        terms = np.memmap(d / "bm25-terms.bin", dtype=np.int32, mode="r")
+        docs = np.memmap(d / "bm25-docs.bin", dtype=np.int32, mode="r")
+        tfs = np.memmap(d / "bm25-tfs.bin", dtype=np.uint16, mode="r")
+        out_docs = np.memmap(d / "bm25-csr-docs.bin", dtype=np.int32, mode="w+", shape=(total,))
+        out_tfs = np.memmap(d / "bm25-csr-tfs.bin", dtype=np.uint16, mode="w+", shape=(total,))
+        pos = offsets[:-1].copy()           # 每個詞下一個 posting 的位置
+        for s in range(0, total, self._SPILL_CHUNK):
+            t = np.asarray(terms[s:s + self._SPILL_CHUNK])
+            order = np.argsort(t, kind="stable")   # 同一個詞內維持列號順序
+            ts = t[order]
+            uniq, first, cnt = np.unique(ts, return_index=True, return_counts=True)
+            dest = pos[ts] + (np.arange(ts.shape[0]) - np.repeat(first, cnt))
+            out_docs[dest] = np.asarray(docs[s:s + self._SPILL_CHUNK])[order]
+            out_tfs[dest] = np.asarray(tfs[s:s + self._SPILL_CHUNK])[order]
+            pos[uniq] += cnt
+        out_docs.flush()
+        out_tfs.flush()
+        return out_docs, out_tfs
+
+    def build(self, k1: float = 1.2, b: float = 0.75) -> BM25Index:
+        df = self._df[:len(self.vocab)]
+        offsets = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+        if self._spill_dir is not None:
+            doc_ids, tfs = self._csr_spilled(offsets)
+        else:
+            doc_ids, tfs = self._csr_in_memory()
+        return BM25Index(
+            vocab=dict(self.vocab),
+            offsets=offsets,
+            doc_ids=doc_ids,
+            tfs=tfs,
+            doc_len=np.asarray(self._lens, dtype=np.float32),
+            k1=k1,
+            b=b,
+        )
+
+
+def build_bm25(texts: Sequence[str]) -> BM25Index:
+    builder = BM25Builder()
+    builder.add(texts)
+    return builder.build()
+
+
+def doc_text(doc: Dict) -> str:
+    """建索引用的文字：標題 + 內容（與 retriever 顯示的一致）。"""
+    return f"{doc.get('title', '') or ''} {doc.get('content', '') or ''}".strip()
+
+
+def rrf_fuse(rankings: Sequence[np.ndarray], k0: float = 60.0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reciprocal Rank Fusion：score(d) = Σ 1 / (k0 + rank)，rank 從 1 開始。
+    每個 ranking 是依分數由高到低的列號陣列；回傳 (列號, 融合分數)，由高到低。
+    """
+    parts = [r for r in rankings if len(r)]
+    if not parts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    ids = np.concatenate(parts).astype(np.int64)
+    contrib = np.concatenate([1.0 / (k0 + np.arange(1, len(r) + 1)) for r in parts])
+    uniq, inv = np.unique(ids, return_inverse=True)
+    fused = np.bincount(inv, weights=contrib)
+    order = np.argsort(-fused, kind="stable")
+    return uniq[order], fused[order].astype(np.float32)
+
+
+def _count(tokens: Iterable[str]) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    for t in tokens:
+        out[t] = out.get(t, 0) + 1
+    return out
+
+
+__all__ = [
+    "tokenize",
+    "doc_text",
+    "BM25Index",
+    "BM25Builder",
+    "build_bm25",
+    "rrf_fuse",
+]
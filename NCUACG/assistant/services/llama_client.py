@@ -1,17 +1,181 @@
 # NCUACG/assistant/services/llama_client.py
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import logging
 import os
-from typing import Dict, Optional, List
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, Optional, List, Tuple
 
-from groq import Groq
-from .retriever import retrieve_context
-from .personas import get_system_prompt, resolve_persona_id  # ✅ 單一來源 + 密語解析
+import httpx
+import numpy as np
+from asgiref.sync import sync_to_async
+from groq import AsyncGroq, Groq
+
+from .chunking import estimate_tokens
+from .conf import as_bool, setting
+from .query_cache import normalize_query
+from .retriever import SearchResult, index_generation, search
+from .personas import get_context_tokens, get_system_prompt, personas_version, resolve_persona_id  # ✅ 單一來源 + 密語解析
+from .response_cache import ResponseCache
+from .semantic_cache import SemanticCache, context_key
+from .singleflight import SharedLock, SingleFlight
+
+logger = logging.getLogger(__name__)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Model / Client
 MODEL = os.getenv("LLAMA_MODEL", "llama-3.1-70b-specdec")
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+TEMPERATURE = 0.2
+
+# RAG 脈絡的預設 token 預算（personas.json 的 context_tokens 可逐一覆寫；<= 0 = 不限）
+_CONTEXT_TOKENS = setting("ASSISTANT_CONTEXT_TOKENS", 1200, int)
+_MESSAGE_OVERHEAD_TOKENS = 4     # chat 格式每則訊息的角色/分隔 token（估計）
+
+# 連線池：keep-alive 重用 TLS 連線，省下每次呼叫的握手；上限決定單一行程可同時進行的 LLM 呼叫數
+_BASE_URL = setting("GROQ_BASE_URL", None) or None      # 指向本機 stub（scripts/groq_stub.py）時使用
+_TIMEOUT = setting("LLAMA_HTTP_TIMEOUT", 60.0, float)
+_LIMITS = httpx.Limits(
+    max_connections=setting("LLAMA_HTTP_MAX_CONNECTIONS", 200, int),
+    max_keepalive_connections=setting("LLAMA_HTTP_MAX_KEEPALIVE", 50, int),
+    keepalive_expiry=setting("LLAMA_HTTP_KEEPALIVE_EXPIRY", 30.0, float),
+)
+
+client = Groq(
+    api_key=os.getenv("GROQ_API_KEY"),
+    base_url=_BASE_URL,
+    http_client=httpx.Client(limits=_LIMITS, timeout=_TIMEOUT),
+)
+
+# 非同步 client：httpx.AsyncClient 的連線池綁在建立它的事件迴圈上，換一個迴圈就不能再用。
+# - ASGI（NCUACG/asgi.py 設定 ASSISTANT_ASGI=1）：整個行程只有一個長駐迴圈，每個迴圈快取一個 client
+# - WSGI 下的 async view：asgiref 每個請求各開一個迴圈、用完即關，client 在請求內建立並關閉
+_ASGI = setting("ASSISTANT_ASGI", False, as_bool)
+_ASYNC_CLIENTS: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncGroq] = weakref.WeakKeyDictionary()
+_ASYNC_LOCK = threading.Lock()
+
+def _new_async_client() -> AsyncGroq:
+    return AsyncGroq(
+        api_key=os.getenv("GROQ_API_KEY"),
+        base_url=_BASE_URL,
+        http_client=httpx.AsyncClient(limits=_LIMITS, timeout=_TIMEOUT),
+    )
+
+def get_async_client() -> AsyncGroq:
+    """目前事件迴圈專用的 client（須在協程內呼叫）；迴圈被回收時對應的 client 一併釋放。"""
+    loop = asyncio.get_running_loop()
+    with _ASYNC_LOCK:
+        found = _ASYNC_CLIENTS.get(loop)
+        if found is None:
+            found = _ASYNC_CLIENTS[loop] = _new_async_client()
+    return found
+
+@asynccontextmanager
+async def _async_client() -> AsyncIterator[AsyncGroq]:
+    if _ASGI:
+        yield get_async_client()
+        return
+    owned = _new_async_client()
+    try:
+        yield owned
+    finally:
+        await owned.close()
+
+def _cache_namespace() -> str:
+    """索引內容雜湊 + personas.json 版本；任一改變，舊的快取回覆就不再命中。"""
+    return f"{index_generation()[1]}|{personas_version()}"
+
+# 完全相同請求的回覆快取（ASSISTANT_RESPONSE_CACHE_TTL = 0 代表停用）
+_RESPONSE_CACHE = ResponseCache(
+    alias=setting("ASSISTANT_RESPONSE_CACHE_ALIAS", "assistant"),
+    ttl=setting("ASSISTANT_RESPONSE_CACHE_TTL", 600, float),
+    namespace=_cache_namespace,
+)
+
+# 語意快取：換句話問同一件事、且 persona + 站內脈絡完全相同時沿用回覆（容量 0 代表停用）
+_SEMANTIC_CACHE = SemanticCache(
+    capacity=setting("ASSISTANT_SEMANTIC_CACHE_SIZE", 1024, int),
+    threshold=setting("ASSISTANT_SEMANTIC_CACHE_THRESHOLD", 0.95, float),
+    ttl=setting("ASSISTANT_SEMANTIC_CACHE_TTL", 600, float),
+)
+
+# Single-flight：同一句話的併發請求只做一次檢索 + LLM 呼叫（行程內）；
+# ASSISTANT_SINGLEFLIGHT_SHARED=1 時再以回覆快取的共用後端當鎖，跨 worker 只讓一個呼叫 Groq
+_FLIGHT = SingleFlight(enabled=setting("ASSISTANT_SINGLEFLIGHT", True, as_bool))
+_SHARED_FLIGHT = SharedLock(
+    alias=_RESPONSE_CACHE.alias if setting("ASSISTANT_SINGLEFLIGHT_SHARED", False, as_bool) and _RESPONSE_CACHE.enabled else None,
+    lock_ttl=setting("ASSISTANT_SINGLEFLIGHT_LOCK_TTL", _TIMEOUT, float),
+    wait=setting("ASSISTANT_SINGLEFLIGHT_WAIT", _TIMEOUT, float),
+)
+
+def flight_stats() -> Dict[str, Any]:
+    return {"local": _FLIGHT.stats(), "shared": _SHARED_FLIGHT.stats()}
+
+def _flight_key(prompt: str, persona_slug: Optional[str]) -> str:
+    return hashlib.sha1(f"{persona_slug or ''}\n{normalize_query(prompt)}".encode("utf-8")).hexdigest()
+
+def _with_shared_lock(key: str, call: Callable[[], str]) -> str:
+    """
+    跨 worker 只讓持鎖者呼叫 LLM（call 內會把回覆寫進共用回覆快取）；
+    其他 worker 輪詢快取，鎖釋放或逾時仍沒有結果才自己呼叫。
+    """
+    if not _SHARED_FLIGHT.enabled:
+        return call()
+    token = _SHARED_FLIGHT.acquire(key)
+    if token is None:
+        reply = _SHARED_FLIGHT.wait(key, lambda: _RESPONSE_CACHE.peek(key))
+        return reply if reply is not None else call()
+    try:
+        return call()
+    finally:
+        _SHARED_FLIGHT.release(key, token)
+
+async def _awith_shared_lock(key: str, call: Callable[[], Awaitable[str]]) -> str:
+    if not _SHARED_FLIGHT.enabled:
+        return await call()
+    token = await _SHARED_FLIGHT.aacquire(key)
+    if token is None:
+        reply = await _SHARED_FLIGHT.await_result(key, lambda: _RESPONSE_CACHE.apeek(key))
+        return reply if reply is not None else await call()
+    try:
+        return await call()
+    finally:
+        await _SHARED_FLIGHT.arelease(key, token)
+
+def response_cache_stats() -> Dict[str, Any]:
+    return _RESPONSE_CACHE.stats()
+
+def semantic_cache_stats() -> Dict[str, Any]:
+    return _SEMANTIC_CACHE.stats()
+
+def _cache_key(msgs: List[Dict[str, str]]) -> str:
+    return _RESPONSE_CACHE.key(MODEL, msgs[0]["content"], msgs[1]["content"], TEMPERATURE)
+
+def _prepare(
+    prompt: str, context: Optional[str], persona_slug: Optional[str],
+) -> Tuple[List[Dict[str, str]], str]:
+    msgs = _build_messages(prompt, context, persona_slug)
+    return msgs, _cache_key(msgs)
+
+def _semantic_lookup(msgs: List[Dict[str, str]], query_vec: Optional[np.ndarray]) -> Tuple[int, Optional[str]]:
+    """(脈絡 key, 語意快取命中的回覆或 None)；沒有查詢向量（非 RAG 呼叫）時不查。"""
+    ctx = context_key(MODEL, TEMPERATURE, msgs[0]["content"])
+    if query_vec is None:
+        return ctx, None
+    hit = _SEMANTIC_CACHE.lookup(query_vec, ctx, query=msgs[1]["content"])
+    return ctx, (hit[0] if hit else None)
+
+def _semantic_add(
+    ctx: int, msgs: List[Dict[str, str]], query_vec: Optional[np.ndarray], reply: str, t0: float,
+) -> None:
+    if query_vec is not None:
+        _SEMANTIC_CACHE.add(
+            query_vec, ctx, reply, latency_ms=(time.perf_counter() - t0) * 1000.0, query=msgs[1]["content"],
+        )
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Chat 組裝
@@ -34,26 +198,62 @@ def _build_messages(
         {"role": "user", "content": user_prompt},
     ]
 
+def rag_search(prompt: str, persona_slug: Optional[str] = None) -> Tuple[SearchResult, str]:
+    """
+    檢索 + 依 persona 的 token 預算組脈絡；回傳 (檢索結果, 脈絡字串)。
+    本次 prompt 的 token 估計記在 result.usage（context_tokens / prompt_tokens_est 等）。
+    """
+    result = search(prompt)
+    persona_id = resolve_persona_id(preferred_id=persona_slug, user_text=prompt)
+    plan = result.context_plan(get_context_tokens(persona_id) or _CONTEXT_TOKENS)
+    msgs = _build_messages(prompt, plan.text, persona_slug)
+    prompt_tokens = sum(estimate_tokens(m["content"]) + _MESSAGE_OVERHEAD_TOKENS for m in msgs)
+    result.usage = {**plan.stats(), "prompt_tokens_est": prompt_tokens}
+    logger.info(
+        "assistant prompt ~%d tokens (persona=%s context=%d/%s chunks=%d truncated=%d redundant=%d over_budget=%d)",
+        prompt_tokens, persona_id, plan.tokens, plan.budget, len(plan.rows),
+        len(plan.truncated), len(plan.redundant), len(plan.over_budget),
+    )
+    return result, plan.text
+
 # ──────────────────────────────────────────────────────────────────────────────
 # 對外函式
 def ask_llama(
     prompt: str,
     context: Optional[str] = None,
     persona_slug: Optional[str] = None,
+    query_vec: Optional[np.ndarray] = None,
 ) -> str:
     """
     直接呼叫 LLM。
     :param prompt: 使用者輸入
     :param context: （可選）站內檢索脈絡文字
     :param persona_slug: （可選）persona 代號；例如 "starter_guide"
+    :param query_vec: （可選）檢索時算好的查詢向量；有給才查語意快取
     """
     msgs = _build_messages(prompt, context, persona_slug)
-    resp = client.chat.completions.create(
-        model=MODEL,
-        messages=msgs,
-        temperature=0.2,
-    )
-    return (resp.choices[0].message.content or "").strip()
+    key = _cache_key(msgs)
+    cached = _RESPONSE_CACHE.get(key)
+    if cached is not None:
+        return cached
+    ctx, cached = _semantic_lookup(msgs, query_vec)
+    if cached is not None:
+        return cached
+    t0 = time.perf_counter()
+
+    def call() -> str:
+        resp = client.chat.completions.create(
+            model=MODEL,
+            messages=msgs,
+            temperature=TEMPERATURE,
+        )
+        reply = (resp.choices[0].message.content or "").strip()
+        _RESPONSE_CACHE.put(key, reply)
+        return reply
+
+    reply = _with_shared_lock(key, call)
+    _semantic_add(ctx, msgs, query_vec, reply, t0)
+    return reply
 
 def ask_llama_rag(
     prompt: str,
@@ -63,5 +263,134 @@ def ask_llama_rag(
     先用 retriever 擷取站內內容，組 RAG 後再詢問模型。
     :param persona_slug: （可選）persona 代號
     """
-    ctx = retrieve_context(prompt)
-    return ask_llama(prompt, ctx, persona_slug)
+    reply, _ = ask_llama_rag_with_sources(prompt, persona_slug)
+    return reply
+
+def ask_llama_rag_with_sources(
+    prompt: str,
+    persona_slug: Optional[str] = None,
+) -> Tuple[str, SearchResult]:
+    """
+    與 ask_llama_rag 相同，但一併回傳檢索結果（脈絡與引用來源出自同一次檢索）。
+    同一句話（正規化後）+ 同 persona 的併發請求共用同一次檢索與 LLM 呼叫。
+    """
+    def run() -> Tuple[str, SearchResult]:
+        result, context = rag_search(prompt, persona_slug)
+        return ask_llama(prompt, context, persona_slug, result.query_vector), result
+
+    return _FLIGHT.do(_flight_key(prompt, persona_slug), run)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 非同步版本（ASGI）：等待 LLM 時不佔用 worker 執行緒
+async def aask_llama(
+    prompt: str,
+    context: Optional[str] = None,
+    persona_slug: Optional[str] = None,
+    query_vec: Optional[np.ndarray] = None,
+) -> str:
+    # 組 prompt（讀人設）與算 key（可能觸發索引熱重載檢查）都是同步 I/O，一起丟到執行緒池
+    msgs, key = await sync_to_async(_prepare, thread_sensitive=False)(prompt, context, persona_slug)
+    cached = await _RESPONSE_CACHE.aget(key)
+    if cached is not None:
+        return cached
+    ctx, cached = _semantic_lookup(msgs, query_vec)   # 只是小矩陣掃描，直接在事件迴圈上做
+    if cached is not None:
+        return cached
+    t0 = time.perf_counter()
+
+    async def call() -> str:
+        async with _async_client() as aclient:
+            resp = await aclient.chat.completions.create(
+                model=MODEL,
+                messages=msgs,
+                temperature=TEMPERATURE,
+            )
+        reply = (resp.choices[0].message.content or "").strip()
+        await _RESPONSE_CACHE.aput(key, reply)
+        return reply
+
+    reply = await _awith_shared_lock(key, call)
+    _semantic_add(ctx, msgs, query_vec, reply, t0)
+    return reply
+
+async def aask_llama_rag_with_sources(
+    prompt: str,
+    persona_slug: Optional[str] = None,
+) -> Tuple[str, SearchResult]:
+    async def run() -> Tuple[str, SearchResult]:
+        # 檢索是 CPU 工作（encode + 內積），丟到執行緒池，不阻塞事件迴圈
+        result, context = await sync_to_async(rag_search, thread_sensitive=False)(prompt, persona_slug)
+        return await aask_llama(prompt, context, persona_slug, result.query_vector), result
+
+    return await _FLIGHT.ado(_flight_key(prompt, persona_slug), run)
+
+async def aask_llama_rag(
+    prompt: str,
+    persona_slug: Optional[str] = None,
+) -> str:
+    reply, _ = await aask_llama_rag_with_sources(prompt, persona_slug)
+    return reply
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 串流（SSE 用）
+def _usage_dict(chunk: Any) -> Optional[Dict[str, Any]]:
+    """Groq 把 token 用量放在最後一個 chunk 的 x_groq.usage（OpenAI 相容欄位為 usage）。"""
+    usage = getattr(getattr(chunk, "x_groq", None), "usage", None) or getattr(chunk, "usage", None)
+    if usage is None:
+        return None
+    if hasattr(usage, "model_dump"):
+        return usage.model_dump(exclude_none=True)
+    return dict(usage) if isinstance(usage, dict) else None
+
+def stream_llama(
+    prompt: str,
+    context: Optional[str] = None,
+    persona_slug: Optional[str] = None,
+    query_vec: Optional[np.ndarray] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    以 stream=True 呼叫 LLM，邊收邊 yield：
+      {"type": "delta", "content": str}                  ← 每個 token 片段
+      {"type": "done", "reply": str, "usage": dict}       ← 結束（含 token 用量與首字延遲）
+    命中回覆快取（精確或語意）時整段回覆以單一 delta 送出，usage 只有 cached/ttft_ms/total_ms。
+    """
+    msgs = _build_messages(prompt, context, persona_slug)
+    t0 = time.perf_counter()
+    key = _cache_key(msgs)
+    cached = _RESPONSE_CACHE.get(key)
+    ctx = 0
+    if cached is None:
+        ctx, cached = _semantic_lookup(msgs, query_vec)
+    if cached is not None:
+        elapsed = round((time.perf_counter() - t0) * 1000.0, 1)
+        yield {"type": "delta", "content": cached}
+        yield {"type": "done", "reply": cached, "usage": {"cached": True, "ttft_ms": elapsed, "total_ms": elapsed}}
+        return
+    stream = client.chat.completions.create(
+        model=MODEL,
+        messages=msgs,
+        temperature=TEMPERATURE,
+        stream=True,
+    )
+    parts: List[str] = []
+    usage: Dict[str, Any] = {}
+    ttft_ms: Optional[float] = None
+    for chunk in stream:
+        got = _usage_dict(chunk)
+        if got:
+            usage.update(got)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content or ""
+        if not delta:
+            continue
+        if ttft_ms is None:
+            ttft_ms = (time.perf_counter() - t0) * 1000.0
+        parts.append(delta)
+        yield {"type": "delta", "content": delta}
+    usage["ttft_ms"] = round(ttft_ms, 1) if ttft_ms is not None else None
+    usage["total_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+    reply = "".join(parts).strip()
+    _RESPONSE_CACHE.put(key, reply)     # 串流中途斷線不會走到這裡，不會快取半截回覆
+    _semantic_add(ctx, msgs, query_vec, reply, t0)
+    yield {"type": "done", "reply": reply, "usage": usage}
@@ -4,6 +4,7 @@ from __future__ import annotations
 import json
 import os
 import re
+import time
 from typing import Any, Dict, List, Tuple, Optional
 
 # personas.py 內：替換 _candidate_persona_paths()
@@ -85,6 +86,10 @@ DEFAULT_PERSONA_ID = (
 _CACHE: Dict[str, Dict[str, Any]] = {}
 _SRC: Optional[str] = None
 _MTIME: Optional[float] = None
+_CHECKED_AT = 0.0
+# 每次請求都會查人設（含 async view 的事件迴圈上）：快取期間內連 stat 都不做，
+# 過期後只 stat 一次，mtime 沒變就不重新讀檔解析 JSON
+_RECHECK_SECONDS = 2.0
 
 def _base_dir() -> str:
     if settings and getattr(settings, "BASE_DIR", None):
@@ -122,12 +127,19 @@ def _normalize_persona_item(pid: str, obj: Dict[str, Any]) -> Dict[str, Any]:
         or obj.get("prompt")
         or obj.get("instructions")
     )
+    # RAG 脈絡的 token 預算（可選；未設定時用 ASSISTANT_CONTEXT_TOKENS）
+    ctx_tokens = obj.get("context_tokens", obj.get("contextTokens"))
+    try:
+        ctx_tokens = int(ctx_tokens) if ctx_tokens is not None else None
+    except (TypeError, ValueError):
+        ctx_tokens = None
     return {
         "id": str(pid),
         "name": str(name),
         "avatar": avatar,
         "description": str(description) if description else "",
         "hidden": hidden,                          # ★
+        "context_tokens": ctx_tokens,
         "_system_prompt": str(sys_prompt) if isinstance(sys_prompt, str) else None,
     }
 
@@ -188,6 +200,7 @@ def _merge_with_fallback(meta_by_id: Dict[str, Dict[str, Any]]) -> Dict[str, Dic
             "avatar": file_meta.get("avatar") or fb_meta.get("avatar"),
             "description": file_meta.get("description") or fb_meta.get("description") or "",
             "hidden": bool(file_meta.get("hidden", False)),  # fallback 預設 False
+            "context_tokens": file_meta.get("context_tokens"),
             "_system_prompt": (
                 file_meta.get("_system_prompt")
                 or PERSONAS.get(pid)  # 以內建 prompt 作為最後保底
@@ -195,17 +208,32 @@ def _merge_with_fallback(meta_by_id: Dict[str, Dict[str, Any]]) -> Dict[str, Dic
         }
     return merged
 
+def _source_mtime() -> Tuple[Optional[str], Optional[float]]:
+    """第一個存在的候選檔與其 mtime（只 stat，不讀內容）。"""
+    for p in _candidate_persona_paths():
+        try:
+            return p, os.path.getmtime(p)
+        except OSError:
+            continue
+    return None, None
+
 def _load_personas_cached() -> Dict[str, Dict[str, Any]]:
     """
     具 mtime 熱重載的讀取：檔案未變動則走快取；否則重新載入並合併後援。
     若兩個候選路徑皆不存在，則以空結果與 FALLBACK 合併。
     """
-    global _CACHE, _SRC, _MTIME
+    global _CACHE, _SRC, _MTIME, _CHECKED_AT
+    now = time.monotonic()
+    if _CACHE and now - _CHECKED_AT < _RECHECK_SECONDS:
+        return _CACHE
+    src, mtime = _source_mtime()
+    if _CACHE and src and _SRC == src and _MTIME == mtime:
+        _CHECKED_AT = now
+        return _CACHE
+    _CHECKED_AT = now
     file_meta, src = _load_personas_from_files()
     if src and os.path.exists(src):
         mtime = os.path.getmtime(src)
-        if _CACHE and _SRC == src and _MTIME == mtime:
-            return _CACHE
         merged = _merge_with_fallback(file_meta)
         _CACHE, _SRC, _MTIME = merged, src, mtime
         return merged
@@ -215,6 +243,16 @@ def _load_personas_cached() -> Dict[str, Dict[str, Any]]:
     _CACHE, _SRC, _MTIME = merged, None, None
     return merged
 
+def personas_version() -> str:
+    """
+    personas.json 的版本標記（來源路徑 + mtime）；檔案改動後即改變，
+    給回覆快取等需要隨人設失效的地方使用。無檔案時為 "builtin"。
+    """
+    _load_personas_cached()
+    if not _SRC:
+        return "builtin"
+    return f"{_SRC}:{_MTIME}"
+
 # ----------------------------------------------
 # 對外 API（含 UI 用清單、系統提示、預設 id）
 # ----------------------------------------------
@@ -287,6 +325,13 @@ def get_system_prompt(persona_id: Optional[str]) -> str:
     # 最後保底（理論上到不了）
     return PERSONAS.get(get_default_persona_id(), "")
 
+def get_context_tokens(persona_id: Optional[str]) -> Optional[int]:
+    """
+    persona 在 personas.json 設定的脈絡 token 預算（context_tokens）；未設定回傳 None。
+    """
+    pid = persona_id or get_default_persona_id()
+    return (_load_personas_cached().get(pid, {}) or {}).get("context_tokens")
+
 # 舊名稱相容
 def get_persona_prompt(persona_id: Optional[str]) -> str:
     return get_system_prompt(persona_id)
@@ -339,4 +384,6 @@ __all__ = [
     "get_system_prompt",
     "get_persona_prompt",
     "resolve_persona_id",         # ★ 新增
+    "personas_version",
+    "get_context_tokens",
 ]
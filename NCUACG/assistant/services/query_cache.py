@@ -0,0 +1,162 @@
+# NCUACG/assistant/services/query_cache.py
+from __future__ import annotations
+
+import hashlib
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 查詢向量快取（LRU + TTL）
+# 社博期間大量重複的問題（「社博什麼時候」「活動時間」）命中時直接略過 encoder。
+# - 行程內：OrderedDict 做 LRU，容量與 TTL 可設定
+# - 可選共用：透過 Django cache（例如 Redis）讓所有 worker 共享結果
+_TRAILING_PUNCT = "?？!！。.,，~～ "
+
+
+def normalize_query(text: str) -> str:
+    """快取 key 用的正規化：NFKC（全半形統一）、小寫、壓縮空白、去掉句尾標點。"""
+    t = unicodedata.normalize("NFKC", text or "")
+    t = re.sub(r"\s+", " ", t).strip().lower()
+    return t.rstrip(_TRAILING_PUNCT)
+
+
+class QueryEmbeddingCache:
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 3600.0,
+        shared_alias: Optional[str] = None,
+        key_prefix: str = "assistant:qemb:",
+    ):
+        self.maxsize = int(maxsize)
+        self.ttl = float(ttl)
+        self.shared_alias = shared_alias or None
+        self.key_prefix = key_prefix
+        self._data: "OrderedDict[str, Tuple[float, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0
+
+    def _key(self, model: str, text: str) -> str:
+        digest = hashlib.sha1(f"{model}\n{normalize_query(text)}".encode("utf-8")).hexdigest()
+        return digest
+
+    # ---- 共用後端（Django cache） ----
+    def _shared(self) -> Any:
+        if not self.shared_alias:
+            return None
+        try:
+            from django.core.cache import caches
+            return caches[self.shared_alias]
+        except Exception:
+            logger.warning("shared query cache %r unavailable; using local cache only", self.shared_alias)
+            self.shared_alias = None
+            return None
+
+    def _shared_get(self, key: str) -> Optional[np.ndarray]:
+        backend = self._shared()
+        if backend is None:
+            return None
+        try:
+            raw = backend.get(self.key_prefix + key)
+        except Exception:
+            return None
+        if not raw:
+            return None
+        return np.frombuffer(raw, dtype=np.float32)
+
+    def _shared_set(self, key: str, vec: np.ndarray) -> None:
+        backend = self._shared()
+        if backend is None:
+            return
+        try:
+            backend.set(self.key_prefix + key, vec.astype(np.float32).tobytes(), timeout=int(self.ttl))
+        except Exception:
+            pass
+
+    # ---- 行程內 LRU ----
+    def _local_get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, vec = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return vec
+
+    def _local_set(self, key: str, vec: np.ndarray) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, vec)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    # ---- 對外 ----
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        if not self.enabled:
+            return None
+        key = self._key(model, text)
+        vec = self._local_get(key)
+        if vec is None:
+            vec = self._shared_get(key)
+            if vec is not None:
+                self.shared_hits += 1
+                self._local_set(key, vec)
+        if vec is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return vec
+
+    def put(self, model: str, text: str, vec: np.ndarray) -> np.ndarray:
+        vec = np.asarray(vec, dtype=np.float32)
+        vec.setflags(write=False)  # 多個請求共用同一個陣列，禁止就地修改
+        if self.enabled:
+            key = self._key(model, text)
+            self._local_set(key, vec)
+            self._shared_set(key, vec)
+        return vec
+
+    def get_or_compute(self, model: str, text: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        vec = self.get(model, text)
+        if vec is not None:
+            return vec
+        return self.put(model, text, compute())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.shared_hits = 0
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared_hits": self.shared_hits,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "shared_backend": self.shared_alias,
+        }
+
+
+__all__ = ["normalize_query", "QueryEmbeddingCache"]
@@ -0,0 +1,156 @@
+# NCUACG/assistant/services/response_cache.py
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from .query_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# LLM 回覆快取（完全相同的請求直接回傳上次的回覆）
+# key = sha256(model, system prompt（含 persona 與站內脈絡）, 正規化後的訊息, temperature)
+# 後端走 Django cache framework：預設 LocMemCache（行程內、MAX_ENTRIES 為容量上限），
+# 換成 Redis 等後端即可讓所有 worker 共用。
+#
+# 失效：key 前綴帶「命名空間」＝ 索引內容雜湊 + personas.json 版本。
+# 重建索引（熱重載後雜湊改變）或修改 personas.json 後，舊 key 不會再被查到，
+# 自然由 TTL / LRU 淘汰，不必逐筆刪除。
+Namespace = Callable[[], str]
+
+
+def request_key(model: str, system: str, message: str, temperature: float) -> str:
+    payload = json.dumps(
+        [model, system, normalize_query(message), round(float(temperature), 4)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        alias: Optional[str] = "assistant",
+        ttl: float = 600.0,
+        namespace: Optional[Namespace] = None,
+        key_prefix: str = "assistant:reply:",
+    ):
+        self.alias = alias or None
+        self.ttl = float(ttl)
+        self.namespace = namespace
+        self.key_prefix = key_prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.alias is not None and self.ttl > 0
+
+    def _backend(self) -> Any:
+        if not self.enabled:
+            return None
+        try:
+            from django.core.cache import caches
+            return caches[self.alias]
+        except Exception:
+            logger.warning("response cache %r unavailable; caching disabled", self.alias)
+            self.alias = None
+            return None
+
+    def _namespace(self) -> str:
+        if self.namespace is None:
+            return ""
+        try:
+            return hashlib.sha1(self.namespace().encode("utf-8")).hexdigest()[:12] + ":"
+        except Exception:
+            # 索引載入失敗等情況：寧可不命中，也不要跨版本回傳舊回覆
+            return "unversioned:"
+
+    def key(self, model: str, system: str, message: str, temperature: float) -> str:
+        return self.key_prefix + self._namespace() + request_key(model, system, message, temperature)
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    # ---- 同步 ----
+    def get(self, key: str) -> Optional[str]:
+        backend = self._backend()
+        if backend is None:
+            return None
+        try:
+            value = backend.get(key)
+        except Exception:
+            value = None
+        self._count(value is not None)
+        return value
+
+    def peek(self, key: str) -> Optional[str]:
+        """與 get 相同但不計入命中率（single-flight 輪詢用）。"""
+        backend = self._backend()
+        if backend is None:
+            return None
+        try:
+            return backend.get(key)
+        except Exception:
+            return None
+
+    def put(self, key: str, reply: str) -> None:
+        backend = self._backend()
+        if backend is None or not reply:
+            return
+        try:
+            backend.set(key, reply, timeout=int(self.ttl))
+        except Exception:
+            pass
+
+    # ---- 非同步（Django cache 的 aget/aset） ----
+    async def aget(self, key: str) -> Optional[str]:
+        backend = self._backend()
+        if backend is None:
+            return None
+        try:
+            value = await backend.aget(key)
+        except Exception:
+            value = None
+        self._count(value is not None)
+        return value
+
+    async def apeek(self, key: str) -> Optional[str]:
+        backend = self._backend()
+        if backend is None:
+            return None
+        try:
+            return await backend.aget(key)
+        except Exception:
+            return None
+
+    async def aput(self, key: str, reply: str) -> None:
+        backend = self._backend()
+        if backend is None or not reply:
+            return
+        try:
+            await backend.aset(key, reply, timeout=int(self.ttl))
+        except Exception:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "backend": self.alias,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+__all__ = ["request_key", "ResponseCache"]
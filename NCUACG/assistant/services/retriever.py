@@ -1,15 +1,30 @@
 # NCUACG/assistant/services/retriever.py
 from __future__ import annotations
 
+import json
+import logging
 import os
-import re
-import pickle
+import threading
+import time
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
 
-from sentence_transformers import SentenceTransformer
+from . import index_store
+from .conf import as_bool, setting
+from .batch_encoder import BatchingEncoder
+from .context_builder import ContextPlan, build_context
+from .dedup import mmr_select
+from .embedding import DEFAULT_MODEL_NAME, get_model, model_stats
+from .lexical import BM25Index, build_bm25, doc_text, rrf_fuse
+from .query_cache import QueryEmbeddingCache
+from .search_backends import ExactSearch, QuantizedSearch, backend_stats, build_backend
+from .topn import topn, topn_batch
+from .timeparse import extract_start_dt as _extract_start_dt  # noqa: F401 舊名稱相容
+from .timeparse import parse_dt as _parse_dt  # noqa: F401
+from .timeparse import TimeIndex, start_ts_column, ts_to_dt
 
 # ====== 時間處理（盡量不依賴額外套件） ======
 from datetime import datetime, timedelta, timezone
@@ -36,158 +51,610 @@ except Exception:  # pragma: no cover
 # ====== 內容與向量檔位置（沿用你的既有邏輯） ======
 BASE = Path(__file__).resolve().parents[3]  # 到 NCUACG_net/
 DATA = BASE / "frontend" / "src" / "data"
-DATA.mkdir(exist_ok=True)
-VECS_PATH = DATA / "notices.pkl"
+INDEX_DIR = DATA / "notices_index"   # scripts/build_emb.py 產生的 memmap 索引
+VECS_PATH = DATA / "notices.pkl"     # 舊格式；僅在尚未建立新索引時使用
 
-# 讀取向量與原文（沿用）
-vecs, docs = pickle.load(open(VECS_PATH, "rb"))
-vecs = np.asarray(vecs, dtype=np.float32)
-vecs_norm = vecs / (np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-9)
+logger = logging.getLogger(__name__)
 
-# 查詢嵌入模型（與 build_emb 同一家族；E5）
-_Q_MODEL_NAME = "intfloat/multilingual-e5-base"
-_q_model = SentenceTransformer(_Q_MODEL_NAME)
+# 搜尋後端：exact（全表掃描，預設）或 ivf（近似最近鄰，適合大語料）
+_SEARCH_BACKEND = setting("ASSISTANT_SEARCH_BACKEND", "exact")
+_IVF_MIN_ROWS = setting("ASSISTANT_IVF_MIN_ROWS", 20_000, int)  # 低於此筆數仍走 exact
+_IVF_NPROBE = setting("ASSISTANT_IVF_NPROBE", 8, int)
+# 索引帶有量化副本（build_emb --quantize）時：先掃量化副本，再以 float32 精算前 k*RESCORE 名。
+# 只省常駐記憶體、不會比 float32 全表內積快（見 search_backends.QuantizedSearch），預設關閉
+_QUANTIZED_SCAN = setting("ASSISTANT_QUANTIZED_SCAN", False, as_bool)
+_RESCORE = setting("ASSISTANT_RESCORE_FACTOR", 4, int)
 
-def _embed_query(text: str) -> np.ndarray:
-    q = _q_model.encode([f"query: {text}"], normalize_embeddings=True, convert_to_numpy=True)[0]
-    return q.astype(np.float32)
-
-# ====== 時間解析輔助 ======
-_ISO_CANDIDATES = (
-    "%Y-%m-%d",
-    "%Y-%m-%d %H:%M",
-    "%Y-%m-%d %H:%M:%S",
-)
+# 混合檢索：BM25（字元 bigram）與向量排名以 RRF 合併；k 越大，前段名次的權重差距越小
+_HYBRID = setting("ASSISTANT_HYBRID", True, as_bool)
+_RRF_K = setting("ASSISTANT_RRF_K", 60.0, float)
+
+# MMR 多樣化：λ < 1 時從候選池挑出彼此不重複的 k 筆（1 = 停用，純相關度）
+_MMR_LAMBDA = setting("ASSISTANT_MMR_LAMBDA", 1.0, float)
+
+# 時間視窗的用法："pool"（視窗內夠相關的列補進相似度候選池，預設）/ "prefilter"（只搜視窗內）/ "off"
+_TIME_FILTER = str(setting("ASSISTANT_TIME_FILTER", "pool")).lower()
+_WINDOW_SIM_MARGIN = setting("ASSISTANT_WINDOW_SIM_MARGIN", 0.05, float)
+
+@dataclass
+class _LoadedIndex:
+    vecs: np.ndarray                 # 已 L2 正規化
+    docs: List[Dict[str, Any]]
+    backend: Any                     # search_backends.ExactSearch / IVFSearch
+    start_ts: np.ndarray             # int64 epoch 秒；解析不到者為 timeparse.NAT
+    time_index: TimeIndex            # 依 start_ts 排序，用來做時間視窗預過濾
+    lexical: Optional[BM25Index] = None   # BM25 倒排索引（停用混合檢索時為 None）
+    duplicates: Optional[Dict[int, List[Dict[str, Any]]]] = None   # 代表列 → 建索引時被合併的段落來源
+    model: str = DEFAULT_MODEL_NAME  # 建索引用的模型（查詢端須一致）
+    signature: Optional[Tuple[Any, ...]] = None   # 載入時的檔案簽章（判斷是否需要重載）
+    content_hash: str = ""
+    generation: int = 0              # 行程內第幾代索引（每次熱重載 +1）
+
+# 向量與原文改為第一次查詢時才載入（避免 manage.py / migrate 也付出載入成本）
+_INDEX: Optional[_LoadedIndex] = None
+_INDEX_LOCK = threading.Lock()
 
-def _to_dt_aware(dt: datetime) -> datetime:
-    """確保 datetime 是有時區的（統一轉成 UTC aware）。"""
-    if dt.tzinfo is None:
-        return dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(timezone.utc)
+# 熱重載：最多每 N 秒檢查一次索引檔是否換代（<= 0 停用）；
+# 新一代在背景執行緒載入，完成後整個物件一次替換，進行中的查詢繼續用舊的那一代。
+_RELOAD_SECONDS = setting("ASSISTANT_INDEX_RELOAD_SECONDS", 5.0, float)
+_NEXT_CHECK = 0.0
+_RELOAD_LOCK = threading.Lock()
 
-def _parse_dt(value: Any) -> Optional[datetime]:
+# 查詢嵌入模型（與 build_emb 同一家族；E5）；實際載入交給 embedding 註冊表
+_Q_MODEL_NAME = DEFAULT_MODEL_NAME
+
+def _index_signature() -> Optional[Tuple[Any, ...]]:
+    """索引檔的 (路徑, mtime, 大小)；header.json 是新索引的提交點，換代時必定改變。"""
+    path = INDEX_DIR / index_store.HEADER_NAME
+    if not path.is_file():
+        path = VECS_PATH
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (str(path), st.st_mtime_ns, st.st_size)
+
+def _load_index() -> _LoadedIndex:
     """
-    盡力從 doc 的欄位值解析時間。
-    支援：
-    - ISO 8601（含時區）
-    - 常見日期格式（見 _ISO_CANDIDATES）
-    - '2025/08/30 18:00'、'2025.08.30' 等常見變體（以正規化方式嘗試）
+    優先讀取 memmap 索引（多 worker 共用 page cache、不需 unpickle）；
+    找不到時才回退到舊的 notices.pkl。
     """
-    if value is None:
-        return None
-    if isinstance(value, (int, float)):
-        # 若是 Unix timestamp（秒）
-        try:
-            return _to_dt_aware(datetime.fromtimestamp(float(value), tz=timezone.utc))
-        except Exception:
-            return None
-    if isinstance(value, datetime):
-        return _to_dt_aware(value)
-    if not isinstance(value, str):
-        return None
+    signature = _index_signature()
+    if index_store.exists(INDEX_DIR):
+        idx = index_store.open_index(INDEX_DIR)
+        model, content_hash = idx.header.model or DEFAULT_MODEL_NAME, idx.header.content_hash
+        vecs, docs, columns = idx.vectors, idx.docs, idx.columns
+        attachments = idx.attachments
+        qvecs = idx.qvectors
+        if vecs.dtype != np.float32:
+            # build_emb --dtype float16：載入時轉一次 float32（常駐記憶體為檔案的兩倍）。
+            # 若留著 float16 memmap，每次查詢的 vecs @ q 都會把整個矩陣轉型一次
+            # （100k 列約 300 ms、數百 MB 暫存）；float16 只用來縮小磁碟與傳輸大小
+            t0 = time.perf_counter()
+            vecs = np.ascontiguousarray(vecs, dtype=np.float32)
+            logger.info("converted %s index vectors to float32 in %.0f ms",
+                        idx.vectors.dtype, (time.perf_counter() - t0) * 1000.0)
+        if not idx.header.normalized:
+            vecs = vecs / (np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-9)
+    else:
+        logger.warning("vector index not found at %s; falling back to legacy %s", INDEX_DIR, VECS_PATH)
+        vecs, docs = index_store.load_legacy_pickle(VECS_PATH)
+        vecs = vecs / (np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-9)
+        model, content_hash, columns, attachments = DEFAULT_MODEL_NAME, "", {}, {}
+        qvecs = None
 
-    s = value.strip()
-    if not s:
-        return None
+    backend = build_backend(_SEARCH_BACKEND, vecs, min_rows=_IVF_MIN_ROWS, n_probe=_IVF_NPROBE)
+    if qvecs is not None and _QUANTIZED_SCAN and isinstance(backend, ExactSearch):
+        # 模式由 header 決定（int8 附 qscale 欄位；float16 不需要）
+        backend = QuantizedSearch(vecs, qvecs, scales=columns.get("qscale"), rescore=_RESCORE)
+    start_ts = columns.get("start_ts")
+    if start_ts is None:
+        # 舊索引沒有時間欄位：載入時算一次，之後查詢不再 parse
+        start_ts = start_ts_column(docs)
+    lexical = None
+    if _HYBRID:
+        if "lexical" in attachments:
+            lexical = BM25Index.load(attachments["lexical"])
+        else:
+            # 舊索引沒有 BM25 附檔：載入時建一次
+            lexical = build_bm25([doc_text(d) for d in docs])
+    duplicates = _load_duplicates(attachments["duplicates"]) if "duplicates" in attachments else {}
+    return _LoadedIndex(
+        vecs=vecs, docs=docs, backend=backend,
+        start_ts=start_ts, time_index=TimeIndex(start_ts), lexical=lexical, duplicates=duplicates,
+        model=model, signature=signature, content_hash=content_hash,
+    )
+
+def _load_duplicates(path: Path) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    duplicates 附檔：每行一筆 [代表列號, 來源]（build_emb 邊去重邊寫）；
+    舊索引是單一 JSON 物件 {列號: [來源, ...]}。
+    """
+    out: Dict[int, List[Dict[str, Any]]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        if f.read(1) == "{":
+            f.seek(0)
+            return {int(row): refs for row, refs in json.load(f).items()}
+        f.seek(0)
+        for line in f:
+            if line.strip():
+                row, ref = json.loads(line)
+                out.setdefault(int(row), []).append(ref)
+    return out
+
+def _install(index: _LoadedIndex) -> None:
+    global _INDEX, _Q_MODEL_NAME
+    _Q_MODEL_NAME = index.model
+    _INDEX = index   # 單一參照賦值即完成換代；查詢端不需要鎖
 
-    # 1) 嘗試原字串用 fromisoformat（Python 3.11+ 支援 ±HH:MM）
+def _reload_worker(current: _LoadedIndex) -> None:
     try:
-        return _to_dt_aware(datetime.fromisoformat(s))
+        if _index_signature() == current.signature:
+            return
+        fresh = _load_index()
+        fresh.generation = current.generation + 1
+        _install(fresh)
+        logger.info(
+            "vector index reloaded: generation %d, %d rows, hash %s",
+            fresh.generation, len(fresh.docs), fresh.content_hash[:12],
+        )
     except Exception:
-        pass
-
-    # 2) 嘗試替換常見分隔符號，做幾種 pattern
-    s2 = re.sub(r"[./]", "-", s)
-    # 移除多餘空白
-    s2 = re.sub(r"\s+", " ", s2)
-
-    for fmt in _ISO_CANDIDATES:
-        try:
-            return _to_dt_aware(datetime.strptime(s2, fmt))
-        except Exception:
-            continue
-
-    # 3) 嘗試抓出 YYYY-MM-DD 或 YYYY-MM-DD HH:MM 的片段
-    m = re.search(r"(\d{4}-\d{2}-\d{2})(?:[ T](\d{2}:\d{2}(?::\d{2})?))?", s2)
-    if m:
-        date_part = m.group(1)
-        time_part = m.group(2) or "00:00"
-        try:
-            return _to_dt_aware(datetime.strptime(f"{date_part} {time_part}", "%Y-%m-%d %H:%M" if len(time_part) == 5 else "%Y-%m-%d %H:%M:%S"))
-        except Exception:
-            pass
-
-    return None
-
-# 從文件物件提取開始時間（支援多鍵）
-_START_KEYS = ("start_time", "start", "date", "datetime", "when", "time")
-
-def _extract_start_dt(doc: Dict[str, Any]) -> Optional[datetime]:
-    meta = doc if isinstance(doc, dict) else {}
-    for key in _START_KEYS:
-        if key in meta:
-            dt = _parse_dt(meta.get(key))
-            if dt:
-                return dt
-    # 也許日期藏在 content 裡，試著掃描
-    text = (meta.get("content") or meta.get("title") or "") if isinstance(meta, dict) else ""
-    dt = _parse_dt(text)
-    return dt
+        # 新檔案還沒寫完或格式錯誤：繼續服務舊的一代，下次檢查再試
+        logger.exception("vector index reload failed; keep serving generation %d", current.generation)
+    finally:
+        _RELOAD_LOCK.release()
+
+def _maybe_reload(current: _LoadedIndex) -> None:
+    global _NEXT_CHECK
+    now = time.monotonic()
+    if now < _NEXT_CHECK or not _RELOAD_LOCK.acquire(blocking=False):
+        return
+    _NEXT_CHECK = now + _RELOAD_SECONDS
+    if _index_signature() == current.signature:
+        _RELOAD_LOCK.release()
+        return
+    threading.Thread(target=_reload_worker, args=(current,), name="index-reload", daemon=True).start()
+
+def _get_index() -> _LoadedIndex:
+    """
+    回傳目前這一代索引。第一次呼叫同步載入；之後最多每 _RELOAD_SECONDS 秒
+    檢查一次檔案簽章，有變動就在背景載入新的一代。
+    呼叫端應在一次查詢內只取一次並沿用同一個物件。
+    """
+    index = _INDEX
+    if index is None:
+        with _INDEX_LOCK:
+            if _INDEX is None:
+                _install(_load_index())
+        return _INDEX
+    if _RELOAD_SECONDS > 0:
+        _maybe_reload(index)
+    return index
+
+def index_generation() -> Tuple[int, str]:
+    """(行程內世代, 內容雜湊)；給快取失效等用途。"""
+    index = _get_index()
+    return index.generation, index.content_hash
+
+# 查詢向量快取：命中時完全略過 encoder（容量 0 代表停用）
+_QUERY_CACHE = QueryEmbeddingCache(
+    maxsize=setting("ASSISTANT_QEMB_CACHE_SIZE", 1024, int),
+    ttl=setting("ASSISTANT_QEMB_CACHE_TTL", 3600, float),
+    shared_alias=setting("ASSISTANT_QEMB_CACHE_SHARED", None),
+)
+
+# 併發請求的查詢 micro-batching（批次大小 <= 1 代表停用，每個請求各自 encode）
+_BATCH_SIZE = setting("ASSISTANT_QUERY_BATCH_SIZE", 16, int)
+_BATCH_WAIT_MS = setting("ASSISTANT_QUERY_BATCH_WAIT_MS", 3.0, float)
+_BATCHER: Optional[BatchingEncoder] = None
+_BATCHER_LOCK = threading.Lock()
+
+def _encode_queries(texts: Sequence[str]) -> np.ndarray:
+    q_model = get_model(_Q_MODEL_NAME)
+    qs = q_model.encode([f"query: {t}" for t in texts], normalize_embeddings=True, convert_to_numpy=True)
+    return np.asarray(qs, dtype=np.float32)
+
+def _get_batcher() -> Optional[BatchingEncoder]:
+    global _BATCHER
+    if _BATCH_SIZE <= 1:
+        return None
+    if _BATCHER is None:
+        with _BATCHER_LOCK:
+            if _BATCHER is None:
+                _BATCHER = BatchingEncoder(
+                    _encode_queries, max_batch=_BATCH_SIZE, max_wait_ms=_BATCH_WAIT_MS,
+                    prepare=lambda: get_model(_Q_MODEL_NAME),
+                )
+    return _BATCHER
+
+def _encode_query(text: str) -> np.ndarray:
+    batcher = _get_batcher()
+    if batcher is not None:
+        return batcher.encode(text)
+    return _encode_queries([text])[0]
+
+def _embed_query(text: str) -> np.ndarray:
+    return _QUERY_CACHE.get_or_compute(_Q_MODEL_NAME, text, lambda: _encode_query(text))
+
+def query_cache_stats() -> Dict[str, Any]:
+    return _QUERY_CACHE.stats()
+
+def retriever_stats() -> Dict[str, Any]:
+    """檢索端的執行狀態（索引世代與後端、查詢快取、micro-batcher、已載入模型）；不會觸發載入。"""
+    index = _INDEX
+    return {
+        "index": None if index is None else {
+            "generation": index.generation,
+            "content_hash": index.content_hash,
+            "model": index.model,
+            "lexical": index.lexical is not None,
+            **backend_stats(index.backend),
+        },
+        "query_cache": _QUERY_CACHE.stats(),
+        "batcher": _BATCHER.stats() if _BATCHER is not None else None,
+        "models": model_stats(),
+    }
 
 # ====== 相似度 + 時間過濾 ======
-def _rank_with_time(query: str, k: int = 4, pool_factor: int = 4) -> List[Tuple[int, float, Optional[datetime]]]:
+# 排序結果：(列號, cosine, RRF 分數或 None, 起始時間)
+Ranked = Tuple[int, float, Optional[float], Optional[datetime]]
+
+def _diversify(index: _LoadedIndex, q: np.ndarray, idxs: np.ndarray, k: int) -> np.ndarray:
+    """以 MMR 從候選中挑 k 筆（依挑選順序）。"""
+    idxs = np.asarray(idxs, dtype=np.int64)
+    local = mmr_select(index.backend.vectors(idxs), q, np.arange(idxs.size), k, lam=_MMR_LAMBDA)
+    return np.asarray([int(idxs[j]) for j in local], dtype=np.int64)
+
+def _hybrid_search(
+    index: _LoadedIndex,
+    q: np.ndarray,
+    query: str,
+    n: int,
+    rows: Optional[np.ndarray] = None,
+    sims: Optional[np.ndarray] = None,
+    top: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
     """
-    回傳候選索引 + 相似度 + 起始時間。
-    先取相似度前 k*pool_factor，再做未來視窗過濾與排序。
+    向量前 n 名（rows 給定時只算這些列）與 BM25 前 n 名以 RRF 合併，取前 n。
+    回傳 (列號, RRF 分數)；沒有融合（停用混合檢索或 BM25 沒命中）時分數為 None，
+    列號即依 cosine 由高到低。cosine 一律由呼叫端另算，兩種分數不混在同一個欄位。
+    sims：已算好的全表相似度（topk_batch 以一次矩陣乘法算出），給定時不再掃描。
+    top：search_batch 以 topn_batch 一次選好的全表前 n 名（不限列時直接沿用）。
     """
-    q = _embed_query(query)
-    sims = vecs_norm @ q  # cosine (已正規化)
-    # 先抓比較多的候選
-    n = min(len(sims), max(k * pool_factor, k))
-    idxs = sims.argsort()[::-1][:n]
+    if top is not None and rows is None:
+        idxs = top[0]
+    elif sims is not None:
+        if rows is not None:
+            local, _ = topn(sims[rows], n)
+            idxs = rows[local]
+        else:
+            idxs, _ = topn(sims, n)
+    elif rows is not None:
+        idxs, _ = index.backend.search_rows(rows, q, n)
+    else:
+        idxs, _ = index.backend.search(q, n)
+    if index.lexical is None:
+        return idxs, None
+    lex_idxs, _ = index.lexical.search(query, n, rows=rows)
+    if not lex_idxs.size:
+        return idxs, None
+    fused, fused_scores = rrf_fuse([idxs, lex_idxs], k0=_RRF_K)
+    return fused[:n], fused_scores[:n]
+
+def _fused_map(idxs: np.ndarray, fused: Optional[np.ndarray]) -> Dict[int, float]:
+    """列號 → RRF 分數（沒有融合時為空）。"""
+    if fused is None:
+        return {}
+    return {int(i): float(s) for i, s in zip(idxs, fused)}
+
+def _row_cosines(index: _LoadedIndex, ids: np.ndarray, q: np.ndarray) -> np.ndarray:
+    """少量指定列的 cosine（向量已正規化）。"""
+    if not len(ids):
+        return np.empty(0, dtype=np.float32)
+    return index.backend.vectors(ids) @ np.asarray(q, dtype=np.float32)
+
+def _rank_with_time(
+    query: str,
+    k: int = 4,
+    pool_factor: int = 4,
+    index: Optional[_LoadedIndex] = None,
+    q: Optional[np.ndarray] = None,
+    window: Optional[Tuple[datetime, datetime]] = None,
+    sims: Optional[np.ndarray] = None,
+    time_filter: Optional[str] = None,
+    top: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+) -> List[Ranked]:
+    """
+    回傳 (列號, cosine, RRF 分數或 None, 起始時間)。time_filter（預設 ASSISTANT_TIME_FILTER）：
+
+    - "pool"（預設）：全表相似度前 k*pool_factor 為候選池；時間視窗內的列另外做一次
+      只掃視窗的搜尋。視窗內的列（不論來自哪邊）cosine 不低於「候選池最佳 cosine −
+      _WINDOW_SIM_MARGIN」才算數（排不進前幾名的近期活動不會被漏掉，不相干的近期公告也擠不進來）。
+      候選中落在視窗內的依開始時間、再依 cosine 排在前面，不足 k 筆再以候選池順序
+      （混合檢索時為 RRF）補滿。
+    - "prefilter"：明確的時間過濾模式，只在視窗內的列中搜尋並依開始時間排序
+      （同一時間再依 cosine；適合「這週有什麼活動」這類查詢）；視窗內沒有任何列時回退到純相似度。
+    - "off"：純相似度前 k。
+
+    啟用 MMR 時先從候選中挑出 k 筆彼此不重複的，再排序。
+    顯示用的分數一律是 cosine；RRF 分數另外帶著（只有經過融合的候選池列才有）。
+    window：自訂 (起, 迄) 時間視窗，預設為 [now, now+_WINDOW_DAYS]。
+    sims / top：search_batch 已算好的全表相似度與前 k*pool_factor 名（見 _hybrid_search）。
+    """
+    index = index or _get_index()
+    if q is None:
+        q = _embed_query(query)
+    n = max(k * pool_factor, k)
+    mmr = _MMR_LAMBDA < 1.0
+    mode = time_filter or _TIME_FILTER
+
+    rows = np.empty(0, dtype=np.int64)
+    if mode != "off":
+        if window is None:
+            now = _now()
+            window = (now, now + timedelta(days=_WINDOW_DAYS))
+        lo, hi = window
+        rows = index.time_index.rows_between(int(lo.timestamp()), int(hi.timestamp()))
 
-    now = _now()
-    until = now + timedelta(days=_WINDOW_DAYS)
+    def enrich(idxs: Sequence[int], fused: Dict[int, float]) -> List[Ranked]:
+        idxs = np.asarray(idxs, dtype=np.int64)
+        cos = _row_cosines(index, idxs, q)
+        return [(int(i), float(c), fused.get(int(i)), ts_to_dt(index.start_ts[int(i)])) for i, c in zip(idxs, cos)]
 
-    enriched: List[Tuple[int, float, Optional[datetime]]] = []
-    for i in idxs:
-        i_int = int(i)
-        dt = _extract_start_dt(docs[i_int])
-        enriched.append((i_int, float(sims[i_int]), dt))
+    def by_time(hits: List[Ranked]) -> List[Ranked]:
+        return sorted(hits, key=lambda x: (x[3], -x[1]))   # dt 早者優先，cosine 高者優先
 
-    # 只留在 [now, until] 之間的
-    future = [(i, s, dt) for (i, s, dt) in enriched if (dt is not None and dt >= now and dt <= until)]
+    if mode == "prefilter" and rows.size:
+        idxs, fused = _hybrid_search(index, q, query, n, rows=rows, sims=sims)
+        if mmr:
+            idxs = _diversify(index, q, idxs, k)
+        return by_time(enrich(idxs, _fused_map(idxs, fused)))[:k]
 
-    # 排序：先依開始時間，再以相似度作次序
-    if future:
-        future.sort(key=lambda x: (x[2], -x[1]))  # dt 早者優先，相似度高者優先
-        return future[:k]
+    # 全表候選池（純相似度 / 混合檢索）
+    pool_idxs, pool_scores = _hybrid_search(index, q, query, n, sims=sims, top=top)
+    pool_fused = _fused_map(pool_idxs, pool_scores)
+    if not rows.size:
+        # 視窗內沒有任何列（或停用時間過濾）：候選池前 k（避免沒脈絡）
+        if mmr:
+            pool_idxs = _diversify(index, q, pool_idxs, k)
+        return enrich(pool_idxs[:k], pool_fused)
 
-    # 若沒有任何未來活動，回退到純相似度前 k（避免沒脈絡）
-    fallback = [(int(i), float(sims[int(i)]), _extract_start_dt(docs[int(i)])) for i in idxs[:k]]
-    return fallback
+    # 視窗內的候選（候選池內的 + 只掃視窗找到的），cosine 都要夠接近候選池的最佳結果；
+    # 小語料時整個表都在候選池裡，沒有這道門檻，任何近期公告都會被排到最前面
+    cand: Dict[int, float] = {}
+    pool_cos = _row_cosines(index, pool_idxs, q)
+    if pool_cos.size:
+        floor = float(pool_cos.max()) - _WINDOW_SIM_MARGIN
+        in_window = np.isin(pool_idxs, rows) & (pool_cos >= floor)
+        cand = {int(i): float(c) for i, c in zip(pool_idxs[in_window], pool_cos[in_window])}
+        if sims is not None:
+            local, w_cos = topn(sims[rows], n)
+            w_idxs = rows[local]
+        else:
+            w_idxs, w_cos = index.backend.search_rows(rows, q, n)
+        for i, c in zip(w_idxs, w_cos):
+            if c >= floor:
+                cand.setdefault(int(i), float(c))
+    if cand:
+        idxs = np.fromiter(cand, dtype=np.int64, count=len(cand))
+        if mmr:
+            idxs = _diversify(index, q, idxs, k)
+        future = by_time(enrich(idxs, pool_fused))[:k]
+    else:
+        future = []
+
+    # 不足 k 筆：以候選池順序補滿
+    taken = {x[0] for x in future}
+    rest_idxs = np.asarray([i for i in pool_idxs if int(i) not in taken], dtype=np.int64)
+    need = k - len(future)
+    if need > 0 and rest_idxs.size:
+        if mmr:
+            rest_idxs = _diversify(index, q, rest_idxs, need)
+        future += enrich(rest_idxs[:need], pool_fused)
+    return future
+
+def duplicates_of(row: int, index: Optional[_LoadedIndex] = None) -> List[Dict[str, Any]]:
+    """建索引時被合併到第 row 列的重複段落來源（沒有則為空 list）。"""
+    index = index or _get_index()
+    return list((index.duplicates or {}).get(int(row), ()))
+
+@dataclass
+class SearchHit:
+    row: int                         # 索引列號
+    score: float                     # 與查詢的 cosine 相似度（一律是 cosine，可互相比較）
+    start: Optional[datetime]        # 解析到的開始時間（UTC）
+    doc: Dict[str, Any]
+    fused: Optional[float] = None    # 混合檢索的 RRF 分數（沒經過融合時為 None，只用於排序）
+
+@dataclass
+class SearchResult:
+    """
+    一次檢索的完整結果：同一代索引、同一次 encode 與掃描。
+    文件清單、LLM 脈絡字串、前端引用來源都由這個物件衍生，不必重跑檢索。
+    """
+    query: str
+    hits: List[SearchHit]
+    generation: int = 0
+    content_hash: str = ""
+    timings: Dict[str, float] = field(default_factory=dict)   # embed_ms / rank_ms
+    duplicates: Dict[int, List[Dict[str, Any]]] = field(default_factory=dict)
+    query_vector: Optional[np.ndarray] = field(default=None, repr=False)   # 語意快取等下游沿用
+    usage: Dict[str, Any] = field(default_factory=dict)   # 組 prompt 時填入的 token 統計（llama_client.rag_search）
+
+    @property
+    def indices(self) -> List[int]:
+        return [h.row for h in self.hits]
+
+    @property
+    def scores(self) -> List[float]:
+        return [h.score for h in self.hits]
+
+    @property
+    def times(self) -> List[Optional[datetime]]:
+        return [h.start for h in self.hits]
+
+    @property
+    def docs(self) -> List[Dict[str, Any]]:
+        return [h.doc for h in self.hits]
+
+    def context(self, budget: Optional[int] = None) -> str:
+        return self.context_plan(budget).text
+
+    def context_plan(self, budget: Optional[int] = None) -> ContextPlan:
+        """依排序在 token 預算內組脈絡（同一份文件的段落共用標題列、略過重複句）；budget None = 不限。"""
+        return build_context(self.hits, budget)
+
+    def citations(self) -> List[Dict[str, Any]]:
+        """給前端顯示的引用來源（JSON 可序列化，不含全文）。"""
+        out: List[Dict[str, Any]] = []
+        for h in self.hits:
+            d = h.doc
+            item: Dict[str, Any] = {k: d[k] for k in _CITATION_KEYS if d.get(k) not in (None, "")}
+            item["score"] = round(h.score, 6)
+            if h.fused is not None:
+                item["fused"] = round(h.fused, 6)
+            if h.start:
+                item["start"] = h.start.isoformat()
+            dups = self.duplicates.get(h.row)
+            if dups:
+                item["duplicates"] = dups
+            out.append(item)
+        return out
+
+# 引用來源保留的欄位
+_CITATION_KEYS = ("source", "title", "id", "slug", "url", "posted", "date", "type", "category", "chunk")
+
+def format_context(hits: Sequence[SearchHit], budget: Optional[int] = None) -> str:
+    """
+    把命中的文件內容串成一段供 LLM 參考；若能取得開始時間，會一併顯示（見 context_builder）。
+    """
+    return build_context(hits, budget).text
+
+Window = Optional[Tuple[datetime, datetime]]
+
+def _result(
+    index: _LoadedIndex,
+    query: str,
+    ranked: List[Ranked],
+    timings: Dict[str, float],
+    q: Optional[np.ndarray] = None,
+) -> SearchResult:
+    docs = index.docs
+    dups = index.duplicates or {}
+    return SearchResult(
+        query=query,
+        hits=[SearchHit(row=i, score=cos, start=dt, doc=docs[i], fused=fused) for (i, cos, fused, dt) in ranked],
+        generation=index.generation,
+        content_hash=index.content_hash,
+        timings=timings,
+        duplicates={i: dups[i] for (i, *_) in ranked if i in dups},
+        query_vector=q,
+    )
+
+def search(
+    query: str,
+    k: int = 4,
+    pool_factor: int = 4,
+    window: Window = None,
+    time_filter: Optional[str] = None,
+) -> SearchResult:
+    """
+    單次檢索：取一代索引、encode 一次、排序一次，回傳帶分數/時間/文件的結果物件。
+    time_filter："pool" / "prefilter" / "off"（見 _rank_with_time），None 用 ASSISTANT_TIME_FILTER。
+    """
+    index = _get_index()   # 同一次查詢固定使用同一代索引
+    t0 = time.perf_counter()
+    q = _embed_query(query)
+    t1 = time.perf_counter()
+    ranked = _rank_with_time(
+        query, k=k, pool_factor=pool_factor, index=index, q=q, window=window, time_filter=time_filter,
+    )
+    t2 = time.perf_counter()
+    return _result(index, query, ranked, {"embed_ms": (t1 - t0) * 1000.0, "rank_ms": (t2 - t1) * 1000.0}, q)
+
+# 一次矩陣乘法的查詢數上限：(查詢數 × 列數) 個 float32 的暫存
+_BATCH_SCORE_BLOCK = 256
+
+def embed_queries(queries: Sequence[str]) -> np.ndarray:
+    """
+    批次取得查詢向量：先查快取，未命中的一次送進 encoder（不經 micro-batcher），再寫回快取。
+    """
+    out: List[Optional[np.ndarray]] = [_QUERY_CACHE.get(_Q_MODEL_NAME, t) for t in queries]
+    missing: Dict[str, List[int]] = {}
+    for j, v in enumerate(out):
+        if v is None:
+            missing.setdefault(queries[j], []).append(j)
+    if missing:
+        texts = list(missing)
+        for t, vec in zip(texts, _encode_queries(texts)):
+            vec = _QUERY_CACHE.put(_Q_MODEL_NAME, t, vec)
+            for j in missing[t]:
+                out[j] = vec
+    if not out:
+        return np.zeros((0, _get_index().vecs.shape[1]), dtype=np.float32)
+    return np.stack(out).astype(np.float32, copy=False)
+
+def search_batch(
+    queries: Sequence[str],
+    k: int = 4,
+    windows: Optional[Sequence[Window]] = None,
+    pool_factor: int = 4,
+    time_filter: Optional[str] = None,
+) -> List[SearchResult]:
+    """
+    多筆查詢一次處理（離線評估、預熱快取）：
+    所有查詢一起 encode；exact 後端的相似度以「查詢矩陣 × 文件矩陣」一次算出
+    （每 _BATCH_SCORE_BLOCK 筆一塊），候選池再以 topn_batch 整塊一次選出；
+    IVF / 量化後端則逐筆走後端的 search()，與 search() 結果一致。
+    排序規則與 search() 相同。windows 與 queries 等長，個別查詢可指定 (起, 迄)，None 為預設視窗。
+    """
+    queries = list(queries)
+    if windows is not None and len(windows) != len(queries):
+        raise ValueError(f"windows has {len(windows)} entries for {len(queries)} queries")
+    index = _get_index()
+    t0 = time.perf_counter()
+    qs = embed_queries(queries)
+    embed_ms = (time.perf_counter() - t0) * 1000.0 / max(len(queries), 1)
+
+    n = max(k * pool_factor, k)
+    results: List[SearchResult] = []
+    for start in range(0, len(queries), _BATCH_SCORE_BLOCK):
+        t1 = time.perf_counter()
+        chunk = qs[start:start + _BATCH_SCORE_BLOCK]
+        block = index.backend.score_matrix(chunk)
+        tops = topn_batch(block, n) if block is not None else None
+        score_ms = (time.perf_counter() - t1) * 1000.0 / max(len(chunk), 1)
+        for j in range(len(chunk)):
+            qi = start + j
+            sims = block[j] if block is not None else None
+            top = (tops[0][j], tops[1][j]) if tops is not None else None
+            t2 = time.perf_counter()
+            ranked = _rank_with_time(
+                queries[qi], k=k, pool_factor=pool_factor, index=index, q=qs[qi],
+                window=windows[qi] if windows is not None else None, sims=sims, time_filter=time_filter,
+                top=top,
+            )
+            rank_ms = score_ms + (time.perf_counter() - t2) * 1000.0
+            results.append(_result(index, queries[qi], ranked, {"embed_ms": embed_ms, "rank_ms": rank_ms}, qs[qi]))
+    return results
 
 def topk(query: str, k: int = 4) -> List[Dict[str, Any]]:
     """
     回傳前 k 筆原始文件物件（含 title/content 等），已考慮「未來活動」優先。
+    需要同時拿脈絡字串時請直接用 search()。
+    """
+    return search(query, k=k).docs
+
+def topk_batch(
+    queries: Sequence[str],
+    k: int = 4,
+    windows: Optional[Sequence[Window]] = None,
+) -> List[List[Dict[str, Any]]]:
+    """topk() 的批次版本：每筆查詢的前 k 筆文件（見 search_batch）。"""
+    return [r.docs for r in search_batch(queries, k=k, windows=windows)]
+
+def retrieve_context(query: str, k: int = 4, budget: Optional[int] = None) -> str:
+    """
+    把前 k 筆文件的內容串成一段供 LLM 參考（search(query, k).context(budget)）。
     """
-    ranked = _rank_with_time(query, k=k, pool_factor=4)
-    return [docs[i] for (i, _, _) in ranked]
-
-def retrieve_context(query: str, k: int = 4) -> str:
-    """
-    把前 k 筆文件的內容串成一段供 LLM 參考；若能取得開始時間，會一併顯示。
-    """
-    ranked = _rank_with_time(query, k=k, pool_factor=4)
-    parts: List[str] = []
-    for (i, _sim, dt) in ranked:
-        d = docs[i]
-        title = str(d.get("title", "") or "").strip()
-        content = str(d.get("content", "") or "").strip()
-        # 顯示有解析到的日期，幫助 persona 嚴格控雷
-        dt_str = dt.astimezone(timezone(timedelta(hours=8))).strftime("%Y-%m-%d %H:%M %Z") if dt else ""
-        header = f"[{title}] {dt_str}".strip()
-        if header:
-            parts.append(header)
-        parts.append(content)
-    return "\n---\n".join(p for p in parts if p)
+    return search(query, k=k).context(budget)
@@ -0,0 +1,265 @@
+# NCUACG/assistant/services/search_backends.py
+from __future__ import annotations
+
+import logging
+import time
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .topn import topn
+
+logger = logging.getLogger(__name__)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 向量搜尋後端
+# 所有後端都實作同一個介面：search(q, n) -> (row 索引, 相似度)，依相似度由高到低。
+# - ExactSearch：全表內積，作為正確答案（reference）
+# - IVFSearch：純 NumPy 的倒排檔（k-means 分群 + 只掃描最近的 n_probe 群）
+# - QuantizedSearch：以 int8 / float16 量化副本掃全表，前 n*rescore 名再用 float32 精算
+# 向量須已 L2 正規化，內積即 cosine。
+#
+# 時間視窗內搜尋（search_rows）、MMR / 門檻用的列向量（vectors）、批次查詢的整表分數
+# （score_matrix）也都由後端提供，retriever 不直接讀 float32 矩陣，各條路徑的計分方式一致。
+Hits = Tuple[np.ndarray, np.ndarray]
+
+
+class _Backend:
+    name = ""
+    vecs: np.ndarray
+
+    def __len__(self) -> int:
+        return int(self.vecs.shape[0])
+
+    def vectors(self, ids: np.ndarray) -> np.ndarray:
+        """指定列的 float32 向量（少量列：MMR、門檻比較；memmap 下只讀對應頁面）。"""
+        return np.asarray(self.vecs[np.asarray(ids, dtype=np.int64)], dtype=np.float32)
+
+    def search_rows(self, rows: np.ndarray, q: np.ndarray, n: int) -> Hits:
+        """只在指定列中搜尋（時間視窗）；預設為精確內積。"""
+        return search_rows(self.vecs, rows, q, n)
+
+    def score_matrix(self, qs: np.ndarray) -> Optional[np.ndarray]:
+        """
+        多筆查詢的全表分數 (len(qs), rows)；不適合整表掃描的後端回傳 None，
+        呼叫端改為逐筆 search()。
+        """
+        return None
+
+
+class ExactSearch(_Backend):
+    name = "exact"
+
+    def __init__(self, vecs: np.ndarray):
+        self.vecs = vecs
+
+    def search(self, q: np.ndarray, n: int) -> Hits:
+        return topn(self.vecs @ q, n)
+
+    def score_matrix(self, qs: np.ndarray) -> Optional[np.ndarray]:
+        return np.asarray(self.vecs @ np.asarray(qs, dtype=np.float32).T, dtype=np.float32).T
+
+
+class IVFSearch(_Backend):
+    """
+    Inverted File Index：
+    1) 用 spherical k-means 把向量分成 n_lists 群
+    2) 每群的 row id 連續存在 `_order` 中，`_offsets[c]:_offsets[c+1]` 即第 c 群
+    3) 查詢時只掃描與 q 最相近的 n_probe 群
+    """
+    name = "ivf"
+
+    def __init__(
+        self,
+        vecs: np.ndarray,
+        n_lists: Optional[int] = None,
+        n_probe: int = 8,
+        n_iter: int = 10,
+        sample_size: int = 50_000,
+        seed: int = 0,
+    ):
+        self.vecs = vecs
+        rows = int(vecs.shape[0])
+        self.n_lists = max(1, min(rows, n_lists or int(np.sqrt(max(rows, 1)))))
+        self.n_probe = max(1, min(int(n_probe), self.n_lists))
+
+        t0 = time.perf_counter()
+        rng = np.random.default_rng(seed)
+        self.centroids = self._train(rng, n_iter, sample_size)
+        assign = self._assign(self.centroids)
+        self._order = np.argsort(assign, kind="stable").astype(np.int64)
+        counts = np.bincount(assign, minlength=self.n_lists)
+        self._offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        logger.info(
+            "IVF index built: %d rows, %d lists, n_probe=%d in %.2fs",
+            rows, self.n_lists, self.n_probe, time.perf_counter() - t0,
+        )
+
+    # ---- 建索引 ----
+    def _train(self, rng: np.random.Generator, n_iter: int, sample_size: int) -> np.ndarray:
+        rows = len(self)
+        take = min(rows, max(sample_size, self.n_lists))
+        sample_idx = np.sort(rng.choice(rows, size=take, replace=False))
+        sample = np.asarray(self.vecs[sample_idx], dtype=np.float32)
+        cents = sample[rng.choice(take, size=self.n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            labels = np.argmax(sample @ cents.T, axis=1)
+            for c in range(self.n_lists):
+                members = sample[labels == c]
+                if len(members):
+                    cents[c] = members.sum(axis=0)
+                else:
+                    # 空群：重新挑一個樣本當中心，避免整群報廢
+                    cents[c] = sample[rng.integers(take)]
+            cents /= np.linalg.norm(cents, axis=1, keepdims=True) + 1e-9
+        return cents
+
+    def _assign(self, cents: np.ndarray, block: int = 16_384) -> np.ndarray:
+        out = np.empty(len(self), dtype=np.int64)
+        for start in range(0, len(self), block):
+            chunk = np.asarray(self.vecs[start:start + block], dtype=np.float32)
+            out[start:start + block] = np.argmax(chunk @ cents.T, axis=1)
+        return out
+
+    # ---- 查詢 ----
+    def candidates(self, q: np.ndarray) -> np.ndarray:
+        cent_sims = self.centroids @ q
+        probe, _ = topn(cent_sims, self.n_probe)
+        parts = [self._order[self._offsets[c]:self._offsets[c + 1]] for c in probe]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def search(self, q: np.ndarray, n: int) -> Hits:
+        cand = self.candidates(q)
+        if cand.size == 0:
+            return cand, np.empty(0, dtype=np.float32)
+        local, sims = topn(self.vecs[cand] @ q, n)
+        return cand[local], sims
+
+
+class QuantizedSearch(_Backend):
+    """
+    兩階段搜尋：
+    1) 以量化副本（int8 + 逐列 scale，或 float16）分塊轉成 float32 後做內積，取前 n*rescore 名
+    2) 只對這些候選讀取 float32 向量重新計分，取前 n
+    float32 矩陣只有候選列會被讀到（memmap 下只載入對應頁面），常駐記憶體以量化副本為主。
+
+    NumPy 沒有 int8 / float16 的 BLAS 內積，第 1 步一定要先轉 float32；
+    轉換寫進一塊重複使用的小緩衝區（block 列，預設 2048 × 768 × 4 ≈ 6 MB，留在快取內），
+    不會每次查詢配置整表大小的暫存。即使如此仍比 float32 全表內積慢
+    （100k × 768：int8 約 1.4 倍、float16 約 7 倍），所以這是省記憶體的選項，不是加速，預設關閉。
+    """
+    name = "quantized"
+
+    def __init__(
+        self,
+        vecs: np.ndarray,
+        qvecs: np.ndarray,
+        scales: Optional[np.ndarray] = None,
+        rescore: int = 4,
+        block: int = 2_048,
+    ):
+        if qvecs.shape != vecs.shape:
+            raise ValueError(f"quantized shape {qvecs.shape} does not match {vecs.shape}")
+        self.vecs = vecs
+        self.qvecs = qvecs
+        self.scales = None if scales is None else np.asarray(scales, dtype=np.float32)
+        self.rescore = max(1, int(rescore))
+        self.block = max(1, int(block))
+        self.mode = str(qvecs.dtype)
+
+    def __len__(self) -> int:
+        return int(self.qvecs.shape[0])
+
+    def approx_scores(self, q: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """量化副本上的近似 cosine；rows 給定時只算這些列。"""
+        q = np.asarray(q, dtype=np.float32)
+        total = len(self) if rows is None else int(rows.shape[0])
+        out = np.empty(total, dtype=np.float32)
+        buf = np.empty((min(self.block, total), self.qvecs.shape[1]), dtype=np.float32)
+        for s in range(0, total, self.block):
+            e = min(total, s + self.block)
+            part = self.qvecs[s:e] if rows is None else self.qvecs[rows[s:e]]
+            np.copyto(buf[:e - s], part, casting="unsafe")
+            np.dot(buf[:e - s], q, out=out[s:e])
+        if self.scales is not None:
+            out *= self.scales if rows is None else self.scales[rows]
+        return out
+
+    def _rescore(self, cand: np.ndarray, q: np.ndarray, n: int) -> Hits:
+        if cand.size == 0:
+            return cand, np.empty(0, dtype=np.float32)
+        cand = np.sort(cand)      # 依列號讀取 float32，對 memmap 較友善
+        local, sims = topn(self.vectors(cand) @ q, n)
+        return cand[local], sims
+
+    def search(self, q: np.ndarray, n: int) -> Hits:
+        cand, _ = topn(self.approx_scores(q), max(n * self.rescore, n))
+        return self._rescore(cand, q, n)
+
+    def search_rows(self, rows: np.ndarray, q: np.ndarray, n: int) -> Hits:
+        if rows.size == 0:
+            return rows, np.empty(0, dtype=np.float32)
+        local, _ = topn(self.approx_scores(q, rows), max(n * self.rescore, n))
+        return self._rescore(rows[local], q, n)
+
+
+_BACKENDS = {
+    ExactSearch.name: ExactSearch,
+    IVFSearch.name: IVFSearch,
+}
+
+
+def build_backend(name: str, vecs: np.ndarray, min_rows: int = 0, **opts):
+    """
+    依名稱建立後端；資料量小於 min_rows 時一律用 exact（小語料分群沒有意義）。
+    """
+    name = (name or ExactSearch.name).lower()
+    if name not in _BACKENDS:
+        raise ValueError(f"unknown search backend: {name!r} (choices: {sorted(_BACKENDS)})")
+    if name == ExactSearch.name or int(vecs.shape[0]) < min_rows:
+        return ExactSearch(vecs)
+    return _BACKENDS[name](vecs, **opts)
+
+
+def search_rows(vecs: np.ndarray, rows: np.ndarray, q: np.ndarray, n: int) -> Hits:
+    """
+    只在指定列（例如時間視窗內的列）中做精確搜尋；成本與 len(rows) 成正比。
+    回傳的索引是全域列號。
+    """
+    if rows.size == 0:
+        return rows, np.empty(0, dtype=np.float32)
+    local, sims = topn(vecs[rows] @ q, n)
+    return rows[local], sims
+
+
+def recall_at_k(backend, reference, queries: Sequence[np.ndarray], k: int) -> float:
+    """以 reference（通常是 ExactSearch）的前 k 為正解，計算 backend 的平均 recall@k。"""
+    if not len(queries):
+        return 0.0
+    total = 0.0
+    for q in queries:
+        truth, _ = reference.search(q, k)
+        got, _ = backend.search(q, k)
+        if len(truth):
+            total += len(np.intersect1d(truth, got)) / len(truth)
+    return total / len(queries)
+
+
+def backend_stats(backend) -> Dict[str, object]:
+    stats: Dict[str, object] = {"backend": backend.name, "rows": len(backend)}
+    if isinstance(backend, IVFSearch):
+        stats.update({"n_lists": backend.n_lists, "n_probe": backend.n_probe})
+    elif isinstance(backend, QuantizedSearch):
+        stats.update({"quantization": backend.mode, "rescore": backend.rescore})
+    return stats
+
+
+__all__ = [
+    "ExactSearch",
+    "IVFSearch",
+    "QuantizedSearch",
+    "build_backend",
+    "search_rows",
+    "recall_at_k",
+    "backend_stats",
+]
@@ -0,0 +1,155 @@
+# NCUACG/assistant/services/semantic_cache.py
+from __future__ import annotations
+
+import hashlib
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .query_cache import normalize_query
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 語意回覆快取
+# 同一件事的不同問法（「社博幾號?」「社團博覽會哪天」）精確快取不會命中，
+# 但 retriever 已經算好 E5 查詢向量：拿它跟最近的問題比 cosine，
+# 超過門檻、且送給 LLM 的 system prompt（persona + 站內脈絡）完全相同時，沿用上次的回覆。
+#
+# - 固定容量的 ring buffer（向量矩陣預先配置），查詢是一次 rows @ q 的掃描
+# - context_key 相同才比較：system prompt 內含檢索到的段落全文，key 相同即代表兩次檢索到
+#   同一組來源；索引重建或 personas.json 改動後脈絡不同，自然不會命中
+# - 字面守門（query_guard）：cosine 過門檻還要兩個問題裡的數字與英數詞完全相同。
+#   E5 對「2024 / 2025」「7/12 / 8/30」「3 點 / 5 點」這類差異幾乎不敏感，
+#   這正是同一組脈絡下最容易答錯的情況；中文換句話說（社博幾號 / 社團博覽會哪天）不受影響。
+#   被守門擋下的候選計入 stats 的 guard_rejects，上線後可據此調整門檻。
+# - 行程內快取；跨 worker 共用交給精確快取（response_cache.py）
+_GUARD_RE = re.compile(r"[0-9]+|[a-z][a-z0-9]*")
+
+
+def context_key(*parts: Any) -> int:
+    """把 (model, temperature, system prompt…) 壓成 63-bit 整數，存進 int64 陣列做向量化比對。"""
+    raw = "\x1f".join(str(p) for p in parts).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), "little") >> 1
+
+
+def query_guard(text: str) -> frozenset:
+    """問題中的數字與英數詞（NFKC 正規化、小寫）；兩個問題的 guard 不同就不共用回覆。"""
+    return frozenset(_GUARD_RE.findall(normalize_query(text)))
+
+
+class SemanticCache:
+    def __init__(self, capacity: int = 1024, threshold: float = 0.95, ttl: float = 600.0):
+        self.capacity = int(capacity)
+        self.threshold = float(threshold)
+        self.ttl = float(ttl)
+        self._lock = threading.Lock()
+        self._vecs: Optional[np.ndarray] = None              # 第一次寫入時依維度配置
+        self._keys = np.zeros(max(self.capacity, 0), dtype=np.int64)
+        self._expires = np.zeros(max(self.capacity, 0), dtype=np.float64)
+        self._latency_ms = np.zeros(max(self.capacity, 0), dtype=np.float64)
+        self._replies: List[Optional[str]] = [None] * max(self.capacity, 0)
+        self._guards: List[Optional[frozenset]] = [None] * max(self.capacity, 0)
+        self._next = 0
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_ms = 0.0
+        self.lookup_ms = 0.0
+        self.guard_rejects = 0
+        self._hit_sim = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    @staticmethod
+    def _unit(vec: np.ndarray) -> np.ndarray:
+        v = np.asarray(vec, dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(v))
+        return v / norm if norm > 0 else v
+
+    def lookup(self, vec: np.ndarray, key: int, query: Optional[str] = None) -> Optional[Tuple[str, float]]:
+        """
+        回傳 (reply, cosine)；沒有超過門檻的同脈絡項目時回傳 None。
+        query 給定時，候選還要通過字面守門（依 cosine 由高到低找第一個通過的）。
+        """
+        if not self.enabled:
+            return None
+        t0 = time.perf_counter()
+        q = self._unit(vec)
+        guard = query_guard(query) if query is not None else None
+        found: Optional[Tuple[str, float]] = None
+        with self._lock:
+            n = self._size
+            if n and self._vecs is not None and self._vecs.shape[1] == q.shape[0]:
+                valid = (self._keys[:n] == key) & (self._expires[:n] > time.monotonic())
+                if valid.any():
+                    # 連續區塊整段內積（BLAS）比先挑列再算快；不符的列再遮掉
+                    sims = np.where(valid, self._vecs[:n] @ q, -np.inf)
+                    above = np.flatnonzero(sims >= self.threshold)
+                    for row in above[np.argsort(-sims[above], kind="stable")]:
+                        stored = self._guards[row]
+                        if guard is not None and stored is not None and stored != guard:
+                            self.guard_rejects += 1
+                            continue
+                        found = (self._replies[row] or "", float(sims[row]))
+                        self.saved_ms += float(self._latency_ms[row])
+                        self._hit_sim += float(sims[row])
+                        break
+            if found is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.lookup_ms += (time.perf_counter() - t0) * 1000.0
+        return found
+
+    def add(
+        self, vec: np.ndarray, key: int, reply: str, latency_ms: float = 0.0, query: Optional[str] = None,
+    ) -> None:
+        """寫入一筆；latency_ms 為這次 LLM 呼叫的耗時，之後命中時累計為省下的延遲。"""
+        if not self.enabled or not reply:
+            return
+        q = self._unit(vec)
+        with self._lock:
+            if self._vecs is None or self._vecs.shape[1] != q.shape[0]:
+                # 第一次寫入，或換了 embedding 模型（維度改變）：重新配置
+                self._vecs = np.zeros((self.capacity, q.shape[0]), dtype=np.float32)
+                self._size = self._next = 0
+            row = self._next
+            self._vecs[row] = q
+            self._keys[row] = key
+            self._expires[row] = time.monotonic() + self.ttl
+            self._latency_ms[row] = float(latency_ms)
+            self._replies[row] = reply
+            self._guards[row] = query_guard(query) if query is not None else None
+            self._next = (row + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._size = self._next = 0
+            self._replies = [None] * self.capacity
+            self._guards = [None] * self.capacity
+            self.hits = self.misses = self.guard_rejects = 0
+            self.saved_ms = self.lookup_ms = self._hit_sim = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": self._size,
+            "capacity": self.capacity,
+            "threshold": self.threshold,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "guard_rejects": self.guard_rejects,
+            "saved_ms": round(self.saved_ms, 1),
+            "avg_hit_similarity": round(self._hit_sim / self.hits, 4) if self.hits else None,
+            "avg_lookup_ms": round(self.lookup_ms / total, 4) if total else 0.0,
+        }
+
+
+__all__ = ["context_key", "query_guard", "SemanticCache"]
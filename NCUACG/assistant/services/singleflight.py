@@ -0,0 +1,256 @@
+# NCUACG/assistant/services/singleflight.py
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Single-flight：相同 key 的併發請求只算一次
+# 置頂公告後幾十個人在幾秒內問同一句話；每個請求各自 encode、檢索、呼叫 Groq，
+# 既浪費又容易撞到 Groq 的 rate limit。
+#
+# - SingleFlight：行程內。第一個請求（leader）負責計算，之後同 key 的請求（follower）
+#   等它的結果（或例外）；計算結束就從表中移除，不是快取。同步（執行緒）與 async 各一套。
+# - SharedLock：跨 worker。以共用 Django cache 的 add()（不存在才寫入）當鎖，
+#   拿不到鎖的 worker 輪詢結果（通常是共用回覆快取），鎖釋放或逾時就自己算。
+
+
+class _Call:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._acalls: Dict[Tuple[int, str], "asyncio.Future[Any]"] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key: str, fn: Callable[[], T]) -> T:
+        if not self.enabled:
+            return fn()
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = fn()
+            return call.value
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        if not self.enabled:
+            return await fn()
+        loop = asyncio.get_running_loop()
+        slot = (id(loop), key)       # Future 只能在建立它的事件迴圈裡等待
+        counted = False
+        while True:
+            fut = self._acalls.get(slot)
+            if fut is None:
+                break
+            if not counted:
+                self.followers += 1
+                counted = True
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if fut.cancelled():
+                    continue        # leader 的連線斷了：重新競選，不要跟著失敗
+                raise
+        fut = loop.create_future()
+        self._acalls[slot] = fut
+        self.leaders += 1
+        try:
+            value = await fn()
+            fut.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()          # 沒有 follower 時也不要出現 "exception was never retrieved"
+            raise
+        finally:
+            self._acalls.pop(slot, None)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.leaders + self.followers
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._calls) + len(self._acalls),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "coalesced_rate": round(self.followers / total, 4) if total else 0.0,
+        }
+
+
+class SharedLock:
+    """
+    跨 worker 的 single-flight 鎖（Django cache 的 add 為原子操作：Redis SET NX、Memcached add）。
+    lock_ttl 要大於一次 LLM 呼叫的上限，leader 當掉時鎖會自動過期。
+    釋放時先比對 token 再刪，只是盡力避免刪到別人的鎖（get + delete 非原子）。
+    """
+
+    def __init__(
+        self,
+        alias: Optional[str] = None,
+        lock_ttl: float = 30.0,
+        wait: float = 20.0,
+        poll: float = 0.1,
+        key_prefix: str = "assistant:flight:",
+    ):
+        self.alias = alias or None
+        self.lock_ttl = float(lock_ttl)
+        self.wait_seconds = float(wait)
+        self.poll = float(poll)
+        self.key_prefix = key_prefix
+        self.acquired = 0
+        self.waited = 0
+        self.served_by_peer = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.alias is not None
+
+    def _backend(self) -> Any:
+        if not self.enabled:
+            return None
+        try:
+            from django.core.cache import caches
+            return caches[self.alias]
+        except Exception:
+            logger.warning("shared single-flight cache %r unavailable; using in-process only", self.alias)
+            self.alias = None
+            return None
+
+    # ---- 同步 ----
+    def acquire(self, key: str) -> Optional[str]:
+        """拿到鎖回傳 token；被別的 worker 持有時回傳 None。後端不可用時視為拿到（不擋請求）。"""
+        backend = self._backend()
+        token = uuid.uuid4().hex
+        if backend is None:
+            return token
+        try:
+            if backend.add(self.key_prefix + key, token, timeout=int(self.lock_ttl) or 1):
+                self.acquired += 1
+                return token
+            return None
+        except Exception:
+            return token
+
+    def release(self, key: str, token: str) -> None:
+        backend = self._backend()
+        if backend is None:
+            return
+        try:
+            if backend.get(self.key_prefix + key) == token:
+                backend.delete(self.key_prefix + key)
+        except Exception:
+            pass
+
+    def wait(self, key: str, ready: Callable[[], Optional[T]]) -> Optional[T]:
+        """輪詢 ready() 直到有結果；鎖被釋放（或逾時）仍沒有結果就回傳 None，由呼叫端自己算。"""
+        backend = self._backend()
+        self.waited += 1
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            value = ready()
+            if value is not None:
+                self.served_by_peer += 1
+                return value
+            try:
+                held = backend is not None and backend.get(self.key_prefix + key) is not None
+            except Exception:
+                held = False
+            if not held or time.monotonic() >= deadline:
+                value = ready()   # 釋放前剛寫入的結果
+                if value is not None:
+                    self.served_by_peer += 1
+                return value
+            time.sleep(self.poll)
+
+    # ---- 非同步 ----
+    async def aacquire(self, key: str) -> Optional[str]:
+        backend = self._backend()
+        token = uuid.uuid4().hex
+        if backend is None:
+            return token
+        try:
+            if await backend.aadd(self.key_prefix + key, token, timeout=int(self.lock_ttl) or 1):
+                self.acquired += 1
+                return token
+            return None
+        except Exception:
+            return token
+
+    async def arelease(self, key: str, token: str) -> None:
+        backend = self._backend()
+        if backend is None:
+            return
+        try:
+            if await backend.aget(self.key_prefix + key) == token:
+                await backend.adelete(self.key_prefix + key)
+        except Exception:
+            pass
+
+    async def await_result(self, key: str, ready: Callable[[], Awaitable[Optional[T]]]) -> Optional[T]:
+        backend = self._backend()
+        self.waited += 1
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            value = await ready()
+            if value is not None:
+                self.served_by_peer += 1
+                return value
+            try:
+                held = backend is not None and await backend.aget(self.key_prefix + key) is not None
+            except Exception:
+                held = False
+            if not held or time.monotonic() >= deadline:
+                value = await ready()
+                if value is not None:
+                    self.served_by_peer += 1
+                return value
+            await asyncio.sleep(self.poll)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.alias,
+            "acquired": self.acquired,
+            "waited": self.waited,
+            "served_by_peer": self.served_by_peer,
+        }
+
+
+__all__ = ["SingleFlight", "SharedLock"]
@@ -0,0 +1,173 @@
+# NCUACG/assistant/services/timeparse.py
+from __future__ import annotations
+
+import re
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 文件開始時間解析（retriever 與 scripts/build_emb.py 共用，不依賴 Django）
+# build_emb 在建索引時就把每筆 doc 的開始時間算成 int64 epoch 秒欄位，
+# retriever 查詢時只做向量化比較，不再逐筆 parse。
+
+# ====== 時間解析輔助 ======
+_ISO_CANDIDATES = (
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d %H:%M:%S",
+)
+
+def _to_dt_aware(dt: datetime) -> datetime:
+    """確保 datetime 是有時區的（統一轉成 UTC aware）。"""
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+def _parse_dt(value: Any) -> Optional[datetime]:
+    """
+    盡力從 doc 的欄位值解析時間。
+    支援：
+    - ISO 8601（含時區）
+    - 常見日期格式（見 _ISO_CANDIDATES）
+    - '2025/08/30 18:00'、'2025.08.30' 等常見變體（以正規化方式嘗試）
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        # 若是 Unix timestamp（秒）
+        try:
+            return _to_dt_aware(datetime.fromtimestamp(float(value), tz=timezone.utc))
+        except Exception:
+            return None
+    if isinstance(value, datetime):
+        return _to_dt_aware(value)
+    if not isinstance(value, str):
+        return None
+
+    s = value.strip()
+    if not s:
+        return None
+
+    # 1) 嘗試原字串用 fromisoformat（Python 3.11+ 支援 ±HH:MM）
+    try:
+        return _to_dt_aware(datetime.fromisoformat(s))
+    except Exception:
+        pass
+
+    # 2) 嘗試替換常見分隔符號，做幾種 pattern
+    s2 = re.sub(r"[./]", "-", s)
+    # 移除多餘空白
+    s2 = re.sub(r"\s+", " ", s2)
+
+    for fmt in _ISO_CANDIDATES:
+        try:
+            return _to_dt_aware(datetime.strptime(s2, fmt))
+        except Exception:
+            continue
+
+    # 3) 嘗試抓出 YYYY-MM-DD 或 YYYY-MM-DD HH:MM 的片段
+    m = re.search(r"(\d{4}-\d{2}-\d{2})(?:[ T](\d{2}:\d{2}(?::\d{2})?))?", s2)
+    if m:
+        date_part = m.group(1)
+        time_part = m.group(2) or "00:00"
+        try:
+            return _to_dt_aware(datetime.strptime(f"{date_part} {time_part}", "%Y-%m-%d %H:%M" if len(time_part) == 5 else "%Y-%m-%d %H:%M:%S"))
+        except Exception:
+            pass
+
+    return None
+
+# 從文件物件提取開始時間（支援多鍵）
+_START_KEYS = ("start_time", "start", "date", "datetime", "when", "time")
+
+def _extract_start_dt(doc: Dict[str, Any]) -> Optional[datetime]:
+    meta = doc if isinstance(doc, dict) else {}
+    for key in _START_KEYS:
+        if key in meta:
+            dt = _parse_dt(meta.get(key))
+            if dt:
+                return dt
+    # 也許日期藏在 content 裡，試著掃描
+    text = (meta.get("content") or meta.get("title") or "") if isinstance(meta, dict) else ""
+    dt = _parse_dt(text)
+    if dt is None and "posted" in meta:
+        dt = _month_day_after(meta.get("title") or "", meta.get("posted")) or \
+            _month_day_after(meta.get("content") or "", meta.get("posted"))
+    return dt
+
+# 標題常見「8/30社團博覽會」這種沒有年份的寫法：以發布日補年份，
+# 早於發布日者視為隔年（12 月公告 1/5 的活動）
+_MONTH_DAY_RE = re.compile(r"(?<![\d/])(\d{1,2})/(\d{1,2})(?![\d/])")
+
+def _month_day_after(text: str, posted: Any) -> Optional[datetime]:
+    base = _parse_dt(posted)
+    m = _MONTH_DAY_RE.search(text or "")
+    if base is None or m is None:
+        return None
+    month, day = int(m.group(1)), int(m.group(2))
+    for year in (base.year, base.year + 1):
+        try:
+            dt = base.replace(year=year, month=month, day=day, hour=0, minute=0, second=0, microsecond=0)
+        except ValueError:
+            return None
+        if dt.date() >= base.date():
+            return dt
+    return None
+
+# ====== 預先計算的時間欄位 ======
+# 與 numpy datetime64 的 NaT 同一個位元樣式；任何「>= now」比較都會是 False
+NAT = np.iinfo(np.int64).min
+
+def start_ts_column(docs: Iterable[Dict[str, Any]]) -> np.ndarray:
+    """把每筆 doc 的開始時間轉成 int64 epoch 秒；解析不到者為 NAT。"""
+    out = []
+    for d in docs:
+        dt = _extract_start_dt(d)
+        out.append(int(dt.timestamp()) if dt else NAT)
+    return np.asarray(out, dtype=np.int64)
+
+def ts_to_dt(ts: int) -> Optional[datetime]:
+    """start_ts 欄位的單一值 → aware datetime（UTC）；NAT → None。"""
+    ts = int(ts)
+    if ts == NAT:
+        return None
+    return datetime.fromtimestamp(ts, tz=timezone.utc)
+
+class TimeIndex:
+    """
+    依開始時間排序的列索引：有時間的列依 start_ts 由早到晚排好，
+    查詢 [lo, hi] 只需兩次二分搜尋，成本與視窗內筆數成正比，不必掃描整個欄位。
+    """
+
+    def __init__(self, start_ts: np.ndarray):
+        start_ts = np.asarray(start_ts, dtype=np.int64)
+        dated = np.flatnonzero(start_ts != NAT)
+        order = np.argsort(start_ts[dated], kind="stable")
+        self._rows = dated[order].astype(np.int64)
+        self._ts = np.ascontiguousarray(start_ts[self._rows])
+
+    def __len__(self) -> int:
+        return int(self._rows.shape[0])
+
+    def rows_between(self, lo: int, hi: int) -> np.ndarray:
+        """回傳 start_ts 落在 [lo, hi] 的列（依列號排序，讓後續向量讀取較連續）。"""
+        a = int(np.searchsorted(self._ts, lo, side="left"))
+        b = int(np.searchsorted(self._ts, hi, side="right"))
+        if a >= b:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(self._rows[a:b])
+
+# 對外名稱（底線版本保留給既有呼叫端）
+parse_dt = _parse_dt
+extract_start_dt = _extract_start_dt
+
+__all__ = [
+    "NAT",
+    "parse_dt",
+    "extract_start_dt",
+    "start_ts_column",
+    "ts_to_dt",
+    "TimeIndex",
+]
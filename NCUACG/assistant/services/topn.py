@@ -0,0 +1,49 @@
+# NCUACG/assistant/services/topn.py
+from __future__ import annotations
+
+from typing import Tuple
+
+import numpy as np
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Top-n 選取：argpartition（O(N)）先挑出 n 個，再只排序這 n 個（O(n log n)）。
+# 取代 `scores.argsort()[::-1][:n]` 的整表排序 + 反轉複製。
+# 回傳順序一律為分數由高到低。
+
+
+def topn(scores: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """單一查詢：回傳 (索引, 分數)，依分數由高到低。"""
+    total = int(scores.shape[0])
+    n = min(int(n), total)
+    if n <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=scores.dtype)
+    if n < total:
+        part = np.argpartition(scores, total - n)[total - n:]
+    else:
+        part = np.arange(total)
+    order = np.argsort(scores[part])[::-1]
+    idxs = part[order]
+    return idxs, scores[idxs]
+
+
+def topn_batch(scores: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    多筆查詢：scores 形狀 (Q, N)，回傳 (Q, n) 的索引與分數，每列由高到低。
+    """
+    if scores.ndim != 2:
+        raise ValueError(f"topn_batch expects a 2-D array, got shape {scores.shape}")
+    q, total = scores.shape
+    n = min(int(n), total)
+    if n <= 0:
+        return np.empty((q, 0), dtype=np.int64), np.empty((q, 0), dtype=scores.dtype)
+    if n < total:
+        part = np.argpartition(scores, total - n, axis=1)[:, total - n:]
+    else:
+        part = np.broadcast_to(np.arange(total), (q, total))
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(part_scores, axis=1)[:, ::-1]
+    idxs = np.take_along_axis(part, order, axis=1)
+    return idxs, np.take_along_axis(part_scores, order, axis=1)
+
+
+__all__ = ["topn", "topn_batch"]
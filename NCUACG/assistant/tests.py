@@ -1,3 +1,935 @@
-from django.test import TestCase
+# NCUACG/assistant/tests.py
+from __future__ import annotations
 
-# Create your tests here.
+import asyncio
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Sequence
+from unittest import mock
+
+import httpx
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.test import AsyncRequestFactory, SimpleTestCase
+from django.urls import Resolver404, resolve
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from . import views
+from .services import index_store, llama_client, retriever
+from .services.batch_encoder import BatchingEncoder
+from .services.chunking import carry_meta, chunk_sentences, estimate_tokens, split_sentences
+from .services.context_builder import SEPARATOR, build_context, parent_key
+from .services.dedup import Deduplicator, dedup_docs
+from .services.lexical import BM25Builder, BM25Index, build_bm25, doc_text, rrf_fuse, tokenize
+from .services.semantic_cache import SemanticCache, query_guard
+from .services.singleflight import SingleFlight
+from .services.timeparse import NAT, TimeIndex, extract_start_dt, start_ts_column
+from .services.topn import topn, topn_batch
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 全部是 SimpleTestCase，不連資料庫：DB_NAME=x GROQ_API_KEY=x python manage.py test assistant
+# 測試用的假模型：不載入 E5、不連 Groq
+# - 假 encoder：字元 bigram 雜湊成 64 維詞袋向量（字面相近的文字 cosine 高），結果固定
+# - 同步 Groq：行程內的假 client（同步 / 串流 create()），記錄呼叫次數，可設延遲或例外
+# - 非同步 Groq：真的 AsyncGroq + httpx 連線池，打到背景執行緒裡的 scripts/groq_stub.py
+_DIM = 64
+_REPLY = "這是測試回覆。"
+
+
+def _fake_vec(text: str) -> np.ndarray:
+    v = np.zeros(_DIM, dtype=np.float32)
+    for tok in tokenize(text):
+        v[int.from_bytes(hashlib.blake2b(tok.encode("utf-8"), digest_size=4).digest(), "little") % _DIM] += 1.0
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm else v
+
+
+def _fake_encode(texts: Sequence[str]) -> np.ndarray:
+    return np.stack([_fake_vec(t) for t in texts]).astype(np.float32)
+
+
+def _chunk(content: str = "", usage: Any = None) -> SimpleNamespace:
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content else []
+    return SimpleNamespace(choices=choices, x_groq=SimpleNamespace(usage=usage) if usage else None, usage=None)
+
+
+class _FakeCompletions:
+    def __init__(self, delay: float = 0.0, error: BaseException = None, stream_error: BaseException = None):
+        self.delay = delay
+        self.error = error
+        self.stream_error = stream_error
+        self.calls = 0
+        self.messages: List[List[Dict[str, str]]] = []
+        self._lock = threading.Lock()
+
+    def _record(self, messages) -> None:
+        with self._lock:
+            self.calls += 1
+            self.messages.append(messages)
+
+    def _reply(self) -> SimpleNamespace:
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=_REPLY))])
+
+    def _stream(self):
+        yield _chunk("這是")
+        if self.stream_error is not None:
+            raise self.stream_error
+        yield _chunk("測試回覆。")
+        yield _chunk(usage={"prompt_tokens": 12, "completion_tokens": 5})
+
+    def create(self, model, messages, temperature, stream=False):
+        self._record(messages)
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self._stream() if stream else self._reply()
+
+
+def _client(completions: _FakeCompletions) -> SimpleNamespace:
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+
+def _load_script(name: str):
+    """載入 scripts/<name>.py（scripts/ 不是 package）；腳本自己的 logging.basicConfig 不套用到測試。"""
+    path = Path(settings.BASE_DIR).parent / "scripts" / f"{name}.py"
+    spec = importlib.util.spec_from_file_location(f"scripts_{name}", path)
+    module = importlib.util.module_from_spec(spec)
+    with mock.patch("logging.basicConfig"):
+        spec.loader.exec_module(module)
+    return module
+
+
+class _GroqStub:
+    """在背景執行緒跑 scripts/groq_stub.py（隨機 port）；served / peak 由 stub 的 /stats 讀出。"""
+
+    REPLY = "這是 stub 的回覆。"
+
+    def __init__(self, delay: float = 0.05):
+        stub = _load_script("groq_stub")
+        self.server = stub.ThreadingHTTPServer(("127.0.0.1", 0), stub.make_handler(self.REPLY, delay))
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stats(self) -> Dict[str, int]:
+        return httpx.get(f"{self.url}/stats").json()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+
+def _notice_docs() -> List[Dict[str, Any]]:
+    now = timezone.now()
+    return [
+        {"source": "notice", "id": 1, "title": "社團博覽會", "start_time": (now + timedelta(days=10)).isoformat(),
+         "content": "社團博覽會在中大湖畔舉辦，歡迎新生來動漫社攤位參觀。"},
+        {"source": "notice", "id": 2, "title": "停車場施工公告", "start_time": (now + timedelta(days=3)).isoformat(),
+         "content": "校內停車場施工，機車請改停體育館旁。"},
+        {"source": "notice", "id": 3, "title": "期末檢討會", "start_time": (now - timedelta(days=60)).isoformat(),
+         "content": "期末檢討會在社辦舉行，請幹部準時出席。"},
+        {"source": "about", "title": "社團介紹",
+         "content": "本社以動畫、漫畫、輕小說的討論與創作為主，每週都有社課。"},
+        {"source": "notice", "id": 5, "title": "社團博覽會攤位", "start_time": (now + timedelta(days=9)).isoformat(),
+         "content": "社團博覽會攤位請在前一天下午布置完成。"},
+    ]
+
+
+def _write_fake_index(path: Path, docs: List[Dict[str, Any]]) -> index_store.IndexHeader:
+    vecs = _fake_encode([f"{d.get('title', '')} {d.get('content', '')}" for d in docs])
+    return index_store.write_index(
+        path, vecs, docs, model="fake-e5", columns={"start_ts": start_ts_column(docs)},
+    )
+
+
+class _AssistantTestCase(SimpleTestCase):
+    """
+    每個測試用暫存目錄裡的小索引 + 假 encoder + 假 Groq（非同步走 groq_stub）；
+    回覆快取、語意快取、查詢向量快取都清空，測試之間互不影響。
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.stub = _GroqStub()
+        cls.addClassCleanup(cls.stub.close)
+
+    def setUp(self) -> None:
+        super().setUp()
+        tmp = Path(tempfile.mkdtemp(prefix="assistant-test-"))
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        self.docs = _notice_docs()
+        _write_fake_index(tmp / "index", self.docs)
+
+        self.completions = _FakeCompletions()
+        for target, attr, value in (
+            (retriever, "INDEX_DIR", tmp / "index"),
+            (retriever, "_INDEX", None),
+            (retriever, "_RELOAD_SECONDS", 0.0),
+            (retriever, "_encode_queries", _fake_encode),
+            (retriever, "_get_batcher", lambda: None),
+            (llama_client, "client", _client(self.completions)),
+            (llama_client, "_BASE_URL", self.stub.url),
+        ):
+            patcher = mock.patch.object(target, attr, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        env = mock.patch.dict(os.environ, {"GROQ_API_KEY": "stub"})
+        env.start()
+        self.addCleanup(env.stop)
+        retriever._QUERY_CACHE.clear()
+        llama_client._SEMANTIC_CACHE.clear()
+        caches["assistant"].clear()
+
+    def post_json(self, url: str, body: Dict[str, Any]):
+        return self.client.post(url, data=json.dumps(body), content_type="application/json")
+
+    def stub_served(self) -> int:
+        return self.stub.stats()["served"]
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 索引檔
+class IndexStoreTests(SimpleTestCase):
+    def setUp(self) -> None:
+        self.dir = Path(tempfile.mkdtemp(prefix="assistant-index-"))
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+
+    def _data_files(self) -> set:
+        return {p.name for p in self.dir.iterdir() if p.name != index_store.HEADER_NAME}
+
+    def test_roundtrip_and_verify(self):
+        docs = _notice_docs()
+        header = _write_fake_index(self.dir, docs)
+        idx = index_store.open_index(self.dir)
+        self.assertEqual(idx.header.content_hash, header.content_hash)
+        self.assertEqual(idx.docs, docs)
+        np.testing.assert_allclose(np.linalg.norm(idx.vectors, axis=1), 1.0, rtol=1e-5)
+        self.assertEqual(idx.columns["start_ts"].tolist(), start_ts_column(docs).tolist())
+        self.assertTrue(index_store.verify_index(self.dir))
+
+    def test_corrupted_vectors_fail_verification(self):
+        header = _write_fake_index(self.dir, _notice_docs())
+        with open(self.dir / header.vectors_file, "r+b") as f:
+            f.write(b"\xff\xff\xff\xff")
+        self.assertFalse(index_store.verify_index(self.dir))
+
+    def test_commit_keeps_one_previous_generation(self):
+        docs = _notice_docs()
+        first = _write_fake_index(self.dir, docs)
+        old_header = index_store.read_header(self.dir)
+        second = _write_fake_index(self.dir, docs[:3])
+        self.assertNotEqual(first.content_hash, second.content_hash)
+        # 拿到舊 header 的讀者在下一次提交前仍讀得到舊資料
+        self.assertEqual(len(index_store._read_docs(self.dir / old_header.docs_file)), len(docs))
+        self.assertLessEqual(index_store._generation_files(first), self._data_files())
+        third = _write_fake_index(self.dir, docs[:2])
+        self.assertEqual(self._data_files(), index_store._generation_files(second) | index_store._generation_files(third))
+        self.assertEqual(index_store.read_header(self.dir).count, 2)
+
+    def test_failed_build_keeps_committed_index(self):
+        docs = _notice_docs()
+        header = _write_fake_index(self.dir, docs)
+        before = self._data_files()
+        with self.assertRaises(RuntimeError):
+            with index_store.IndexWriter(self.dir, model="fake-e5") as w:
+                w.append(_fake_encode(["x"]), [{"content": "x"}])
+                raise RuntimeError("build failed")
+        self.assertEqual(self._data_files(), before)
+        self.assertEqual(index_store.read_header(self.dir).content_hash, header.content_hash)
+        self.assertTrue(index_store.verify_index(self.dir))
+
+
+class Float16IndexTests(_AssistantTestCase):
+    def test_float16_vectors_are_converted_once_at_load(self):
+        docs = _notice_docs()
+        vecs = _fake_encode([f"{d['title']} {d['content']}" for d in docs])
+        index_store.write_index(retriever.INDEX_DIR, vecs, docs, model="fake-e5", dtype="float16")
+        index = retriever._get_index()
+        self.assertEqual(index.vecs.dtype, np.float32)
+        self.assertTrue(index.vecs.flags["C_CONTIGUOUS"])
+        self.assertNotIsInstance(index.vecs, np.memmap)
+        np.testing.assert_allclose(index.vecs, vecs, atol=1e-3)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 檢索元件
+class TopNTests(SimpleTestCase):
+    def test_returns_highest_scores_in_order(self):
+        scores = np.array([0.1, 0.9, 0.3, 0.7, 0.5], dtype=np.float32)
+        idxs, top = topn(scores, 3)
+        self.assertEqual(idxs.tolist(), [1, 3, 4])
+        np.testing.assert_allclose(top, [0.9, 0.7, 0.5])
+
+    def test_n_larger_than_size_and_non_positive(self):
+        scores = np.array([0.2, 0.8], dtype=np.float32)
+        self.assertEqual(topn(scores, 10)[0].tolist(), [1, 0])
+        self.assertEqual(topn(scores, 0)[0].size, 0)
+
+    def test_batch_matches_single(self):
+        scores = np.random.default_rng(0).random((4, 50)).astype(np.float32)
+        idxs, _ = topn_batch(scores, 5)
+        for row, got in zip(scores, idxs):
+            self.assertEqual(got.tolist(), topn(row, 5)[0].tolist())
+
+
+class SearchBatchTests(_AssistantTestCase):
+    def test_search_batch_matches_search(self):
+        queries = ["社團博覽會在哪裡", "停車場施工", "社課時間", "期末檢討會"]
+        batch = retriever.search_batch(queries, k=3)
+        for q, got in zip(queries, batch):
+            want = retriever.search(q, k=3)
+            self.assertEqual([h.row for h in got.hits], [h.row for h in want.hits], q)
+            np.testing.assert_allclose([h.score for h in got.hits], [h.score for h in want.hits], rtol=1e-5)
+
+    def test_repeated_queries_are_encoded_once(self):
+        with mock.patch.object(retriever, "_encode_queries", wraps=_fake_encode) as enc:
+            retriever.search_batch(["社課時間", "社課時間", "停車場施工"], k=2)
+        enc.assert_called_once()
+        self.assertEqual(list(enc.call_args.args[0]), ["社課時間", "停車場施工"])
+
+
+class BatchTopNTests(_AssistantTestCase):
+    def test_search_batch_selects_pools_in_one_call_per_block(self):
+        queries = ["社團博覽會在哪裡", "停車場施工", "期末檢討會"]
+        with mock.patch.object(retriever, "topn_batch", wraps=topn_batch) as spy:
+            batch = retriever.search_batch(queries, k=2, time_filter="off")
+        spy.assert_called_once()
+        self.assertEqual(spy.call_args.args[0].shape, (3, len(self.docs)))
+        for q, got in zip(queries, batch):
+            self.assertEqual([h.row for h in got.hits], [h.row for h in retriever.search(q, k=2, time_filter="off").hits])
+
+
+class TimeWindowTests(_AssistantTestCase):
+    def test_rows_between_is_inclusive_and_skips_nat(self):
+        ts = np.array([300, NAT, 100, 200, 400], dtype=np.int64)
+        index = TimeIndex(ts)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.rows_between(100, 300).tolist(), [0, 2, 3])
+        self.assertEqual(index.rows_between(500, 600).size, 0)
+
+    def test_month_day_title_takes_year_from_posting_date(self):
+        dt = extract_start_dt({"title": "8/30社團博覽會", "posted": "2025-07-16"})
+        self.assertEqual((dt.year, dt.month, dt.day), (2025, 8, 30))
+        # 早於發布日的月/日視為隔年
+        dt = extract_start_dt({"title": "1/5 新年會", "posted": "2025-12-20"})
+        self.assertEqual((dt.year, dt.month, dt.day), (2026, 1, 5))
+        # 發布日本身不是活動開始時間
+        self.assertIsNone(extract_start_dt({"title": "系統維護公告", "posted": "2025-07-11"}))
+
+    def test_unrelated_upcoming_notice_does_not_jump_the_queue(self):
+        result = retriever.search("社團博覽會在哪裡", k=3)
+        titles = [h.doc["title"] for h in result.hits]
+        self.assertIn(titles[0], ("社團博覽會", "社團博覽會攤位"))
+        self.assertNotEqual(titles[0], "停車場施工公告")   # 在視窗內、開始得最早，但不相關
+
+    def test_prefilter_returns_only_window_rows_by_start_time(self):
+        result = retriever.search("公告", k=3, time_filter="prefilter")
+        starts = [h.start for h in result.hits]
+        self.assertTrue(all(s is not None and s >= timezone.now() for s in starts))
+        self.assertEqual(starts, sorted(starts))
+
+
+class LexicalTests(SimpleTestCase):
+    def test_bm25_ranks_matching_document_first(self):
+        bm25 = build_bm25(["停車場施工公告", "社團博覽會攤位說明", "期末檢討會"])
+        idxs, scores = bm25.search("博覽會在哪", 3)
+        self.assertEqual(int(idxs[0]), 1)
+        self.assertTrue(np.all(np.diff(scores) <= 0))
+
+    def test_bm25_rows_filter(self):
+        bm25 = build_bm25(["社團博覽會", "社團博覽會攤位", "期末檢討會"])
+        idxs, _ = bm25.search("社團博覽會", 3, rows=np.array([1, 2]))
+        self.assertEqual(idxs.tolist(), [1])
+
+    def test_rrf_prefers_documents_ranked_high_in_both_lists(self):
+        fused, scores = rrf_fuse([np.array([3, 1, 2]), np.array([1, 4, 3])], k0=60.0)
+        self.assertEqual(int(fused[0]), 1)
+        self.assertEqual(set(fused.tolist()), {1, 2, 3, 4})
+        self.assertTrue(np.all(np.diff(scores) <= 0))
+
+
+class ChunkingTests(SimpleTestCase):
+    TEXT = "社團博覽會在九月舉辦。攤位在中大湖畔。請幹部提前布置！當天有抽獎活動。歡迎新生參觀？"
+
+    def test_split_keeps_trailing_punctuation(self):
+        self.assertEqual(
+            split_sentences(self.TEXT),
+            ["社團博覽會在九月舉辦。", "攤位在中大湖畔。", "請幹部提前布置！", "當天有抽獎活動。", "歡迎新生參觀？"],
+        )
+
+    def test_chunks_respect_budget_and_overlap(self):
+        chunks = chunk_sentences(self.TEXT, max_tokens=20, overlap_tokens=10)
+        self.assertGreater(len(chunks), 1)
+        for c in chunks:
+            self.assertLessEqual(estimate_tokens(c), 20)
+        for prev, nxt in zip(chunks, chunks[1:]):
+            self.assertTrue(nxt.startswith(split_sentences(prev)[-1]))
+
+    def test_carry_meta_renames_posting_date(self):
+        meta = carry_meta({"id": 7, "date": "2025-07-16", "type": "", "category": "活動"})
+        self.assertEqual(meta, {"id": 7, "posted": "2025-07-16", "category": "活動"})
+
+
+class ContextBuilderTests(SimpleTestCase):
+    def _hit(self, row: int, start=None, **doc) -> SimpleNamespace:
+        return SimpleNamespace(row=row, start=start, doc=doc)
+
+    def test_untitled_chunks_from_different_documents_stay_apart(self):
+        hits = [
+            self._hit(0, source="about", section=0, content="本社以動畫與漫畫的討論為主。"),
+            self._hit(1, source="notice", id=7, title="社團博覽會", content="攤位在中大湖畔。"),
+            self._hit(2, source="about", section=3, content="每週三晚上有社課。"),
+        ]
+        blocks = build_context(hits).text.split(SEPARATOR)
+        self.assertEqual(blocks, ["本社以動畫與漫畫的討論為主。", "[社團博覽會]\n攤位在中大湖畔。", "每週三晚上有社課。"])
+
+    def test_chunks_of_one_document_share_a_header_in_rank_order(self):
+        hits = [
+            self._hit(0, source="notice", id=7, title="社團博覽會", content="攤位在中大湖畔。"),
+            self._hit(1, source="notice", id=8, title="社團博覽會", content="今年改在體育館。"),
+            self._hit(2, source="notice", id=7, title="社團博覽會", content="請幹部提前布置。"),
+        ]
+        plan = build_context(hits)
+        self.assertEqual(plan.text.split(SEPARATOR), [
+            "[社團博覽會]\n攤位在中大湖畔。\n請幹部提前布置。",
+            "[社團博覽會]\n今年改在體育館。",
+        ])
+        self.assertEqual(plan.rows, [0, 1, 2])
+
+    def test_parent_key_prefers_document_ids(self):
+        self.assertEqual(parent_key({"source": "notice", "id": 7, "slug": "x"}), ("notice", "id", "7"))
+        self.assertEqual(parent_key({"source": "about", "section": 0}), ("about", "section", "0"))
+        self.assertEqual(parent_key({"source": "notice", "title": "社課"}), ("notice", "title", "社課"))
+        self.assertIsNone(parent_key({"source": "introduction", "content": "…"}))
+
+
+class HybridScoreTests(_AssistantTestCase):
+    def _cosines(self, result) -> List[float]:
+        vecs = retriever._get_index().vecs
+        return [float(vecs[h.row] @ result.query_vector) for h in result.hits]
+
+    def test_hits_carry_cosine_and_fused_score_separately(self):
+        for mode in ("pool", "prefilter", "off"):
+            result = retriever.search("社團博覽會在哪裡", k=3, time_filter=mode)
+            np.testing.assert_allclose(result.scores, self._cosines(result), rtol=1e-5, err_msg=mode)
+            self.assertTrue(any(h.fused is not None for h in result.hits), mode)
+            for item, h in zip(result.citations(), result.hits):
+                self.assertEqual(item["score"], round(h.score, 6))
+                self.assertEqual("fused" in item, h.fused is not None)
+
+    def test_window_hits_are_ordered_by_start_then_cosine(self):
+        result = retriever.search("社團博覽會", k=3)
+        dated = [h for h in result.hits if h.start is not None]
+        self.assertEqual([h.start for h in dated], sorted(h.start for h in dated))
+
+    def test_without_lexical_index_no_fused_score(self):
+        with mock.patch.object(retriever, "_HYBRID", False):
+            retriever._INDEX = None
+            result = retriever.search("社團博覽會在哪裡", k=3, time_filter="off")
+        self.assertTrue(all(h.fused is None for h in result.hits))
+        np.testing.assert_allclose(result.scores, self._cosines(result), rtol=1e-5)
+        self.assertEqual(result.scores, sorted(result.scores, reverse=True))
+
+
+class BatchingEncoderTests(SimpleTestCase):
+    def _encoder(self, delay: float = 0.0, **opts) -> BatchingEncoder:
+        calls: List[int] = []
+
+        def encode(texts):
+            calls.append(len(texts))
+            time.sleep(delay)
+            return _fake_encode(texts)
+
+        enc = BatchingEncoder(encode, **opts)
+        enc.calls = calls
+        self.addCleanup(enc.close)
+        return enc
+
+    def test_lone_request_does_not_wait_for_a_batch(self):
+        enc = self._encoder(max_wait_ms=500)
+        t0 = time.perf_counter()
+        vec = enc.encode("社團博覽會")
+        self.assertLess(time.perf_counter() - t0, 0.25)
+        np.testing.assert_allclose(vec, _fake_vec("社團博覽會"))
+
+    def test_concurrent_requests_share_batches(self):
+        enc = self._encoder(delay=0.05, max_wait_ms=50, max_batch=8)
+        barrier = threading.Barrier(6)
+        out: Dict[str, np.ndarray] = {}
+
+        def worker(i: int) -> None:
+            barrier.wait()
+            out[f"問題{i}"] = enc.encode(f"問題{i}")
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sum(enc.calls), 6)
+        self.assertLess(len(enc.calls), 6)
+        for text, vec in out.items():
+            np.testing.assert_allclose(vec, _fake_vec(text))
+        self.assertEqual(enc.stats()["active"], 0)
+
+    def test_prepare_is_not_counted_in_timeout(self):
+        enc = self._encoder(prepare=lambda: time.sleep(0.3))
+        enc.encode("社團博覽會", timeout=0.2)
+        self.assertEqual(enc.calls, [1])
+
+    def test_encoder_error_reaches_caller(self):
+        enc = BatchingEncoder(mock.Mock(side_effect=RuntimeError("model crashed")))
+        self.addCleanup(enc.close)
+        with self.assertRaises(RuntimeError):
+            enc.encode("x")
+        self.assertEqual(enc.stats()["active"], 0)
+
+
+class EmbedQueryTests(_AssistantTestCase):
+    """retriever._embed_query：冷啟動走 micro-batcher 編碼一次，之後同一問題直接命中查詢向量快取。"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.encode = mock.Mock(side_effect=_fake_encode)
+        batcher = BatchingEncoder(self.encode, max_batch=8, max_wait_ms=500)
+        self.addCleanup(batcher.close)
+        patcher = mock.patch.object(retriever, "_get_batcher", lambda: batcher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.batcher = batcher
+
+    def test_cold_call_encodes_once_and_warm_call_hits_cache(self):
+        cold = retriever._embed_query("社團博覽會在哪裡")
+        self.assertEqual(self.encode.call_count, 1)
+        self.assertEqual(self.batcher.stats()["items"], 1)
+        self.assertEqual(retriever.query_cache_stats()["misses"], 1)
+        # 空白、全半形、句尾標點不同也是同一個 key；不再 encode、不進 batcher
+        for text in ("社團博覽會在哪裡", "  社團博覽會在哪裡？"):
+            warm = retriever._embed_query(text)
+            np.testing.assert_array_equal(warm, cold)
+        self.assertEqual(self.encode.call_count, 1)
+        self.assertEqual(self.batcher.stats()["items"], 1)
+        self.assertEqual(retriever.query_cache_stats()["hits"], 2)
+
+    def test_bench_embed_reports_cold_miss_and_hit(self):
+        bench = _load_script("bench_retriever")
+        report = bench.bench_embed(3)
+        self.assertLessEqual({"cold_ms", "miss", "hit"}, set(report))
+        self.assertEqual(self.encode.call_count, 4)          # cold 1 + miss 3；hit 不再 encode
+        self.assertEqual(retriever.query_cache_stats()["hits"], 3)
+
+
+class IncrementalBuildTests(SimpleTestCase):
+    def setUp(self) -> None:
+        self.build_emb = _load_script("build_emb")
+        self.dir = Path(tempfile.mkdtemp(prefix="assistant-build-"))
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        # 找一段雜湊結尾是 \x00 的文字（約 1/256）：S20 欄位讀回時會被截掉
+        texts = (f"公告第{i}段" for i in range(100_000))
+        self.docs = [{"content": next(t for t in texts if self._hash({"content": t}).endswith(b"\0"))},
+                     {"content": "社團博覽會在中大湖畔舉辦。"}]
+
+    def _hash(self, doc: Dict[str, Any]) -> bytes:
+        return self.build_emb.chunk_hash(self.build_emb.passage_text(doc))
+
+    def _write(self, column: np.ndarray) -> None:
+        vecs = _fake_encode([d["content"] for d in self.docs])
+        index_store.write_index(self.dir, vecs, self.docs, model=self.build_emb.MODEL_NAME,
+                                columns={"chunk_hash": column})
+
+    def test_unchanged_chunks_are_reused_even_when_hash_ends_in_nul(self):
+        self._write(self.build_emb.hash_column([self._hash(d) for d in self.docs]))
+        previous = self.build_emb.PreviousIndex(self.dir)
+        plan = self.build_emb.plan_batch(self.docs, previous)
+        self.assertEqual(plan.todo, [])
+        vecs, hashes = self.build_emb.assemble(plan, None, previous)
+        self.assertEqual([bytes(h) for h in hashes], plan.hashes)
+        np.testing.assert_allclose(vecs, _fake_encode([d["content"] for d in self.docs]))
+
+    def test_legacy_s20_column_still_matches(self):
+        self._write(np.asarray([self._hash(d) for d in self.docs], dtype="S20"))
+        previous = self.build_emb.PreviousIndex(self.dir)
+        self.assertEqual(self.build_emb.plan_batch(self.docs, previous).todo, [])
+
+    def test_streaming_build_spills_postings_and_refs(self):
+        docs = _notice_docs()
+        be = self.build_emb
+        batches = ((chunk, _fake_encode([d["content"] for d in chunk]),
+                    be.hash_column([self._hash(d) for d in chunk])) for chunk in be.batched(docs, 2))
+        refs = be.RefSpill(dir=self.dir)
+        self.addCleanup(refs.close)
+        refs(0, {"source": "notice", "title": "重複一"})
+        refs(0, {"source": "notice", "title": "重複二"})
+        with mock.patch.object(BM25Builder, "_SPILL_CHUNK", 3):      # 逼出多個區塊
+            header, _ = be.write_batches(self.dir, "float32", batches, duplicates=refs)
+        self.assertFalse([p for p in self.dir.iterdir() if p.name.startswith(".")])
+        idx = index_store.open_index(self.dir)
+        self.assertEqual(header.count, len(docs))
+        spilled = BM25Index.load(idx.attachments["lexical"])
+        self.assertEqual(spilled.to_bytes(), build_bm25([doc_text(d) for d in docs]).to_bytes())
+        self.assertEqual(retriever._load_duplicates(idx.attachments["duplicates"]),
+                         {0: [{"source": "notice", "title": "重複一"}, {"source": "notice", "title": "重複二"}]})
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 建索引去重
+class DedupTests(SimpleTestCase):
+    BASE = "本社以動畫、漫畫、輕小說的討論與創作為主，每週三晚上在社辦有社課，歡迎新生加入。"
+
+    def test_exact_duplicate_is_merged_into_back_reference(self):
+        docs = [
+            {"id": 1, "title": "A", "content": "社團博覽會 在中大湖畔舉辦。"},
+            {"id": 2, "title": "A", "content": "社團博覽會\n  在中大湖畔舉辦。 "},
+        ]
+        refs: Dict[int, List[Dict[str, Any]]] = {}
+        kept = list(dedup_docs(docs, Deduplicator(), refs))
+        self.assertEqual([d["id"] for d in kept], [1])
+        self.assertEqual(refs, {0: [{"id": 2, "title": "A"}]})
+
+    def test_reposts_with_other_title_or_posting_date_collapse(self):
+        docs = [
+            {"id": 901, "title": "社博", "posted": "2025-10-20", "content": "社團博覽會歡迎參加。"},
+            {"id": 902, "title": "社博", "posted": "2026-10-25", "content": "社團博覽會歡迎參加。"},
+            {"id": 903, "title": "社博（改）", "posted": "2026-10-25", "content": self.BASE},
+            {"id": 904, "title": "社課", "posted": "2026-11-01", "content": self.BASE + "！"},
+        ]
+        refs: Dict[int, List[Dict[str, Any]]] = {}
+        kept = list(dedup_docs(docs, Deduplicator(max_distance=8), refs))
+        self.assertEqual([d["id"] for d in kept], [901, 903])
+        self.assertEqual([r["id"] for r in refs[0]], [902])
+        self.assertEqual([r["id"] for r in refs[1]], [904])
+
+    def test_different_start_times_are_never_merged(self):
+        docs = [
+            {"id": 1, "title": "8/30 社團博覽會", "posted": "2025-07-16", "content": "社團博覽會歡迎參加。"},
+            {"id": 2, "title": "8/30 社團博覽會", "posted": "2026-07-16", "content": "社團博覽會歡迎參加。"},
+        ]
+        refs: Dict[int, List[Dict[str, Any]]] = {}
+        self.assertEqual([d["id"] for d in dedup_docs(docs, Deduplicator(), refs)], [1, 2])
+        self.assertEqual(refs, {})
+
+    def test_group_breaks_ties_between_near_duplicates(self):
+        # 固定的 SimHash：A、B 互距 4（各自保留），C 與兩者都距 2
+        sigs = {"A": 0b0011, "B": 0b1100, "C": 0b0110, "D": 0b0111}
+        with mock.patch("assistant.services.dedup.simhash", sigs.__getitem__):
+            dedup = Deduplicator(max_distance=2)
+            self.assertIsNone(dedup.check("A", group="a"))
+            self.assertIsNone(dedup.check("B", group="b"))
+            self.assertEqual(dedup.check("C", group="b"), 1)   # 同 group 優先
+            dedup._exact.clear()
+            self.assertEqual(dedup.check("C", group="a"), 0)
+            dedup._exact.clear()
+            self.assertEqual(dedup.check("C", group="z"), 0)   # 都不同 group：距離相同取先保留的
+            self.assertEqual(dedup.check("D", group="b"), 0)   # 只有 A 在門檻內，group 不限制合併
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 回覆快取與 single-flight
+class ReplyCacheTests(_AssistantTestCase):
+    STREAM = "/api/assistant/chat/stream/"
+
+    def test_exact_cache_serves_repeat_question(self):
+        hits = llama_client.response_cache_stats()["hits"]
+        first = self.post_json("/api/assistant/chat/", {"message": "社團博覽會在哪裡"})
+        second = self.post_json("/api/assistant/chat/", {"message": "  社團博覽會在哪裡？ "})
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.json()["reply"], first.json()["reply"])
+        self.assertEqual(self.completions.calls, 1)
+        self.assertEqual(llama_client.response_cache_stats()["hits"], hits + 1)
+
+    def test_other_persona_is_not_served_from_cache(self):
+        self.post_json("/api/assistant/chat/", {"message": "社團博覽會在哪裡", "persona": "starter_guide"})
+        self.post_json("/api/assistant/chat/", {"message": "社團博覽會在哪裡", "persona": "weekend_curator"})
+        self.assertEqual(self.completions.calls, 2)
+
+    def test_cached_stream_reply_is_one_delta(self):
+        b"".join(self.post_json(self.STREAM, {"message": "社團博覽會在哪裡"}).streaming_content)
+        events = _sse_events(self.post_json(self.STREAM, {"message": "社團博覽會在哪裡"}))
+        self.assertEqual([e for e, _ in events], ["meta", "delta", "done"])
+        self.assertTrue(events[-1][1]["usage"]["cached"])
+        self.assertEqual(self.completions.calls, 1)
+
+    def test_failed_stream_is_not_cached(self):
+        self.completions.stream_error = RuntimeError("connection reset")
+        hits = llama_client.response_cache_stats()["hits"]
+        with self.assertLogs("assistant.views", level="ERROR"):
+            _sse_events(self.post_json(self.STREAM, {"message": "社團博覽會在哪裡"}))
+        self.assertEqual(llama_client.response_cache_stats()["hits"], hits)
+        self.completions.stream_error = None
+        events = _sse_events(self.post_json(self.STREAM, {"message": "社團博覽會在哪裡"}))
+        self.assertEqual(events[-1][0], "done")
+        self.assertEqual(self.completions.calls, 2)
+
+
+class SemanticCacheTests(SimpleTestCase):
+    def setUp(self) -> None:
+        self.cache = SemanticCache(capacity=4, threshold=0.95, ttl=60)
+        self.vec = _fake_vec("社團博覽會在哪裡")
+
+    def test_near_vector_with_same_context_hits(self):
+        self.cache.add(self.vec, 1, "湖畔", query="社團博覽會在哪裡")
+        reply, cos = self.cache.lookup(self.vec + 0.01, 1, query="社團博覽會在哪")
+        self.assertEqual(reply, "湖畔")
+        self.assertGreaterEqual(cos, 0.95)
+
+    def test_other_context_or_far_vector_misses(self):
+        self.cache.add(self.vec, 1, "湖畔", query="社團博覽會在哪裡")
+        self.assertIsNone(self.cache.lookup(self.vec, 2, query="社團博覽會在哪裡"))
+        self.assertIsNone(self.cache.lookup(_fake_vec("停車場施工"), 1, query="停車場施工"))
+
+    def test_guard_rejects_different_numbers(self):
+        self.cache.add(self.vec, 1, "2024 的答案", query="2024 社團博覽會在哪裡")
+        self.assertIsNone(self.cache.lookup(self.vec, 1, query="2025 社團博覽會在哪裡"))
+        self.assertEqual(self.cache.stats()["guard_rejects"], 1)
+        self.assertEqual(query_guard("２０２５ 社博 Day1"), frozenset({"2025", "day1"}))
+
+    def test_ring_buffer_evicts_oldest(self):
+        for i in range(5):
+            self.cache.add(_fake_vec(f"問題{i}號"), 1, f"答{i}", query=f"問題{i}號")
+        self.assertEqual(self.cache.stats()["size"], 4)
+        self.assertIsNone(self.cache.lookup(_fake_vec("問題0號"), 1, query="問題0號"))
+
+
+class SemanticReplyTests(_AssistantTestCase):
+    def test_semantic_cache_serves_paraphrase_with_same_context(self):
+        vec = _fake_vec("社團博覽會在哪裡")
+        llama_client.ask_llama("社團博覽會在哪裡", "脈絡", "starter_guide", query_vec=vec)
+        reply = llama_client.ask_llama("社博在哪裡舉辦", "脈絡", "starter_guide", query_vec=vec + 0.01)
+        self.assertEqual(reply, _REPLY)
+        self.assertEqual(self.completions.calls, 1)
+        self.assertEqual(llama_client.semantic_cache_stats()["hits"], 1)
+        # 不同脈絡（檢索到的段落不同）不共用
+        llama_client.ask_llama("社博在哪裡舉辦", "別的脈絡", "starter_guide", query_vec=vec)
+        self.assertEqual(self.completions.calls, 2)
+
+
+class StatsAPITests(_AssistantTestCase):
+    def _get(self, user=None):
+        request = APIRequestFactory().get("/api/assistant/stats/")
+        if user is not None:
+            force_authenticate(request, user=user)
+        return views.StatsAPI.as_view()(request)
+
+    def test_requires_staff(self):
+        self.assertIn(self._get().status_code, (401, 403))
+        member = SimpleNamespace(is_authenticated=True, is_staff=False)
+        self.assertEqual(self._get(member).status_code, 403)
+        self.assertEqual(resolve("/api/assistant/stats/").url_name, "stats")
+
+    def test_reports_counters_from_every_layer(self):
+        self.post_json("/api/assistant/chat/", {"message": "社團博覽會在哪裡"})
+        self.post_json("/api/assistant/chat/", {"message": "社團博覽會在哪裡"})
+        resp = self._get(SimpleNamespace(is_authenticated=True, is_staff=True))
+        self.assertEqual(resp.status_code, 200)
+        body = json.loads(resp.render().content)
+        self.assertEqual(body["retriever"]["index"]["backend"], "exact")
+        self.assertEqual(body["retriever"]["index"]["rows"], len(self.docs))
+        self.assertGreaterEqual(body["retriever"]["query_cache"]["misses"], 1)
+        self.assertIsNone(body["retriever"]["batcher"])          # 測試中停用 micro-batching
+        self.assertIn("models", body["retriever"])
+        self.assertGreaterEqual(body["response_cache"]["hits"], 1)
+        self.assertIn("hits", body["semantic_cache"])
+        self.assertIn("local", body["singleflight"])
+
+
+class SingleFlightTests(_AssistantTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        # 關掉精確快取，確認是 single-flight（而不是快取）把併發請求合併
+        patcher = mock.patch.object(llama_client._RESPONSE_CACHE, "ttl", 0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_concurrent_threads_share_one_call(self):
+        self.completions.delay = 0.3
+        barrier = threading.Barrier(8)
+        replies: List[str] = []
+
+        def worker() -> None:
+            barrier.wait()
+            replies.append(llama_client.ask_llama_rag("社團博覽會在哪裡", "starter_guide"))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(replies, [_REPLY] * 8)
+        self.assertEqual(self.completions.calls, 1)
+
+    def test_followers_receive_leader_exception(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        errors: List[BaseException] = []
+
+        def slow_fail():
+            started.set()
+            time.sleep(0.2)
+            raise ValueError("boom")
+
+        def follower() -> None:
+            started.wait()
+            try:
+                flight.do("k", lambda: "never")
+            except ValueError as e:
+                errors.append(e)
+
+        t = threading.Thread(target=follower)
+        t.start()
+        with self.assertRaises(ValueError):
+            flight.do("k", slow_fail)
+        t.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+    def test_concurrent_coroutines_share_one_call(self):
+        async def burst():
+            return await asyncio.gather(
+                *[llama_client.aask_llama_rag_with_sources("社團博覽會在哪裡", "starter_guide") for _ in range(8)]
+            )
+
+        served = self.stub_served()
+        results = asyncio.run(burst())
+        self.assertEqual([r for r, _ in results], [_GroqStub.REPLY] * 8)
+        self.assertEqual(self.stub_served(), served + 1)   # 8 個 coroutine，stub 只收到一次請求
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# API
+class ChatAPITests(_AssistantTestCase):
+    def test_reply_with_sources_and_usage(self):
+        resp = self.post_json("/api/assistant/chat/", {"message": "社團博覽會在哪裡", "persona": "starter_guide"})
+        self.assertEqual(resp.status_code, 200)
+        body = resp.json()
+        self.assertEqual(body["reply"], _REPLY)
+        self.assertEqual(body["personaUsed"], "starter_guide")
+        self.assertTrue(body["sources"])
+        self.assertIn("prompt_tokens_est", body["usage"])
+        # 檢索到的脈絡有送進 system prompt
+        self.assertIn("社團博覽會", self.completions.messages[0][0]["content"])
+
+    def test_sources_come_from_the_same_search(self):
+        with mock.patch.object(retriever, "_rank_with_time", wraps=retriever._rank_with_time) as spy:
+            body = self.post_json("/api/assistant/chat/", {"message": "社團博覽會在哪裡"}).json()
+        spy.assert_called_once()
+        self.assertEqual(body["sources"], retriever.search("社團博覽會在哪裡").citations())
+
+    def test_unknown_persona_is_rejected(self):
+        resp = self.post_json("/api/assistant/chat/", {"message": "hi", "persona": "nobody"})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("available_personas", resp.json())
+        self.assertEqual(self.completions.calls, 0)
+
+    def test_llm_failure_returns_500(self):
+        self.completions.error = RuntimeError("groq down")
+        resp = self.post_json("/api/assistant/chat/", {"message": "社團博覽會在哪裡"})
+        self.assertEqual(resp.status_code, 500)
+
+
+def _sse_events(resp) -> List[tuple]:
+    raw = b"".join(resp.streaming_content).decode("utf-8")
+    events = []
+    for block in raw.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+class ChatStreamAPITests(_AssistantTestCase):
+    URL = "/api/assistant/chat/stream/"
+
+    def test_meta_delta_done(self):
+        resp = self.post_json(self.URL, {"message": "社團博覽會在哪裡", "persona": "starter_guide"})
+        self.assertEqual(resp["Content-Type"], "text/event-stream")
+        events = _sse_events(resp)
+        self.assertEqual([e for e, _ in events], ["meta", "delta", "delta", "done"])
+        meta, done = events[0][1], events[-1][1]
+        self.assertEqual(meta["personaUsed"], "starter_guide")
+        self.assertTrue(meta["sources"])
+        self.assertEqual("".join(d["content"] for e, d in events if e == "delta"), _REPLY)
+        self.assertEqual(done["reply"], _REPLY)
+        self.assertEqual(done["usage"]["completion_tokens"], 5)
+        self.assertIn("context_tokens", done["usage"])
+
+    def test_failure_mid_stream_emits_error_event(self):
+        self.completions.stream_error = RuntimeError("connection reset")
+        with self.assertLogs("assistant.views", level="ERROR"):
+            events = _sse_events(self.post_json(self.URL, {"message": "社團博覽會在哪裡"}))
+        self.assertEqual([e for e, _ in events], ["meta", "delta", "error"])
+        self.assertEqual(events[1][1]["content"], "這是")
+
+    def test_invalid_request_is_plain_400(self):
+        resp = self.post_json(self.URL, {"message": ""})
+        self.assertEqual(resp.status_code, 400)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 非同步 client 與 async view（真的 AsyncGroq 連線池 → groq_stub）
+class ChatAsyncTests(_AssistantTestCase):
+    # /chat/async/ 只在 ASGI 或 ASSISTANT_ASYNC_CHAT=1 時掛上，這裡直接呼叫 view
+    def _post(self, body: str):
+        return views.chat_async(AsyncRequestFactory().post("/api/assistant/chat/async/", body, content_type="application/json"))
+
+    async def test_reply(self):
+        served = await asyncio.to_thread(self.stub_served)
+        resp = await self._post(json.dumps({"message": "社團博覽會在哪裡", "persona": "starter_guide"}))
+        self.assertEqual(resp.status_code, 200)
+        body = json.loads(resp.content)
+        self.assertEqual(body["reply"], _GroqStub.REPLY)
+        self.assertEqual(body["personaUsed"], "starter_guide")
+        self.assertTrue(body["sources"])
+        self.assertEqual(await asyncio.to_thread(self.stub_served), served + 1)
+        self.assertEqual(self.completions.calls, 0)     # 沒有走到同步 client
+
+    async def test_bad_json_method_and_persona(self):
+        resp = await self._post("{")
+        self.assertEqual(resp.status_code, 400)
+        resp = await self._post(json.dumps({"message": "hi", "persona": "nobody"}))
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("available_personas", json.loads(resp.content))
+        resp = await views.chat_async(AsyncRequestFactory().get("/api/assistant/chat/async/"))
+        self.assertEqual(resp.status_code, 405)
+
+    def test_not_mounted_under_wsgi(self):
+        with self.assertRaises(Resolver404):
+            resolve("/api/assistant/chat/async/")
+
+    def test_requests_on_separate_event_loops(self):
+        # WSGI 下 asgiref 每個請求各開一個事件迴圈；第二個請求不能沿用前一個迴圈的連線池
+        for i in range(2):
+            self.assertEqual(asyncio.run(llama_client.aask_llama(f"第{i}個問題")), _GroqStub.REPLY)
+        with mock.patch.object(llama_client, "_ASGI", True):
+            for i in range(2):
+                self.assertEqual(asyncio.run(llama_client.aask_llama(f"ASGI 第{i}個問題")), _GroqStub.REPLY)
+
+    def test_async_client_is_per_event_loop(self):
+        async def pair():
+            return llama_client.get_async_client(), llama_client.get_async_client()
+
+        a1, a2 = asyncio.run(pair())
+        b1, _ = asyncio.run(pair())
+        self.assertIs(a1, a2)
+        self.assertIsNot(a1, b1)
+
+    def test_concurrent_calls_share_the_pool(self):
+        async def burst():
+            return await asyncio.gather(*[llama_client.aask_llama(f"問題{i}") for i in range(6)])
+
+        with mock.patch.object(llama_client, "_ASGI", True):
+            replies = asyncio.run(burst())
+        self.assertEqual(replies, [_GroqStub.REPLY] * 6)
+        self.assertGreater(self.stub.stats()["peak"], 1)   # 同時在 stub 上，不是一個接一個
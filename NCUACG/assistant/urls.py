@@ -1,11 +1,12 @@
 # NCUACG/assistant/urls.py
+from django.conf import settings
 from django.urls import path, re_path
 
 # 嘗試匯入正式 view；若尚未實作 list_personas，提供安全 stub（避免專案啟動失敗）
 try:
-    from .views import ChatAPI, list_personas
+    from .views import ChatAPI, ChatStreamAPI, StatsAPI, chat_async, list_personas
 except ImportError:
-    from .views import ChatAPI  # 你的現有檔案至少有 ChatAPI
+    from .views import ChatAPI, ChatStreamAPI, StatsAPI, chat_async  # 你的現有檔案至少有 ChatAPI
     from django.http import JsonResponse
 
     def list_personas(request, *args, **kwargs):
@@ -17,12 +18,23 @@ except ImportError:
 
 app_name = "assistant"
 
+# 以 ASGI（NCUACG/asgi.py）部署時可讓 /chat/ 直接走 async view；
+# /chat/async/ 只在 ASGI 或明確開啟 ASSISTANT_ASYNC_CHAT 時掛上（WSGI 下 async view 每個請求都要另開事件迴圈）
+_async_chat = getattr(settings, "ASSISTANT_ASYNC_CHAT", False) or getattr(settings, "ASSISTANT_ASGI", False)
+_chat_view = chat_async if getattr(settings, "ASSISTANT_ASYNC_CHAT", False) else ChatAPI.as_view()
+
 urlpatterns = [
     # ✅ 正式路由（尾斜線結尾，與 APPEND_SLASH 相容）
-    path("chat/", ChatAPI.as_view(), name="chat"),
+    path("chat/", _chat_view, name="chat"),
+    path("chat/stream/", ChatStreamAPI.as_view(), name="chat_stream"),
     path("personas/", list_personas, name="personas"),
+    path("stats/", StatsAPI.as_view(), name="stats"),   # 快取 / 批次 / 索引計數器（僅限 staff）
 
     # ✅ 兼容無尾斜線（避免 POST 被重導致 Body 遺失）
-    re_path(r"^chat$", ChatAPI.as_view(), name="chat_no_slash"),
+    re_path(r"^chat$", _chat_view, name="chat_no_slash"),
+    re_path(r"^chat/stream$", ChatStreamAPI.as_view(), name="chat_stream_no_slash"),
     re_path(r"^personas$", list_personas, name="personas_no_slash"),
 ]
+
+if _async_chat:
+    urlpatterns.append(path("chat/async/", chat_async, name="chat_async"))
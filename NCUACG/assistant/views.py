@@ -1,16 +1,23 @@
 # NCUACG/assistant/views.py
 from __future__ import annotations
 
-from typing import Any, Dict
+import json
+import logging
+from typing import Any, Dict, Iterator, Mapping, Tuple, Union
 
-from django.http import HttpRequest
+from asgiref.sync import sync_to_async
+from django.http import HttpRequest, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework import status
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 # 模型呼叫（維持原有別名與行為）
-from .services.llama_client import ask_llama_rag as ask_model
+from .services.llama_client import ask_llama_rag as ask_model  # noqa: F401
+from .services.llama_client import aask_llama_rag_with_sources, ask_llama_rag_with_sources, rag_search, stream_llama
+from .services.llama_client import flight_stats, response_cache_stats, semantic_cache_stats
+from .services.retriever import retriever_stats
 
 # ✨ 序列化與 personas 單一來源
 from .serializers import (
@@ -24,59 +31,76 @@ from .services.personas import (
     resolve_persona_id,   # ← 新增：密語/ID 解析
 )
 
+logger = logging.getLogger(__name__)
+
+
+def _parse_chat_request(body: Mapping[str, Any]) -> Union[Response, Tuple[str, str]]:
+    """
+    驗證聊天請求並解析本次採用的 persona；不合法時回傳 400 Response，
+    否則回傳 (message, used)。ChatAPI、ChatStreamAPI 與 chat_async 共用。
+    """
+    # 先用 serializer 驗證基本欄位
+    req = ChatRequestSerializer(data=body)
+    if not req.is_valid():
+        errors: Dict[str, Any] = req.errors  # type: ignore
+        available = PersonaSerializer(get_personas(), many=True).data
+
+        # 若 persona 非法 → 400 並附可用清單
+        if "persona" in errors:
+            detail = (
+                errors["persona"][0]
+                if isinstance(errors["persona"], list)
+                else errors["persona"]
+            )
+            return Response(
+                {"detail": detail, "available_personas": available},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # 其他驗證錯誤 → 也統一附上 available_personas
+        return Response(
+            {
+                "detail": "Invalid request",
+                "errors": errors,
+                "available_personas": available,
+            },
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    data = req.validated_data
+    message: str = data["message"]
+    # 同時相容 personaId（若序列化器沒收這欄就從原始 body 補）
+    preferred_from_body = body.get("personaId") or body.get("persona_id")
+    preferred: str = (data.get("persona") or preferred_from_body or get_default_persona_id())
+
+    # ★關鍵：密語優先 → 解析本次實際採用的人格
+    used = resolve_persona_id(preferred_id=preferred, user_text=message)
+    return message, used
+
 
 class ChatAPI(APIView):
     """
     POST /api/assistant/chat/
     body: { "message": str, "persona"?: str }  # 亦相容 personaId/persona_id
-    resp: { "reply": str, "persona": str, "personaUsed": str } or 400/500
+    resp: { "reply": str, "persona": str, "personaUsed": str, "sources": [...], "usage": {...} } or 400/500
+          usage：prompt token 估計（prompt_tokens_est、context_tokens/context_budget 等）
     """
     permission_classes = [AllowAny]
 
     def post(self, request: HttpRequest, *args, **kwargs):
-        # 先用 serializer 驗證基本欄位
-        req = ChatRequestSerializer(data=request.data)
-        if not req.is_valid():
-            errors: Dict[str, Any] = req.errors  # type: ignore
-            available = PersonaSerializer(get_personas(), many=True).data
-
-            # 若 persona 非法 → 400 並附可用清單
-            if "persona" in errors:
-                detail = (
-                    errors["persona"][0]
-                    if isinstance(errors["persona"], list)
-                    else errors["persona"]
-                )
-                return Response(
-                    {"detail": detail, "available_personas": available},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-
-            # 其他驗證錯誤 → 也統一附上 available_personas
-            return Response(
-                {
-                    "detail": "Invalid request",
-                    "errors": errors,
-                    "available_personas": available,
-                },
-                status=status.HTTP_400_BAD_REQUEST,
-            )
-
-        data = req.validated_data
-        message: str = data["message"]
-        # 同時相容 personaId（若序列化器沒收這欄就從原始 body 補）
-        preferred_from_body = request.data.get("personaId") or request.data.get("persona_id")
-        preferred: str = (data.get("persona") or preferred_from_body or get_default_persona_id())
-
-        # ★關鍵：密語優先 → 解析本次實際採用的人格
-        used = resolve_persona_id(preferred_id=preferred, user_text=message)
+        parsed = _parse_chat_request(request.data)
+        if isinstance(parsed, Response):
+            return parsed
+        message, used = parsed
 
         try:
             # 帶入 used（已處理密語）給模型
-            reply = ask_model(message, persona_slug=used)
+            reply, result = ask_llama_rag_with_sources(message, persona_slug=used)
 
-            # 仍用舊的回應序列化器產生基本欄位
-            resp = ChatResponseSerializer(data={"reply": reply, "persona": used})
+            # 仍用舊的回應序列化器產生基本欄位；sources 與脈絡出自同一次檢索
+            resp = ChatResponseSerializer(
+                data={"reply": reply, "persona": used, "sources": result.citations(), "usage": result.usage}
+            )
             resp.is_valid(raise_exception=True)
 
             # 再補上 personaUsed 供前端持久化
@@ -92,6 +116,87 @@ class ChatAPI(APIView):
             )
 
 
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class ChatStreamAPI(APIView):
+    """
+    POST /api/assistant/chat/stream/
+    body: 同 ChatAPI
+    resp: text/event-stream
+      event: meta   data: { "personaUsed", "sources" }          ← 檢索完成、開始生成前
+      event: delta  data: { "content": str }                    ← Groq 每個 token 片段
+      event: done   data: { "reply", "persona", "personaUsed", "usage" }
+      event: error  data: { "detail" }                          ← 生成中途失敗
+    驗證錯誤仍以一般 JSON 400 回應（尚未開始串流）。
+    """
+    permission_classes = [AllowAny]
+
+    def post(self, request: HttpRequest, *args, **kwargs):
+        parsed = _parse_chat_request(request.data)
+        if isinstance(parsed, Response):
+            return parsed
+        message, used = parsed
+
+        resp = StreamingHttpResponse(self._events(message, used), content_type="text/event-stream")
+        resp["Cache-Control"] = "no-cache"
+        resp["X-Accel-Buffering"] = "no"   # 關掉 nginx 緩衝，片段才會即時送出
+        return resp
+
+    def _events(self, message: str, used: str) -> Iterator[str]:
+        try:
+            result, context = rag_search(message, persona_slug=used)
+            yield _sse("meta", {"personaUsed": used, "sources": result.citations()})
+            for ev in stream_llama(message, context, persona_slug=used, query_vec=result.query_vector):
+                if ev["type"] == "delta":
+                    yield _sse("delta", {"content": ev["content"]})
+                else:
+                    usage = dict(ev["usage"], **result.usage)
+                    usage.update({f"retrieval_{k}": round(v, 3) for k, v in result.timings.items()})
+                    yield _sse("done", {"reply": ev["reply"], "persona": used, "personaUsed": used, "usage": usage})
+        except Exception:
+            logger.exception("chat stream failed")
+            yield _sse("error", {"detail": "Internal Server Error"})
+
+
+@csrf_exempt
+async def chat_async(request: HttpRequest, *args, **kwargs):
+    """
+    POST /api/assistant/chat/async/（ASGI 或 ASSISTANT_ASYNC_CHAT=1 時才掛上；後者也掛在 /chat/）
+    與 ChatAPI 相同的請求/回應格式，但等待 LLM 時不佔用 worker 執行緒，
+    單一 ASGI 行程可同時服務數百個對話（上限見 LLAMA_HTTP_MAX_CONNECTIONS）。
+    DRF 的 APIView 不支援 async，這裡直接用 Django 的 async view。
+    """
+    if request.method != "POST":
+        return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+    try:
+        body = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse({"detail": "JSON parse error"}, status=400)
+    if not isinstance(body, dict):
+        return JsonResponse({"detail": "Invalid request"}, status=400)
+
+    # 驗證與解析 persona 會讀人設檔，不在事件迴圈上做
+    parsed = await sync_to_async(_parse_chat_request, thread_sensitive=False)(body)
+    if isinstance(parsed, Response):
+        return JsonResponse(parsed.data, status=parsed.status_code, safe=False)
+    message, used = parsed
+
+    try:
+        reply, result = await aask_llama_rag_with_sources(message, persona_slug=used)
+        resp = ChatResponseSerializer(
+            data={"reply": reply, "persona": used, "sources": result.citations(), "usage": result.usage}
+        )
+        resp.is_valid(raise_exception=True)
+        payload = dict(resp.data)
+        payload["personaUsed"] = used
+        return JsonResponse(payload, status=200, json_dumps_params={"ensure_ascii": False})
+    except Exception:
+        logger.exception("async chat failed")
+        return JsonResponse({"detail": "Internal Server Error"}, status=500)
+
+
 class PersonasAPI(APIView):
     """
     GET /api/assistant/personas/
@@ -105,6 +210,27 @@ class PersonasAPI(APIView):
         return Response(data, status=status.HTTP_200_OK)
 
 
+class StatsAPI(APIView):
+    """
+    GET /api/assistant/stats/（僅限 staff）
+    resp: { "retriever": {index, query_cache, batcher, models}, "response_cache": {...},
+            "semantic_cache": {...}, "singleflight": {local, shared} }
+    各計數器都是「本 worker 行程」的值；多 worker 部署時每次請求可能落在不同行程。
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        return Response(
+            {
+                "retriever": retriever_stats(),
+                "response_cache": response_cache_stats(),
+                "semantic_cache": semantic_cache_stats(),
+                "singleflight": flight_stats(),
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
 # 兼容函式型掛載（若 urls.py 使用函式 path）
 def chat(request: HttpRequest, *args, **kwargs):
     return ChatAPI.as_view()(request, *args, **kwargs)
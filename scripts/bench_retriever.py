@@ -0,0 +1,238 @@
+# scripts/bench_retriever.py
+"""
+Retriever 的延遲與品質 benchmark（合成語料，不需要真實公告）。
+
+    python scripts/bench_retriever.py                          # 1k / 10k / 100k 段
+    python scripts/bench_retriever.py --sizes 1000000 --dim 256
+    python scripts/bench_retriever.py --json --out bench.json  # 機器可讀輸出，方便比較兩次結果
+    python scripts/bench_retriever.py --embed-samples 0        # 不載入 E5 模型
+
+合成語料：n_topics 個主題中心 + 雜訊的單位向量，開始時間分散在 [-1 年, +1 年]，
+約 30% 沒有時間（NAT）。標註查詢：從「時間視窗內」的列挑出正解，查詢向量為
+正解向量加雜訊；因此正解同時適用全表搜尋與視窗內搜尋。
+
+分開量測（每筆查詢，p50/p95/p99 毫秒）：
+  embed        retriever._embed_query（查詢快取 → micro-batching → E5 encode；需要模型）：
+               cold 為第一次呼叫（含模型載入），miss 為模型已載入但快取未命中，hit 為快取命中
+  time_filter  TimeIndex.rows_between
+  scoring      視窗內列的內積（vecs[rows] @ q）與全表內積（vecs @ q）
+  topk         argpartition 取前 n
+  search       各後端（exact / ivf / int8 / float16）的完整 search(q, n)；
+               int8 / float16 為量化副本掃描 + float32 精算（QuantizedSearch）
+品質：各後端與視窗內搜尋的 recall@k、MRR。
+"""
+import argparse, json, platform, sys, time
+from pathlib import Path
+
+import numpy as np
+
+BASE = Path(__file__).resolve().parents[1]      # 指到 NCUACG_net/
+sys.path.insert(0, str(BASE / "NCUACG"))
+from assistant.services.index_store import quantize_rows  # noqa: E402
+from assistant.services.search_backends import ExactSearch, IVFSearch, QuantizedSearch, search_rows  # noqa: E402
+from assistant.services.timeparse import NAT, TimeIndex  # noqa: E402
+from assistant.services.topn import topn  # noqa: E402
+
+SIZES = (1_000, 10_000, 100_000)
+DAY = 86_400
+WINDOW_DAYS = 30
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# 合成語料與標註查詢
+def synthetic_corpus(rows: int, dim: int, n_topics: int, now: int, seed: int = 0):
+    """回傳 (vecs[float32, 單位向量], start_ts[int64])。"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_topics, dim), dtype=np.float32)
+    topic = rng.integers(0, n_topics, size=rows)
+    vecs = np.empty((rows, dim), dtype=np.float32)
+    block = 65_536                                  # 分塊產生，1M 列時不會多佔一份暫存
+    for s in range(0, rows, block):
+        e = min(rows, s + block)
+        v = centers[topic[s:e]] + 0.8 * rng.standard_normal((e - s, dim), dtype=np.float32)
+        vecs[s:e] = v / np.linalg.norm(v, axis=1, keepdims=True)
+    start_ts = now + rng.integers(-365 * DAY, 365 * DAY, size=rows, dtype=np.int64)
+    start_ts[rng.random(rows) < 0.3] = NAT
+    return vecs, start_ts
+
+
+def labelled_queries(vecs: np.ndarray, candidates: np.ndarray, count: int, noise: float, seed: int = 1):
+    """從 candidates 挑正解列，查詢 = 正解 + 高斯雜訊（再正規化）。回傳 (queries, targets)。"""
+    rng = np.random.default_rng(seed)
+    targets = rng.choice(candidates, size=min(count, candidates.size), replace=False)
+    q = np.asarray(vecs[targets], dtype=np.float32)
+    q = q + noise * rng.standard_normal(q.shape, dtype=np.float32) / np.sqrt(q.shape[1])
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+    # np.sqrt 回傳 float64 純量會讓 q 升成 float64，vecs @ q 就變成整表轉型；與 retriever 一樣用 float32
+    return q.astype(np.float32), targets
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# 量測工具
+def _percentiles(samples_ms) -> dict:
+    a = np.asarray(samples_ms, dtype=np.float64)
+    if not a.size:
+        return {}
+    p50, p95, p99 = np.percentile(a, [50, 95, 99])
+    return {"n": int(a.size), "mean": float(a.mean()), "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+def _timed(fn):
+    t0 = time.perf_counter()
+    out = fn()
+    return out, (time.perf_counter() - t0) * 1000.0
+
+
+def _quality(ranked_rows, targets, k: int) -> dict:
+    """recall@k（正解是否在前 k）與 MRR（正解名次倒數，未命中為 0）。"""
+    hits, rr = 0, 0.0
+    for rows, t in zip(ranked_rows, targets):
+        pos = np.flatnonzero(np.asarray(rows[:k]) == t)
+        if pos.size:
+            hits += 1
+            rr += 1.0 / (int(pos[0]) + 1)
+    n = max(len(targets), 1)
+    return {f"recall@{k}": hits / n, "mrr": rr / n}
+
+
+def bench_embed(samples: int) -> dict:
+    """
+    量測請求實際走的查詢編碼路徑 retriever._embed_query（不是裸的 model.encode）：
+      cold  本行程第一次呼叫：模型載入 + 批次執行緒啟動 + encode
+      miss  模型已載入、查詢快取未命中（每筆都是新問題），含 micro-batching 的等待
+      hit   同一批問題再問一次（查詢向量快取命中）
+    模型不可用時回報原因。
+    """
+    if samples <= 0:
+        return {"skipped": "disabled"}
+    try:
+        from assistant.services import retriever
+        from assistant.services.embedding import load_seconds
+        _, cold_ms = _timed(lambda: retriever._embed_query("第 0 場社團活動什麼時候開始"))
+    except Exception as e:  # noqa: BLE001 沒裝 sentence-transformers 或沒有網路
+        return {"skipped": f"{type(e).__name__}: {e}"}
+    texts = [f"第 {i} 場社團活動什麼時候開始" for i in range(1, samples + 1)]
+    miss = [_timed(lambda t=t: retriever._embed_query(t))[1] for t in texts]
+    hit = [_timed(lambda t=t: retriever._embed_query(t))[1] for t in texts]
+    load_s = load_seconds(retriever._Q_MODEL_NAME)
+    return {
+        "model": retriever._Q_MODEL_NAME,
+        "cold_ms": cold_ms,
+        "load_ms": load_s * 1000.0 if load_s is not None else None,
+        "miss": _percentiles(miss),
+        "hit": _percentiles(hit),
+    }
+
+
+def run_size(rows: int, args, now: int) -> dict:
+    t0 = time.perf_counter()
+    vecs, start_ts = synthetic_corpus(rows, args.dim, args.topics, now, seed=args.seed)
+    if args.dtype == "float16":
+        # 與 retriever 載入 float16 索引時相同：存成 float16，載入後轉一次 float32 再查詢
+        vecs = vecs.astype(np.float16).astype(np.float32)
+    time_index = TimeIndex(start_ts)
+    build = {"corpus_s": time.perf_counter() - t0}
+
+    lo, hi = now, now + WINDOW_DAYS * DAY
+    window_rows = time_index.rows_between(lo, hi)
+    queries, targets = labelled_queries(vecs, window_rows, args.queries, args.noise, seed=args.seed + 1)
+    n = args.k * args.pool_factor
+
+    backends = {"exact": ExactSearch(vecs)}
+    if "ivf" in args.backends:
+        ivf, build["ivf_s"] = _timed(lambda: IVFSearch(vecs, n_probe=args.nprobe, seed=args.seed))
+        build["ivf_s"] /= 1000.0
+        backends["ivf"] = ivf
+    for mode in ("int8", "float16"):
+        if mode in args.backends:
+            (qv, scale), ms = _timed(lambda: quantize_rows(vecs, mode))
+            build[f"{mode}_s"] = ms / 1000.0
+            build[f"{mode}_mb"] = qv.nbytes / 2**20
+            backends[mode] = QuantizedSearch(vecs, qv, scales=scale, rescore=args.rescore)
+    build["float_mb"] = vecs.nbytes / 2**20
+
+    stages = {"time_filter": [], "scoring_window": [], "scoring_full": [], "topk": []}
+    search_ms = {name: [] for name in backends}
+    ranked = {name: [] for name in backends}
+    ranked["window"] = []
+    for q in queries:
+        rows_w, ms = _timed(lambda: time_index.rows_between(lo, hi))
+        stages["time_filter"].append(ms)
+        sims_w, ms = _timed(lambda: vecs[rows_w] @ q)
+        stages["scoring_window"].append(ms)
+        sims, ms = _timed(lambda: vecs @ q)
+        stages["scoring_full"].append(ms)
+        _, ms = _timed(lambda: topn(sims, n))
+        stages["topk"].append(ms)
+        ranked["window"].append(search_rows(vecs, rows_w, q, n)[0])
+        for name, backend in backends.items():
+            (idxs, _), ms = _timed(lambda: backend.search(q, n))
+            search_ms[name].append(ms)
+            ranked[name].append(idxs)
+
+    return {
+        "rows": rows,
+        "window_rows": int(window_rows.size),
+        "queries": int(len(targets)),
+        "build": build,
+        "latency_ms": {
+            **{name: _percentiles(s) for name, s in stages.items()},
+            **{f"search_{name}": _percentiles(s) for name, s in search_ms.items()},
+        },
+        "quality": {name: _quality(r, targets, args.k) for name, r in ranked.items()},
+    }
+
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="retriever 延遲（p50/p95/p99）與 recall@k / MRR")
+    ap.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    ap.add_argument("--dim", type=int, default=768, help="向量維度（E5-base 為 768；1M 列建議 256 以省記憶體）")
+    ap.add_argument("--dtype", choices=("float32", "float16"), default="float32")
+    ap.add_argument("--topics", type=int, default=200, help="合成語料的主題數")
+    ap.add_argument("--queries", type=int, default=200, help="標註查詢數")
+    ap.add_argument("--noise", type=float, default=5.0, help="查詢雜訊強度（越大越難）")
+    ap.add_argument("--k", type=int, default=4)
+    ap.add_argument("--pool-factor", type=int, default=4)
+    ap.add_argument("--backends", nargs="+", choices=("exact", "ivf", "int8", "float16"),
+                    default=["exact", "ivf", "int8"])
+    ap.add_argument("--nprobe", type=int, default=8)
+    ap.add_argument("--rescore", type=int, default=4, help="量化掃描保留 n*rescore 名再精算")
+    ap.add_argument("--embed-samples", type=int, default=50, help="量測 encode 的查詢數；0 = 不載入模型")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", action="store_true", help="輸出 JSON")
+    ap.add_argument("--out", type=Path, default=None, help="另存 JSON 結果")
+    args = ap.parse_args(argv)
+
+    now = int(time.time())
+    report = {
+        "config": {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items() if k not in ("json", "out")},
+        "env": {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine()},
+        "embed_ms": bench_embed(args.embed_samples),
+        "runs": [run_size(rows, args, now) for rows in args.sizes],
+    }
+    if args.out:
+        args.out.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return
+
+    emb = report["embed_ms"]
+    if "skipped" in emb:
+        print(f"embed: skipped ({emb['skipped']})")
+    else:
+        load = f"（模型載入 {emb['load_ms']:.0f}）" if emb["load_ms"] is not None else ""
+        print(f"embed: cold {emb['cold_ms']:.1f} ms{load}")
+        for name in ("miss", "hit"):
+            p = emb[name]
+            print(f"  {name:>4}: p50 {p['p50']:.3f} / p95 {p['p95']:.3f} / p99 {p['p99']:.3f} ms")
+    for run in report["runs"]:
+        print(f"\n== {run['rows']} rows（視窗內 {run['window_rows']}，查詢 {run['queries']}）")
+        print(f"{'stage':>16} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for name, p in run["latency_ms"].items():
+            print(f"{name:>16} {p['p50']:>9.3f} {p['p95']:>9.3f} {p['p99']:>9.3f}")
+        for name, q in run["quality"].items():
+            print(f"{name:>16} recall@{args.k} {q[f'recall@{args.k}']:.3f}  MRR {q['mrr']:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# scripts/bench_topn.py
+"""
+Top-n 選取的 micro-benchmark：比較舊的 argsort 寫法與 argpartition 版本。
+
+    python scripts/bench_topn.py                 # 1k ~ 1M 列，n=16
+    python scripts/bench_topn.py --n 40 --json   # 機器可讀輸出
+"""
+import argparse, json, sys, time
+from pathlib import Path
+
+import numpy as np
+
+BASE = Path(__file__).resolve().parents[1]      # 指到 NCUACG_net/
+sys.path.insert(0, str(BASE / "NCUACG"))
+from assistant.services.topn import topn, topn_batch  # noqa: E402
+
+SIZES = (1_000, 10_000, 100_000, 1_000_000)
+
+
+def _argsort_topn(scores: np.ndarray, n: int) -> np.ndarray:
+    return scores.argsort()[::-1][:n]
+
+
+def _median_ms(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return float(np.median(samples))
+
+
+def run(sizes, n: int, batch: int, repeat: int, seed: int = 0) -> list[dict]:
+    rng = np.random.default_rng(seed)
+    rows = []
+    for size in sizes:
+        scores = rng.random(size, dtype=np.float32)
+        # 正確性：兩種寫法的結果必須一致
+        assert np.array_equal(topn(scores, n)[0], _argsort_topn(scores, n))
+
+        row = {
+            "rows": size,
+            "n": n,
+            "argsort_ms": _median_ms(lambda: _argsort_topn(scores, n), repeat),
+            "topn_ms": _median_ms(lambda: topn(scores, n), repeat),
+        }
+        if batch > 1:
+            many = rng.random((batch, size), dtype=np.float32) if size * batch <= 50_000_000 else None
+            if many is not None:
+                row["batch"] = batch
+                row["argsort_loop_ms"] = _median_ms(lambda: [_argsort_topn(s, n) for s in many], max(1, repeat // 4))
+                row["topn_batch_ms"] = _median_ms(lambda: topn_batch(many, n), max(1, repeat // 4))
+        row["speedup"] = round(row["argsort_ms"] / max(row["topn_ms"], 1e-9), 2)
+        rows.append(row)
+    return rows
+
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="argsort vs argpartition top-n 延遲")
+    ap.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    ap.add_argument("--n", type=int, default=16, help="候選數（retriever 預設 k*pool_factor = 16）")
+    ap.add_argument("--batch", type=int, default=32, help="批次版本的查詢數；1 表示不測")
+    ap.add_argument("--repeat", type=int, default=20)
+    ap.add_argument("--json", action="store_true", help="輸出 JSON")
+    args = ap.parse_args(argv)
+
+    rows = run(args.sizes, args.n, args.batch, args.repeat)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"{'rows':>10} {'argsort ms':>12} {'topn ms':>10} {'speedup':>8} {'loop ms':>10} {'batch ms':>10}")
+    for r in rows:
+        print(
+            f"{r['rows']:>10} {r['argsort_ms']:>12.3f} {r['topn_ms']:>10.3f} {r['speedup']:>8.2f}"
+            f" {r.get('argsort_loop_ms', float('nan')):>10.3f} {r.get('topn_batch_ms', float('nan')):>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
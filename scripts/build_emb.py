@@ -1,16 +1,28 @@
 # scripts/build_emb.py
-from sentence_transformers import SentenceTransformer
-import json, pickle, re, logging
+import argparse, functools, hashlib, itertools, json, re, logging, multiprocessing, os, shutil, sys, tempfile, time
+from dataclasses import dataclass
 from json.decoder import JSONDecodeError
 import numpy as np
 from pathlib import Path
-from typing import Any, Iterable
+from typing import Any, Callable, Iterable, Iterator, Optional
 
 # ─────────────────────────────────────────────────────────────────────────────
 # 基本路徑
 BASE = Path(__file__).resolve().parents[1]      # 指到 NCUACG_net/
 DATA = BASE / "frontend" / "src" / "data"
 DATA.mkdir(exist_ok=True)
+INDEX_DIR  = DATA / "notices_index"             # retriever 預設讀取位置
+LEGACY_PKL = DATA / "notices.pkl"
+
+# 索引格式與 retriever 共用（assistant/services/index_store.py，不依賴 Django）
+sys.path.insert(0, str(BASE / "NCUACG"))
+from assistant.services import index_store  # noqa: E402
+from assistant.services.chunking import (  # noqa: E402
+    DEFAULT_MAX_TOKENS, DEFAULT_OVERLAP_TOKENS, carry_meta, chunk_sentences,
+)
+from assistant.services.dedup import Deduplicator, dedup_docs  # noqa: E402
+from assistant.services.lexical import BM25Builder, doc_text  # noqa: E402
+from assistant.services.timeparse import NAT, start_ts_column  # noqa: E402
 
 # 資料來源
 NOTICES_JSON = DATA / "notices.json"
@@ -68,10 +80,10 @@ def safe_load_json(path: Path, *, allow_comments: bool = False):
 # ─────────────────────────────────────────────────────────────────────────────
 # Embedding 模型
 MODEL_NAME = "intfloat/multilingual-e5-base"    # 中文/英文皆佳（E5 系列）
-model = SentenceTransformer(MODEL_NAME)
 
 # 會優先擷取這些 key 的字串內容
-PREFERRED_KEYS = {"title", "content", "description", "text", "body", "summary", "subtitle"}
+# 用 tuple 固定順序：set 的迭代順序會隨 PYTHONHASHSEED 變動，導致每次建置的段落順序不同
+PREFERRED_KEYS = ("title", "content", "description", "text", "body", "summary", "subtitle")
 
 def extract_text_blocks(obj: Any) -> list[str]:
     """
@@ -115,77 +127,430 @@ def extract_text_blocks(obj: Any) -> list[str]:
         out.append(s)
     return out
 
-def chunk_text(text: str, max_chars: int = 500) -> list[str]:
-    """簡單等長切片（只接字串）"""
-    text = re.sub(r"\s+", " ", text).strip()
-    if not text:
-        return []
-    return [text[i:i+max_chars] for i in range(0, len(text), max_chars)]
+def chunk_text(text: str, max_tokens: int = DEFAULT_MAX_TOKENS, overlap: int = DEFAULT_OVERLAP_TOKENS) -> list[str]:
+    """依句子切塊（中英文句末標點），每塊不超過 max_tokens，相鄰塊重疊 overlap 以內的尾句"""
+    return chunk_sentences(text, max_tokens=max_tokens, overlap_tokens=overlap)
+
+Chunker = Callable[[str], list[str]]
 
 # ─────────────────────────────────────────────────────────────────────────────
-# 收集語料
-docs: list[dict] = []
-
-# ① notices.json
-notices = safe_load_json(NOTICES_JSON, allow_comments=False)
-if notices is not None:
-    if isinstance(notices, dict):
-        notice_blocks = extract_text_blocks(notices)
-        for i, txt in enumerate(notice_blocks):
-            for piece in chunk_text(txt):
-                docs.append({"source": "notice", "index": i, "content": piece})
-    else:
-        for n in notices or []:
-            blocks = extract_text_blocks(n.get("content", n))
-            for piece in [p for b in blocks for p in chunk_text(b)]:
-                docs.append({
-                    "source":  "notice",
-                    "title":   n.get("title", ""),
-                    "slug":    n.get("slug", ""),
-                    "content": piece
-                })
-
-# ② aboutInfo.json
-about_data = safe_load_json(ABOUT_JSON, allow_comments=False)
-if about_data is not None:
-    about_blocks = extract_text_blocks(about_data)
-    for i, txt in enumerate(about_blocks):
-        for piece in chunk_text(txt):
-            docs.append({"source": "about", "section": i, "content": piece})
-
-# ③ introduction.json
-intro_data = safe_load_json(INTRO_JSON, allow_comments=False)
-if intro_data is not None:
-    if isinstance(intro_data, list):
-        for item in intro_data:
-            blocks = extract_text_blocks({
-                "title": item.get("title", ""),
-                "text":  item.get("text",  ""),
-            }) or extract_text_blocks(item)
-
-            for piece in [p for b in blocks for p in chunk_text(b)]:
-                docs.append({
-                    "source":  "introduction",
-                    "title":   item.get("title", ""),
-                    "url":     item.get("url", ""),
-                    "id":      item.get("id"),
-                    "content": piece,
-                })
+# 收集語料（串流管線：來源讀取 → 切塊 → 批次編碼 → 追加寫入）
+# 每個階段都是 generator，記憶體只需容納一個批次；大型封存（多年公告、歌謠祭投稿）
+# 可用 .jsonl 逐行讀取，不必整份載入。
+def read_records(path: Path) -> Iterator[Any]:
+    """
+    來源讀取：.jsonl 逐行 yield；.json 若是陣列就逐筆 yield，否則 yield 整個物件。
+    """
+    if path.suffix == ".jsonl":
+        try:
+            with open(path, "r", encoding="utf-8-sig") as f:
+                for lineno, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except JSONDecodeError as e:
+                        raise SystemExit(f"❌ 解析 JSONL 失敗：{path} 第 {lineno} 行：{e.msg}")
+        except FileNotFoundError:
+            logger.warning("⚠️ 找不到檔案：%s", path)
+        return
+
+    data = safe_load_json(path, allow_comments=False)
+    if data is None:
+        return
+    if isinstance(data, list):
+        yield from data
     else:
-        for piece in [p for b in extract_text_blocks(intro_data) for p in chunk_text(b)]:
-            docs.append({"source": "introduction", "content": piece})
+        yield data
+
+def iter_notice_docs(records: Iterable[Any], source: str = "notice", chunk: Chunker = chunk_text) -> Iterator[dict]:
+    for n in records:
+        if not isinstance(n, dict):
+            for i, txt in enumerate(extract_text_blocks(n)):
+                for piece in chunk(txt):
+                    yield {"source": source, "index": i, "content": piece}
+            continue
+        if "content" not in n and "title" not in n:
+            # 舊格式：notices.json 是一個大物件
+            for i, txt in enumerate(extract_text_blocks(n)):
+                for piece in chunk(txt):
+                    yield {"source": source, "index": i, "content": piece}
+            continue
+        # 結構化欄位（id / type / category，發布日 date 改名 posted）帶進每一段；
+        # 活動開始時間仍由 timeparse 從內文／標題解析，不拿發布日充數
+        meta = carry_meta(n)
+        blocks = extract_text_blocks(n.get("content", n))
+        for j, piece in enumerate(p for b in blocks for p in chunk(b)):
+            yield {
+                "source":  source,
+                "title":   n.get("title", ""),
+                "slug":    n.get("slug", ""),
+                **meta,
+                "chunk":   j,
+                "content": piece
+            }
+
+def iter_about_docs(records: Iterable[Any], chunk: Chunker = chunk_text) -> Iterator[dict]:
+    section = 0
+    for rec in records:
+        for txt in extract_text_blocks(rec):
+            for piece in chunk(txt):
+                yield {"source": "about", "section": section, "content": piece}
+            section += 1
 
-# 沒有任何文件就中止（避免輸出空 pkl）
-if not docs:
-    raise SystemExit("❌ 沒有可用文件，請確認 notices.json / aboutInfo.json / introduction.json 是否存在且有內容")
+def iter_intro_docs(records: Iterable[Any], chunk: Chunker = chunk_text) -> Iterator[dict]:
+    for item in records:
+        if not isinstance(item, dict):
+            for piece in (p for b in extract_text_blocks(item) for p in chunk(b)):
+                yield {"source": "introduction", "content": piece}
+            continue
+        blocks = extract_text_blocks({
+            "title": item.get("title", ""),
+            "text":  item.get("text",  ""),
+        }) or extract_text_blocks(item)
+
+        meta = carry_meta(item)
+        for j, piece in enumerate(p for b in blocks for p in chunk(b)):
+            yield {
+                "source":  "introduction",
+                "title":   item.get("title", ""),
+                "url":     item.get("url", ""),
+                "id":      item.get("id"),
+                **meta,
+                "chunk":   j,
+                "content": piece,
+            }
+
+def iter_docs(extra_sources: Iterable[Path] = (), chunk: Chunker = chunk_text) -> Iterator[dict]:
+    # ① notices.json
+    yield from iter_notice_docs(read_records(NOTICES_JSON), chunk=chunk)
+    # ② aboutInfo.json
+    yield from iter_about_docs(read_records(ABOUT_JSON), chunk=chunk)
+    # ③ introduction.json
+    yield from iter_intro_docs(read_records(INTRO_JSON), chunk=chunk)
+    # ④ 額外封存（--source）：以檔名當 source，格式同 notices
+    for path in extra_sources:
+        yield from iter_notice_docs(read_records(path), source=path.stem, chunk=chunk)
+
+def collect_docs(extra_sources: Iterable[Path] = (), chunk: Chunker = chunk_text) -> list[dict]:
+    return list(iter_docs(extra_sources, chunk=chunk))
+
+def batched(items: Iterable[Any], size: int) -> Iterator[list]:
+    it = iter(items)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+# ─────────────────────────────────────────────────────────────────────────────
+# 增量建置：以「模型 + passage 文字」的雜湊當 key，沒變的段落沿用舊向量
+def passage_text(doc: dict) -> str:
+    # E5 建議：文件加前綴 "passage: "
+    return f"passage: {doc['content']}"
+
+HASH_BYTES = 20   # sha1
+
+def chunk_hash(text: str, model_name: str = MODEL_NAME) -> bytes:
+    return hashlib.sha1(f"{model_name}\n{text}".encode("utf-8")).digest()
+
+def hash_column(hashes: list[bytes]) -> np.ndarray:
+    """
+    chunk_hash 欄位存成定長 void（V20）：NumPy 的 S 型別讀回時會去掉結尾的 \x00，
+    約 1/256 的雜湊會因此永遠對不上、每次都重新編碼。
+    """
+    return np.frombuffer(b"".join(hashes), dtype=f"V{HASH_BYTES}")
+
+class PreviousIndex:
+    """
+    既有索引的 chunk_hash → 列號對照；向量留在 memmap，需要時才讀（不整份載入記憶體）。
+    對照表是排序好的定長雜湊陣列 + searchsorted（每列約 28 bytes，不建 Python dict）；
+    used 記錄哪些舊列在這次建置中被沿用，結束時用來算移除了幾段。
+    索引不存在、模型不同或沒有雜湊欄位時為空。
+    """
+
+    def __init__(self, index_dir: Optional[Path] = None, model_name: str = MODEL_NAME):
+        self._keys = hash_column([])
+        self._rows = np.empty(0, dtype=np.int64)
+        self.used = np.zeros(0, dtype=bool)
+        self.vectors: Optional[np.ndarray] = None
+        if index_dir is None or not index_store.exists(index_dir):
+            return
+        try:
+            prev = index_store.open_index(index_dir)
+        except index_store.IndexFormatError as e:
+            logger.warning("既有索引無法讀取，改為全量建置：%s", e)
+            return
+        hashes = prev.columns.get("chunk_hash")
+        if prev.header.model != model_name or hashes is None:
+            return
+        self.vectors = prev.vectors
+        if hashes.dtype.kind == "S":
+            # 舊索引的 S20 欄位讀回時少了結尾的 \x00；sha1 固定 20 bytes，補回即可還原
+            hashes = hash_column([bytes(h).ljust(HASH_BYTES, b"\0") for h in hashes])
+        keys = np.asarray(hashes, dtype=f"V{HASH_BYTES}")
+        self._rows = np.argsort(keys, kind="stable")
+        self._keys = keys[self._rows]
+        self.used = np.zeros(len(keys), dtype=bool)
+
+    def row(self, h: bytes) -> Optional[int]:
+        if not self._keys.size:
+            return None
+        key = np.frombuffer(h, dtype=f"V{HASH_BYTES}")
+        i = int(np.searchsorted(self._keys, key)[0])
+        if i < self._keys.size and self._keys[i] == key[0]:
+            return int(self._rows[i])
+        return None
+
+    def __contains__(self, h: bytes) -> bool:
+        return self.row(h) is not None
+
+    def __len__(self) -> int:
+        return int(self._keys.size)
+
+    def vector(self, h: bytes) -> np.ndarray:
+        row = self.row(h)
+        self.used[row] = True
+        return np.asarray(self.vectors[row], dtype=np.float32)
+
+    def unused(self) -> int:
+        """既有索引中這次沒有沿用到的段數（已刪除或內容變動）。"""
+        return int(len(self) - self.used.sum())
+
+class PassageEncoder:
+    """批次編碼器；第一次真的需要編碼時才載入模型（全部沿用時完全不碰 torch）。"""
+    window = 1   # 一次處理幾個批次
+
+    def __init__(self, model_name: str = MODEL_NAME, threads: Optional[int] = None):
+        self.model_name = model_name
+        self.threads = threads
+        self._model = None
+        self.encoded = 0
+        self.seconds = 0.0
+
+    def encode(self, passages: list[str]) -> np.ndarray:
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer
+            if self.threads:
+                import torch
+                torch.set_num_threads(self.threads)
+            self._model = SentenceTransformer(self.model_name)
+        t0 = time.perf_counter()
+        vecs = self._model.encode(passages, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+        self.seconds += time.perf_counter() - t0
+        self.encoded += len(passages)
+        return vecs
+
+    def encode_many(self, jobs: list[list[str]]) -> list[Optional[np.ndarray]]:
+        return [self.encode(j) if j else None for j in jobs]
+
+    def close(self) -> None:
+        pass
+
+# ---- 多行程編碼（--workers N） ----
+# 每個 worker 在 initializer 載入一次模型；工作單位是「整個批次」，與單行程送進
+# model.encode 的清單完全相同（sentence-transformers 內部的長度排序/padding 也就相同），
+# 結果再依提交順序合併，因此輸出與單行程建置逐位元一致。
+_WORKER_ENCODER: Optional[PassageEncoder] = None
+
+def _init_worker(model_name: str, threads: Optional[int]) -> None:
+    global _WORKER_ENCODER
+    _WORKER_ENCODER = PassageEncoder(model_name, threads=threads)
+
+def _encode_in_worker(passages: list[str]) -> np.ndarray:
+    return _WORKER_ENCODER.encode(passages)
+
+class PoolEncoder(PassageEncoder):
+    def __init__(self, model_name: str, workers: int, threads: Optional[int] = None):
+        super().__init__(model_name, threads)
+        self.window = workers * 2
+        # spawn：Windows 相容，也避免 fork 後 torch 執行緒池狀態錯亂
+        ctx = multiprocessing.get_context("spawn")
+        self._pool = ctx.Pool(workers, initializer=_init_worker, initargs=(model_name, threads))
+
+    def encode_many(self, jobs: list[list[str]]) -> list[Optional[np.ndarray]]:
+        t0 = time.perf_counter()
+        pending = [self._pool.apply_async(_encode_in_worker, (j,)) if j else None for j in jobs]
+        out = [p.get() if p is not None else None for p in pending]
+        self.seconds += time.perf_counter() - t0
+        self.encoded += sum(len(j) for j in jobs)
+        return out
+
+    def close(self) -> None:
+        self._pool.close()
+        self._pool.join()
+
+@dataclass
+class BatchPlan:
+    docs: list[dict]
+    passages: list[str]
+    hashes: list[bytes]
+    todo: list[int]          # 需要重新編碼的列（新增或內容變動）
+
+    @property
+    def todo_passages(self) -> list[str]:
+        return [self.passages[i] for i in self.todo]
+
+def plan_batch(docs: list[dict], previous: PreviousIndex) -> BatchPlan:
+    passages = [passage_text(d) for d in docs]
+    hashes = [chunk_hash(p) for p in passages]
+    todo = [i for i, h in enumerate(hashes) if h not in previous]
+    return BatchPlan(docs, passages, hashes, todo)
+
+def assemble(plan: BatchPlan, fresh: Optional[np.ndarray], previous: PreviousIndex) -> tuple[np.ndarray, np.ndarray]:
+    """回傳 (vecs, chunk_hash 欄位)；新編碼的列用 fresh，其餘沿用舊向量。"""
+    rows: list = [None] * len(plan.docs)
+    for j, i in enumerate(plan.todo):
+        rows[i] = fresh[j]
+    for i, h in enumerate(plan.hashes):
+        if rows[i] is None:
+            rows[i] = previous.vector(h)
+    return np.vstack(rows).astype(np.float32), hash_column(plan.hashes)
+
+def embed_batches(
+    doc_batches: Iterable[list[dict]], previous: PreviousIndex, encoder: PassageEncoder
+) -> Iterator[tuple[list[dict], np.ndarray, np.ndarray]]:
+    """每次取 encoder.window 個批次一起送出（多行程時可平行），依原順序產出。"""
+    for window in batched(doc_batches, encoder.window):
+        plans = [plan_batch(docs, previous) for docs in window]
+        fresh = encoder.encode_many([p.todo_passages for p in plans])
+        for plan, f in zip(plans, fresh):
+            yield (plan.docs, *assemble(plan, f, previous))
 
 # ─────────────────────────────────────────────────────────────────────────────
 # 產生向量並輸出
-# E5 建議：文件加前綴 "passage: "
-passages = [f"passage: {d['content']}" for d in docs]
-vecs = model.encode(passages, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+def parse_args(argv=None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="建立 AI 助理的向量索引（memmap 格式）")
+    ap.add_argument("--out", type=Path, default=INDEX_DIR, help="索引輸出目錄")
+    ap.add_argument("--dtype", choices=index_store.SUPPORTED_DTYPES, default="float32",
+                    help="向量儲存精度（float16 可省一半磁碟空間；retriever 載入時轉回 float32）")
+    ap.add_argument("--quantize", choices=index_store.QUANT_MODES, default=None,
+                    help="另存量化副本供第一階段掃描（int8 約 1/4 記憶體），前幾名再以原始向量精算；"
+                         "查詢時需設 ASSISTANT_QUANTIZED_SCAN=1，只省記憶體、不會比 float32 快")
+    ap.add_argument("--from-pkl", type=Path, nargs="?", const=LEGACY_PKL, default=None,
+                    help="不重新編碼，直接把舊版 notices.pkl 轉成新索引格式")
+    ap.add_argument("--full", action="store_true", help="忽略既有索引，全部重新編碼")
+    ap.add_argument("--source", type=Path, action="append", default=[],
+                    help="額外語料（.json 或 .jsonl，格式同 notices），可重複指定")
+    ap.add_argument("--batch-size", type=int, default=64, help="每批編碼/寫入的段落數")
+    ap.add_argument("--workers", type=int, default=1, help="平行編碼的行程數（各自載入一次模型）")
+    ap.add_argument("--threads", type=int, default=None,
+                    help="每個 encoder 的 torch 執行緒數；要與其他建置逐位元比對時請指定相同值")
+    ap.add_argument("--chunk-tokens", type=int, default=DEFAULT_MAX_TOKENS, help="每段的 token 預算（估計值）")
+    ap.add_argument("--chunk-overlap", type=int, default=DEFAULT_OVERLAP_TOKENS,
+                    help="相鄰段落重疊的 token 上限（以整句為單位）")
+    ap.add_argument("--no-dedup", action="store_true", help="不做重複段落合併")
+    ap.add_argument("--dedup-distance", type=int, default=3,
+                    help="SimHash 漢明距離門檻（<0 只合併完全相同的段落）")
+    return ap.parse_args(argv)
+
+def iter_legacy_batches(path: Path, batch_size: int) -> Iterator[tuple[list[dict], np.ndarray, np.ndarray]]:
+    vecs, docs = index_store.load_legacy_pickle(path)
+    for start in range(0, len(docs), batch_size):
+        chunk = docs[start:start + batch_size]
+        hashes = hash_column([chunk_hash(passage_text(d)) for d in chunk])
+        yield chunk, vecs[start:start + batch_size], hashes
+
+class RefSpill:
+    """
+    去重 back-reference 的落地暫存：dedup_docs 每合併一段就寫一行 [代表列號, 來源]（JSONL），
+    不在記憶體累積；write_batches 在 commit 前把整個檔案串流複製成附檔 "duplicates"。
+    """
+
+    def __init__(self, dir: Optional[Path] = None):
+        self._f = tempfile.TemporaryFile(dir=dir)
+        self.count = 0
+
+    def __call__(self, rep: int, ref: dict) -> None:
+        self._f.write(json.dumps([rep, ref], ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+        self.count += 1
+
+    def copy_to(self, dst) -> None:
+        self._f.flush()
+        self._f.seek(0)
+        shutil.copyfileobj(self._f, dst)
+
+    def close(self) -> None:
+        self._f.close()
+
+def write_batches(
+    out: Path,
+    dtype: str,
+    batches: Iterable[tuple[list[dict], np.ndarray, np.ndarray]],
+    duplicates: Optional[RefSpill] = None,
+    quantize: Optional[str] = None,
+):
+    """
+    把 (docs, vecs, chunk_hash) 批次串流寫入索引；回傳 (header, 有開始時間的段數)。
+    duplicates：去重階段落地的 back-reference，批次全部寫完時才完整，因此在 commit 前才複製成附檔。
+
+    BM25 posting 與 back-reference 都逐批寫到暫存檔，不隨語料留在記憶體。
+    仍與段數成正比、留在記憶體的只有：Deduplicator 的雜湊狀態、BM25 每列長度（4 bytes）與詞表、
+    PreviousIndex 的雜湊對照（每列約 28 bytes）。
+    """
+    dated = 0
+    # IndexWriter 邊寫邊落地；commit 時「資料檔先改名、header 最後 os.replace」完成原子替換
+    with index_store.IndexWriter(out, model=MODEL_NAME, dtype=dtype, quantize=quantize) as writer, \
+            tempfile.TemporaryDirectory(prefix=".spill-", dir=out) as spill:
+        # BM25 倒排索引與向量同一代建置、同一次提交（附檔 "lexical"）
+        lexical = BM25Builder(spill_dir=Path(spill))
+        for docs, vecs, hashes in batches:
+            # 開始時間在建索引時解析一次，存成 int64 epoch 欄位（解析不到為 NaT）
+            start_ts = start_ts_column(docs)
+            dated += int((start_ts != NAT).sum())
+            writer.append(vecs, docs, columns={"start_ts": start_ts, "chunk_hash": hashes})
+            lexical.add(doc_text(d) for d in docs)
+        # 沒有任何文件就中止（避免輸出空索引）
+        if not writer.count:
+            raise SystemExit("❌ 沒有可用文件，請確認 notices.json / aboutInfo.json / introduction.json 是否存在且有內容")
+        bm25 = lexical.build()
+        logger.info("BM25：%d 個詞、%d 筆 posting", len(bm25.vocab), bm25.doc_ids.shape[0])
+        with writer.attach_file("lexical") as f:
+            bm25.save(f)
+        del bm25
+        if duplicates is not None and duplicates.count:
+            with writer.attach_file("duplicates") as f:
+                duplicates.copy_to(f)
+        return writer.commit(), dated
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+
+    if args.from_pkl:
+        batches = iter_legacy_batches(args.from_pkl, args.batch_size)
+        header, dated = write_batches(args.out, args.dtype, batches, quantize=args.quantize)
+        logger.info("start_ts：%d / %d 段解析到開始時間", dated, header.count)
+    else:
+        previous = PreviousIndex(None if args.full else args.out, MODEL_NAME)
+        if args.workers > 1:
+            threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+            encoder = PoolEncoder(MODEL_NAME, args.workers, threads)
+        else:
+            encoder = PassageEncoder(MODEL_NAME, args.threads)
+        args.out.mkdir(parents=True, exist_ok=True)
+        refs = RefSpill(dir=args.out)
+        try:
+            chunk = functools.partial(chunk_text, max_tokens=args.chunk_tokens, overlap=args.chunk_overlap)
+            docs = iter_docs(args.source, chunk=chunk)
+            # 去重在編碼之前：重複段落不必編碼，也不佔索引列
+            dedup = Deduplicator(max_distance=args.dedup_distance)
+            if not args.no_dedup:
+                docs = dedup_docs(docs, dedup, refs)
+            batches = embed_batches(batched(docs, args.batch_size), previous, encoder)
+            header, dated = write_batches(args.out, args.dtype, batches, duplicates=refs, quantize=args.quantize)
+        finally:
+            encoder.close()
+            refs.close()
 
-with open(DATA / "notices.pkl", "wb") as f:   # 沿用原檔名，retriever 無需改
-    pickle.dump((vecs, docs), f)
+        logger.info("start_ts：%d / %d 段解析到開始時間", dated, header.count)
+        logger.info("增量建置：沿用 %d 段、重新編碼 %d 段（encoder %.2fs）、移除 %d 段",
+                    header.count - encoder.encoded, encoder.encoded, encoder.seconds, previous.unused())
+        if not args.no_dedup:
+            logger.info("去重：保留 %(kept)d 段，合併完全重複 %(exact_dups)d 段、近似重複 %(near_dups)d 段",
+                        dedup.stats())
+    quant = f" + {header.quantization} 掃描副本" if header.quantization else ""
+    print(f"✅ 產生 {header.count} 段文件向量，寫入 {args.out}（模型：{MODEL_NAME}，{header.dtype}{quant}，hash {header.content_hash[:12]}）")
 
-print(f"✅ 產生 {len(docs)} 段文件向量，寫入 {DATA/'notices.pkl'}（模型：{MODEL_NAME}）")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# scripts/groq_stub.py
+"""
+本機的 Groq（OpenAI 相容）stub，用來在沒有 API key / 網路時測試 async 路徑與壓測併發。
+
+    python scripts/groq_stub.py --port 8765 --delay 1.0
+    GROQ_BASE_URL=http://127.0.0.1:8765 GROQ_API_KEY=stub python NCUACG/manage.py runserver
+
+接受任何以 /chat/completions 結尾的 POST；stream=true 時以 SSE 逐字回傳，
+最後一個 chunk 帶 x_groq.usage（與 Groq 相同位置）。--delay 模擬模型生成時間。
+"""
+import argparse, json, threading, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_handler(reply: str, delay: float):
+    lock = threading.Lock()
+    state = {"inflight": 0, "peak": 0, "served": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"      # keep-alive，才量得到連線池的效果
+
+        def log_message(self, fmt, *args):  # 壓測時不要洗版
+            pass
+
+        def _json(self, code: int, payload: dict) -> None:
+            raw = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/stats":
+                with lock:
+                    self._json(200, dict(state))
+                return
+            self._json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._json(404, {"error": {"message": f"unknown path {self.path}"}})
+                return
+            with lock:
+                state["inflight"] += 1
+                state["peak"] = max(state["peak"], state["inflight"])
+            try:
+                prompt_tokens = sum(len(m.get("content", "")) for m in body.get("messages", []))
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(reply),
+                         "total_tokens": prompt_tokens + len(reply)}
+                base = {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "created": int(time.time()),
+                        "model": body.get("model", "stub")}
+                if body.get("stream"):
+                    self._stream(base, usage)
+                else:
+                    time.sleep(delay)
+                    self._json(200, {
+                        **base, "object": "chat.completion",
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": reply}}],
+                        "usage": usage,
+                    })
+            finally:
+                with lock:
+                    state["inflight"] -= 1
+                    state["served"] += 1
+
+        def _stream(self, base: dict, usage: dict) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def send(payload: str) -> None:
+                raw = f"data: {payload}\n\n".encode("utf-8")
+                self.wfile.write(f"{len(raw):x}\r\n".encode() + raw + b"\r\n")
+                self.wfile.flush()
+
+            step = delay / max(len(reply), 1)
+            for ch in reply:
+                time.sleep(step)
+                send(json.dumps({**base, "object": "chat.completion.chunk",
+                                 "choices": [{"index": 0, "delta": {"content": ch}, "finish_reason": None}]},
+                                ensure_ascii=False))
+            send(json.dumps({**base, "object": "chat.completion.chunk",
+                             "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                             "x_groq": {"id": base["id"], "usage": usage}}))
+            send("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+
+    return Handler
+
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="Groq API stub（OpenAI 相容）")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--delay", type=float, default=0.5, help="每次回覆的模擬生成秒數")
+    ap.add_argument("--reply", default="這是 stub 的回覆。")
+    args = ap.parse_args(argv)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(args.reply, args.delay))
+    server.daemon_threads = True
+    print(f"groq stub listening on http://{args.host}:{args.port}（delay {args.delay}s）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()